@@ -0,0 +1,152 @@
+import sqlite3
+from datetime import datetime
+import db
+import metrics
+from subscription import EXPECTED_AGGREGATES
+
+# The aggregate tables are maintained by triggers on the subscriptions
+# table (see subscription._aggregate_statements), so every query here reads
+# a handful of pre-summed rows no matter how many subscriptions there are
+
+# Rows the triggers may leave behind that carry no information
+EMPTY_ROWS = {
+    'agg_active_price_deltas': 'price_delta = 0 AND count_delta = 0',
+    'agg_monthly_revenue': 'subscriptions = 0',
+    'agg_km_overage': 'subscriptions = 0',
+}
+
+def _month(value):
+    datetime.strptime(value, '%Y-%m')
+    return value
+
+def _location(value):
+    # Subscriptions without a location are aggregated under ''
+    return value or None
+
+# ----------------------------------------------------- Queries
+@metrics.timed('db', rows=True)
+def get_monthly_revenue(start_month=None, end_month=None, location=None):
+    try:
+        start_month = _month(start_month) if start_month else '0000-00'
+        end_month = _month(end_month) if end_month else '9999-99'
+    except ValueError:
+        return [400, {"error": "from and to must be months in the format YYYY-MM"}]
+
+    query = ''' SELECT month, SUM(revenue) AS revenue, SUM(subscriptions) AS subscriptions
+        FROM agg_monthly_revenue
+        WHERE month BETWEEN ? AND ? '''
+    params = [start_month, end_month]
+    if location is not None:
+        query += ' AND delivery_location = ?'
+        params.append(location)
+    query += ' GROUP BY month HAVING SUM(subscriptions) > 0 ORDER BY month'
+
+    try:
+        with db.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        if not rows:
+            return [404, {"message": "No revenue found for the given period"}]
+
+        return [200, [dict(row) for row in rows]]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+@metrics.timed('db', rows='locations')
+def get_revenue_by_location(month=None):
+    try:
+        month = _month(month) if month else datetime.now().strftime('%Y-%m')
+    except ValueError:
+        return [400, {"error": "month must be in the format YYYY-MM"}]
+
+    try:
+        with db.connection() as conn:
+            rows = conn.execute(
+                ''' SELECT delivery_location, revenue, subscriptions
+                FROM agg_monthly_revenue
+                WHERE month = ? AND subscriptions > 0
+                ORDER BY revenue DESC ''',
+                (month,)
+            ).fetchall()
+
+        if not rows:
+            return [404, {"message": f"No revenue found for {month}"}]
+
+        return [200, {
+            "month": month,
+            "revenue": sum(row['revenue'] for row in rows),
+            "subscriptions": sum(row['subscriptions'] for row in rows),
+            "locations": [
+                {**dict(row), "delivery_location": _location(row['delivery_location'])}
+                for row in rows
+            ]
+        }]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+@metrics.timed('db', rows='locations')
+def get_km_overage():
+    try:
+        with db.connection() as conn:
+            rows = conn.execute(
+                ''' SELECT delivery_location, subscriptions, over_contracted, overage_km, km_driven, contracted_km
+                FROM agg_km_overage
+                WHERE subscriptions > 0
+                ORDER BY overage_km DESC '''
+            ).fetchall()
+
+        if not rows:
+            return [404, {"message": "No subscriptions found"}]
+
+        locations = [{**dict(row), "delivery_location": _location(row['delivery_location'])} for row in rows]
+        totals = {
+            key: sum(location[key] for location in locations)
+            for key in ('subscriptions', 'over_contracted', 'overage_km', 'km_driven', 'contracted_km')
+        }
+        return [200, {**totals, "locations": locations}]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+# ----------------------------------------------------- Reconciliation
+def reconcile_aggregates(rebuild=True):
+    # Recomputes every aggregate table from the subscriptions table and
+    # counts the rows that differ. With rebuild the tables are replaced by
+    # the recomputed ones. Runs in one write transaction, so no write can
+    # slip in between computing and replacing
+    report = {}
+    try:
+        with db.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+
+            for table, expected_query in EXPECTED_AGGREGATES.items():
+                expected = f'expected_{table}'
+                conn.execute(f'DROP TABLE IF EXISTS temp.{expected}')
+                conn.execute(f'CREATE TEMP TABLE {expected} AS {expected_query}')
+
+                actual = f'SELECT * FROM {table} WHERE NOT ({EMPTY_ROWS[table]})'
+                mismatched = conn.execute(
+                    f''' SELECT
+                        (SELECT COUNT(*) FROM (SELECT * FROM temp.{expected} EXCEPT {actual})),
+                        (SELECT COUNT(*) FROM ({actual} EXCEPT SELECT * FROM temp.{expected})),
+                        (SELECT COUNT(*) FROM temp.{expected}) '''
+                ).fetchone()
+
+                report[table] = {
+                    "rows": mismatched[2],
+                    "missing_or_wrong": mismatched[0],
+                    "unexpected": mismatched[1],
+                }
+
+                if rebuild:
+                    conn.execute(f'DELETE FROM {table}')
+                    conn.execute(f'INSERT INTO {table} SELECT * FROM temp.{expected}')
+                conn.execute(f'DROP TABLE temp.{expected}')
+
+        consistent = all(not (t["missing_or_wrong"] or t["unexpected"]) for t in report.values())
+        return [200, {"consistent": consistent, "rebuilt": rebuild, "tables": report}]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
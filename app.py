@@ -1,79 +1,142 @@
-from flask import Flask, jsonify, request, make_response
-import requests
+from flask import Flask, Response, jsonify, request, g
+import time
 import os
 from dotenv import load_dotenv
-from flasgger import swag_from
-from datetime import datetime
-from swagger.config import init_swagger
+from werkzeug.utils import secure_filename
+from swagger.config import init_swagger, swag_from
 import subscription
+import analytics
+import columnar
+import importer
+import gateway
+import outbox
+import scheduler
 import auth
+import db
+import metrics
+import serialization
+import replication
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
+app.json = serialization.JSONProvider(app)
 
 # Configuration
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-ADMIN_EMAIL = os.getenv('ADMIN_EMAIL')
-ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
-ADMIN_GATEWAY_URL = os.getenv('ADMIN_GATEWAY_URL')
-
-cookies = None
 
 # Initialize Swagger
 init_swagger(app)
 
-# ----------------------------------------------------- Private functions
-def _login():
-    global cookies
-    if cookies == None or 'Authorization' not in cookies:
-        url = f'{ADMIN_GATEWAY_URL}/user/login' 
-
-        response = requests.post( 
-            url, 
-            json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}, 
-            headers={'Content-Type': 'application/json'},
-            ) 
-        
-        if response.status_code == 200: 
-            cookies = response.cookies
-            return True
-        return False 
-    return True
+# ----------------------------------------------------- Startup
+# Importing the app doesn't touch the database. The server creates the
+# schema once before serving: app.run below, or the gunicorn master (see
+# gunicorn.conf.py)
+def init_schema():
+    return subscription.create_table()
+
+# ----------------------------------------------------- Background tasks
+# Started by the server in each process that handles requests: by app.run
+# below, or by gunicorn in every worker after forking (see gunicorn.conf.py)
+def start_background_tasks():
+    if replication.ROLE == 'replica':
+        # Copy the primary's changes. Car availability is pushed by the primary
+        replication.tailer.start()
+    else:
+        # Deliver queued car availability updates in the background
+        if outbox.OUTBOX_ENABLED:
+            outbox.dispatcher.start()
+
+        # Push availability changes caused by subscriptions starting or ending at midnight
+        if scheduler.AVAILABILITY_JOB_ENABLED:
+            scheduler.availability_job.start()
+
+    # Share this worker's metrics with the other workers (only under gunicorn)
+    metrics.flusher.start()
+
+def stop_background_tasks(timeout=None):
+    outbox.dispatcher.stop(timeout)
+    scheduler.availability_job.stop(timeout)
+    metrics.flusher.stop(timeout)
+    replication.tailer.stop(timeout)
+
+# ----------------------------------------------------- Request metrics
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    start = g.get('request_start')
+    if start is not None:
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - start, route=route, method=request.method, status=response.status_code
+        )
+
+    if response.is_streamed:
+        response.response = _count_bytes(response.response, route, request.method)
+    else:
+        metrics.RESPONSE_BYTES.inc(response.content_length or 0, route=route, method=request.method)
 
-def _is_available(start_date, end_date):
+    return response
+
+# Registered after the metrics hook so it runs before it (Flask runs them
+# in reverse order) and the bytes counted are the compressed ones
+app.after_request(serialization.compress)
+
+# ----------------------------------------------------- Read replica
+# A replica serves reads from its copy of the primary's data and refuses
+# writes, see replication.py
+if replication.ROLE == 'replica':
+    app.before_request(replication.guard_request)
+    app.after_request(replication.add_staleness_header)
+
+def _count_bytes(body, route, method):
+    # Streamed bodies are counted as they are sent
+    sent = 0
     try:
-        # Calculate is_available based on subscription dates 
-        today = datetime.now().strftime('%Y-%m-%d') 
-        start_date = datetime.strptime(start_date, '%Y-%m-%d') 
-        end_date = datetime.strptime(end_date, '%Y-%m-%d') 
-        is_available = not (start_date <= datetime.strptime(today, '%Y-%m-%d') <= end_date)
-        return [200, is_available]
-
-    except Exception as e:
-        return [500, {"error": str(e)}]
-
-def _update_car_is_available(data):
-    car_id = data.get("car_id")
-    start_date = data.get("subscription_start_date")
-    end_date = data.get("subscription_end_date")
-    
-    if car_id and start_date and end_date:
-        is_available = _is_available(start_date, end_date)
-        if is_available[0] == 200:
-            if _login():
-                url = f'{ADMIN_GATEWAY_URL}/car/cars/{car_id}'
-                payload = { "is_available": is_available[1] } 
-                headers = { 'Content-Type': 'application/json' }
-                response = requests.patch(url, json=payload, headers=headers, cookies=cookies)
-                return response.json(), response.status_code
-            
-            return {"message": "Authentication failed"}, 401
-        
-        return {"message": f"Could not calculate is_available: {is_available[1]}"}, 404
-    
-    return {"message": "No car id, start date or end date found"}, 404
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        metrics.RESPONSE_BYTES.inc(sent, route=route, method=method)
+
+# ----------------------------------------------------- Private functions
+def _int_arg(name):
+    value = request.args.get(name)
+    return int(value) if value is not None else None
+
+def _conditional_response(result, status):
+    # Tags successful responses with an ETag so clients polling with
+    # If-None-Match get an empty 304 while nothing has changed
+    response = jsonify(result)
+    response.status_code = status
+
+    if status == 200:
+        response.add_etag()
+        response.make_conditional(request)
+
+    return response
+
+def _stream_subscriptions(batches, stream):
+    # Rows are encoded a batch at a time so each write to the socket carries a batch
+    if stream == 'array':
+        yield b'['
+
+    first = True
+    for batch in batches:
+        if stream == 'ndjson':
+            yield serialization.encode_rows(batch, '\n') + b'\n'
+        else:
+            yield (b'' if first else b',') + serialization.encode_rows(batch)
+        first = False
+
+    if stream == 'array':
+        yield b']'
 
 # ----------------------------------------------------- GET /
 @app.route('/', methods=['GET'])
@@ -85,7 +148,7 @@ def service_info():
             {
                 "path": "/subscriptions",
                 "method": "GET",
-                "description": "Retrieve a list of subscriptions",
+                "description": "Retrieve a list of subscriptions. Supports filters (car_id, location, start_from, start_to, end_from, end_to, active_on, min_price, max_price, has_delivery_insurance, over_contracted_km), sorting (sort, order), keyset pagination (after_id, limit), field projection (fields) and streaming (stream=ndjson|array)",
                 "role_required": "admin, finance, sales"
             },
             {
@@ -106,16 +169,34 @@ def service_info():
                 "description": "Retrieve the total price of current active subscriptions",
                 "role_required": "admin, finance"
             },
+            {
+                "path": "/subscriptions/current/cars",
+                "method": "GET",
+                "description": "Retrieve current active subscriptions together with the car information of each",
+                "role_required": "admin"
+            },
             {
                 "path": "/subscriptions/<int:id>/car",
                 "method": "GET",
                 "description": "Retrieve car information for a specific subscription by ID",
                 "role_required": "admin, sales"
             },
+            {
+                "path": "/cars/<int:car_id>/free-windows",
+                "method": "GET",
+                "description": "Retrieve the date ranges between from and to (YYYY-MM-DD) in which a car has no subscription",
+                "role_required": "admin, sales"
+            },
             {
                 "path": "/subscriptions",
                 "method": "POST",
-                "description": "Add a new subscription",
+                "description": "Add a new subscription. Returns 409 if the car already has a subscription overlapping the dates",
+                "role_required": "admin, sales"
+            },
+            {
+                "path": "/subscriptions/batch",
+                "method": "POST",
+                "description": "Apply a list of create, update and delete operations in a single transaction",
                 "role_required": "admin, sales"
             },
             {
@@ -129,6 +210,78 @@ def service_info():
                 "method": "DELETE",
                 "description": "Delete a subscription by ID",
                 "role_required": "admin, sales"
+            },
+            {
+                "path": "/admin/subscriptions/import",
+                "method": "POST",
+                "description": "Bulk import subscriptions from an uploaded CSV file",
+                "role_required": "admin"
+            },
+            {
+                "path": "/analytics/revenue/monthly",
+                "method": "GET",
+                "description": "Revenue and number of billed subscriptions per month (from, to, location)",
+                "role_required": "admin, finance"
+            },
+            {
+                "path": "/analytics/revenue/locations",
+                "method": "GET",
+                "description": "Revenue per delivery location for a month (month, default the current month)",
+                "role_required": "admin, finance"
+            },
+            {
+                "path": "/analytics/km-overage",
+                "method": "GET",
+                "description": "Km driven over the contracted km, in total and per delivery location",
+                "role_required": "admin, finance"
+            },
+            {
+                "path": "/analytics/utilization",
+                "method": "GET",
+                "description": "Subscribed car-days per month relative to the fleet (from, to)",
+                "role_required": "admin, finance"
+            },
+            {
+                "path": "/analytics/revenue/projection",
+                "method": "GET",
+                "description": "Projected revenue per month from the contracted durations (from, months)",
+                "role_required": "admin, finance"
+            },
+            {
+                "path": "/analytics/km-overage/distribution",
+                "method": "GET",
+                "description": "Distribution of km driven over the contracted km (bins, location)",
+                "role_required": "admin, finance"
+            },
+            {
+                "path": "/replication/changes",
+                "method": "GET",
+                "description": "Change feed for read replicas: the current rows of the subscriptions changed after a change log seq (after_seq, limit) and the ids of the deleted ones",
+                "role_required": "admin, replication"
+            },
+            {
+                "path": "/replication/snapshot",
+                "method": "GET",
+                "description": "A page of all subscriptions (after_id, limit) with the change log seq it was read at, for a replica's first copy",
+                "role_required": "admin, replication"
+            },
+            {
+                "path": "/metrics",
+                "method": "GET",
+                "description": "Request latency, response size, span timing and row count metrics in the Prometheus text format",
+                "role_required": "none"
+            },
+            {
+                "path": "/admin/profiler",
+                "method": "GET",
+                "description": "Stacks sampled by the profiler in the folded (flame graph) format",
+                "role_required": "admin"
+            },
+            {
+                "path": "/admin/profiler/<action>",
+                "method": "POST",
+                "description": "Start or stop the sampling profiler of the worker that handles the request",
+                "role_required": "admin"
             }
         ]
     })
@@ -138,10 +291,47 @@ def service_info():
 @swag_from('swagger/get_subscriptions.yaml')
 @auth.role_required('admin', 'finance', 'sales') 
 def subscriptions_get():
-    
-    status, result = subscription.get_subscriptions()
+    try:
+        after_id = _int_arg('after_id')
+        limit = _int_arg('limit')
+    except ValueError:
+        return jsonify({"error": "after_id and limit must be integers"}), 400
 
-    return jsonify(result), status
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+    filters = {name: request.args[name] for name in subscription.FILTERS if name in request.args}
+    sort = request.args.get('sort')
+    order = request.args.get('order', 'asc')
+    stream = request.args.get('stream')
+
+    if stream:
+        if stream not in ('ndjson', 'array'):
+            return jsonify({"error": "stream must be 'ndjson' or 'array'"}), 400
+
+        try:
+            batches = subscription.iter_subscription_batches(after_id, fields, filters, sort, order, limit)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+        return Response(_stream_subscriptions(batches, stream), mimetype=mimetype)
+
+    if after_id is None and limit is None:
+        status, result = subscription.get_subscriptions(fields, filters, sort, order)
+
+        return jsonify(result), status
+
+    status, result = subscription.get_subscriptions_page(
+        after_id, subscription.MAX_PAGE_SIZE if limit is None else limit, fields, filters, sort, order
+    )
+    if status != 200:
+        return jsonify(result), status
+
+    response = jsonify(result["subscriptions"])
+    if result["next_after_id"] is not None:
+        response.headers['X-Next-After-Id'] = str(result["next_after_id"])
+
+    return response, status
 
 # ----------------------------------------------------- GET /subscriptions/id
 @app.route('/subscriptions/<int:id>', methods=['GET'])
@@ -151,7 +341,7 @@ def get_subscription(id):
     
     status, result = subscription.get_subscription_by_id(id)
 
-    return jsonify(result), status
+    return _conditional_response(result, status)
 
 # ----------------------------------------------------- GET /subscriptions/id/car
 @app.route('/subscriptions/<int:id>/car', methods=['GET'])
@@ -164,14 +354,9 @@ def get_subscription_car_info(id):
         car_id = result.get("car_id")
         
         if car_id:
-            if _login():
-                url = f'{ADMIN_GATEWAY_URL}/car/cars/{car_id}'
-                headers = { 'Content-Type': 'application/json' }
-                response = requests.get(url, headers=headers, cookies=cookies)
-            
-                return response.json(), response.status_code
-            
-            return jsonify({"message": "Authentication failed"}), 401
+            status, result = gateway.client.get_car_info(car_id)
+
+            return jsonify(result), status
         
         return jsonify({"message": "No car id found"}), 404
     
@@ -185,7 +370,28 @@ def get_current_subscriptions():
     
     status, result = subscription.get_active_subscriptions()
 
-    return jsonify(result), status
+    return _conditional_response(result, status)
+
+# ----------------------------------------------------- GET /subscriptions/current/cars
+@app.route('/subscriptions/current/cars', methods=['GET'])
+@swag_from('swagger/get_current_subscriptions_cars.yaml')
+@auth.role_required('admin')
+def get_current_subscriptions_cars():
+    status, result = subscription.get_active_subscriptions()
+    if status != 200:
+        return jsonify(result), status
+
+    cars = gateway.client.get_car_infos(row["car_id"] for row in result if row.get("car_id"))
+
+    subscriptions = []
+    for row in result:
+        car_status, car = cars.get(row.get("car_id"), [404, {"message": "No car id found"}])
+        if car_status == 200:
+            subscriptions.append({**row, "car": car})
+        else:
+            subscriptions.append({**row, "car": None, "car_error": {"status": car_status, **car}})
+
+    return jsonify(subscriptions), 200
 
 # ----------------------------------------------------- GET /subscriptions/current/total-price
 @app.route('/subscriptions/current/total-price', methods=['GET'])
@@ -195,7 +401,16 @@ def get_current_subscriptions_total_price():
     
     status, result = subscription.get_active_subscriptions_total_price()
 
-    return jsonify(result), status
+    return _conditional_response(result, status)
+
+# ----------------------------------------------------- GET /cars/car_id/free-windows
+@app.route('/cars/<int:car_id>/free-windows', methods=['GET'])
+@swag_from('swagger/get_car_free_windows.yaml')
+@auth.role_required('admin', 'sales')
+def get_car_free_windows(car_id):
+    status, result = subscription.get_free_windows(car_id, request.args.get('from'), request.args.get('to'))
+
+    return _conditional_response(result, status)
 
 # ----------------------------------------------------- POST /subscriptions
 @app.route('/subscriptions', methods=['POST'])
@@ -207,13 +422,30 @@ def post_subscription():
     status, result = subscription.add_subscription(data)
     response_data = {"subscription": {"result": result, "status": status}}
 
-    if status == 201:
-        car_update_status, car_update_result = _update_car_is_available(data)
-        response_data["car_update"] = {"result": car_update_result, "status": car_update_status}
-        return jsonify(response_data), car_update_status
+    # The car service is updated by the outbox dispatcher after the commit
+    if "car_update" in result:
+        response_data["car_update"] = result.pop("car_update")
+        outbox.dispatcher.notify()
 
     return jsonify(response_data), status
 
+# ----------------------------------------------------- POST /subscriptions/batch
+@app.route('/subscriptions/batch', methods=['POST'])
+@swag_from('swagger/post_subscriptions_batch.yaml')
+@auth.role_required('admin', 'sales')
+def post_subscriptions_batch():
+    operations = request.get_json(silent=True)
+
+    status, result = subscription.apply_batch(operations)
+    if status != 200:
+        return jsonify(result), status
+
+    if result["car_update"]["car_ids"]:
+        outbox.dispatcher.notify()
+
+    failed = any(item["status"] >= 400 for item in result["results"])
+    return jsonify(result), 207 if failed else 200
+
 # ----------------------------------------------------- PATCH /subscriptions/id
 @app.route('/subscriptions/<int:id>', methods=['PATCH'])
 @swag_from('swagger/patch_subscription.yaml')
@@ -222,17 +454,9 @@ def patch_subscription(id):
     data = request.json
     
     status, result = subscription.update_subscription(id, data)
-    response_data = {"subscription": {"result": result, "status": status}}
 
-    if status == 201:
-        start = data.get('subscription_start_date')
-        end = data.get('subscription_end_date')
-        duration = data.get('subscription_duration_months', 3)
-
-        if start and end or duration and end:
-            car_update_status, car_update_result = _update_car_is_available(data)
-            response_data["car_update"] = {"result": car_update_result, "status": car_update_status}
-            return jsonify(response_data), car_update_status
+    if "car_update" in result:
+        outbox.dispatcher.notify()
 
     return jsonify(result), status
 
@@ -243,12 +467,174 @@ def patch_subscription(id):
 def delete_subscription(id):        
     status, result = subscription.delete_item_by_id(id)
 
+    if "car_update" in result:
+        outbox.dispatcher.notify()
+
+    return jsonify(result), status
+
+# ----------------------------------------------------- POST /admin/subscriptions/import
+@app.route('/admin/subscriptions/import', methods=['POST'])
+@swag_from('swagger/post_subscriptions_import.yaml')
+@auth.role_required('admin')
+def import_subscriptions():
+    file = request.files.get('file')
+    if file is None:
+        return jsonify({"error": "No CSV file uploaded in the 'file' field"}), 400
+
+    try:
+        offset = int(request.form.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
+
+    status, result = importer.import_csv_upload(file.stream, secure_filename(file.filename), offset)
+
+    return jsonify(result), status
+
+# ----------------------------------------------------- GET /analytics/revenue/monthly
+@app.route('/analytics/revenue/monthly', methods=['GET'])
+@swag_from('swagger/get_analytics_revenue_monthly.yaml')
+@auth.role_required('admin', 'finance')
+def get_monthly_revenue():
+    status, result = analytics.get_monthly_revenue(
+        request.args.get('from'), request.args.get('to'), request.args.get('location')
+    )
+
+    return _conditional_response(result, status)
+
+# ----------------------------------------------------- GET /analytics/revenue/locations
+@app.route('/analytics/revenue/locations', methods=['GET'])
+@swag_from('swagger/get_analytics_revenue_locations.yaml')
+@auth.role_required('admin', 'finance')
+def get_revenue_by_location():
+    status, result = analytics.get_revenue_by_location(request.args.get('month'))
+
+    return _conditional_response(result, status)
+
+# ----------------------------------------------------- GET /analytics/km-overage
+@app.route('/analytics/km-overage', methods=['GET'])
+@swag_from('swagger/get_analytics_km_overage.yaml')
+@auth.role_required('admin', 'finance')
+def get_km_overage():
+    status, result = analytics.get_km_overage()
+
+    return _conditional_response(result, status)
+
+# ----------------------------------------------------- GET /analytics/utilization
+@app.route('/analytics/utilization', methods=['GET'])
+@swag_from('swagger/get_analytics_utilization.yaml')
+@auth.role_required('admin', 'finance')
+def get_utilization():
+    status, result = columnar.utilization(request.args.get('from'), request.args.get('to'))
+
+    return jsonify(result), status
+
+# ----------------------------------------------------- GET /analytics/revenue/projection
+@app.route('/analytics/revenue/projection', methods=['GET'])
+@swag_from('swagger/get_analytics_revenue_projection.yaml')
+@auth.role_required('admin', 'finance')
+def get_revenue_projection():
+    try:
+        months = _int_arg('months')
+    except ValueError:
+        return jsonify({"error": "months must be an integer"}), 400
+
+    status, result = columnar.revenue_projection(12 if months is None else months, request.args.get('from'))
+
     return jsonify(result), status
 
+# ----------------------------------------------------- GET /analytics/km-overage/distribution
+@app.route('/analytics/km-overage/distribution', methods=['GET'])
+@swag_from('swagger/get_analytics_km_overage_distribution.yaml')
+@auth.role_required('admin', 'finance')
+def get_km_overage_distribution():
+    try:
+        bins = _int_arg('bins')
+    except ValueError:
+        return jsonify({"error": "bins must be an integer"}), 400
+
+    status, result = columnar.overage_distribution(10 if bins is None else bins, request.args.get('location'))
+
+    return jsonify(result), status
+
+# ----------------------------------------------------- GET /replication/changes
+@app.route('/replication/changes', methods=['GET'])
+@swag_from('swagger/get_replication_changes.yaml')
+@auth.role_required('admin', 'replication')
+def get_replication_changes():
+    try:
+        after_seq = _int_arg('after_seq')
+        limit = _int_arg('limit')
+    except ValueError:
+        return jsonify({"error": "after_seq and limit must be integers"}), 400
+
+    status, result = replication.get_changes(
+        0 if after_seq is None else after_seq, replication.REPLICATION_BATCH_SIZE if limit is None else limit
+    )
+
+    return jsonify(result), status
+
+# ----------------------------------------------------- GET /replication/snapshot
+@app.route('/replication/snapshot', methods=['GET'])
+@swag_from('swagger/get_replication_snapshot.yaml')
+@auth.role_required('admin', 'replication')
+def get_replication_snapshot():
+    try:
+        after_id = _int_arg('after_id')
+        limit = _int_arg('limit')
+    except ValueError:
+        return jsonify({"error": "after_id and limit must be integers"}), 400
+
+    status, result = replication.get_snapshot(
+        0 if after_id is None else after_id, replication.REPLICATION_BATCH_SIZE if limit is None else limit
+    )
+
+    return jsonify(result), status
+
+# ----------------------------------------------------- GET /metrics
+@app.route('/metrics', methods=['GET'])
+@swag_from('swagger/get_metrics.yaml')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ----------------------------------------------------- GET /admin/profiler
+@app.route('/admin/profiler', methods=['GET'])
+@swag_from('swagger/get_admin_profiler.yaml')
+@auth.role_required('admin')
+def get_profile():
+    return Response(metrics.profiler.folded(), mimetype='text/plain')
+
+# ----------------------------------------------------- POST /admin/profiler/<action>
+@app.route('/admin/profiler/<action>', methods=['POST'])
+@swag_from('swagger/post_admin_profiler.yaml')
+@auth.role_required('admin')
+def toggle_profiler(action):
+    if action == 'start':
+        if not metrics.profiler.start():
+            return jsonify({"error": "The profiler is already running", **metrics.profiler.stats()}), 409
+    elif action == 'stop':
+        metrics.profiler.stop()
+    else:
+        return jsonify({"error": "action must be start or stop"}), 400
+
+    return jsonify(metrics.profiler.stats()), 200
+
 # ----------------------------------------------------- GET /health
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy"}), 200
+    return jsonify({
+        "status": "healthy",
+        "db_pool": db.pool_stats(),
+        "cache": subscription.cache_stats(),
+        "auth_cache": auth.cache_stats(),
+        "columnar": columnar.store.stats(),
+        "gateway": gateway.client.stats(),
+        "outbox": outbox.dispatcher.stats(),
+        "availability_job": scheduler.availability_job.stats(),
+        "replication": replication.stats()
+    }), 200
     
 if __name__ == '__main__':
+    # Development server. Use gunicorn in production: gunicorn -c gunicorn.conf.py app:app
+    init_schema()
+    start_background_tasks()
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5006)))
\ No newline at end of file
@@ -1,13 +1,31 @@
 from flask import request, jsonify
+import hashlib
+import time
 import os
 import jwt
 import datetime
 from functools import wraps
 from dotenv import load_dotenv
+import cache
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 SECRET_KEY = os.getenv('SECRET_KEY')
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv('AUTH_CACHE_MAX_ENTRIES', 4096))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 300))
+
+# Verified tokens by sha256 digest, each kept until the token expires
+_token_cache = cache.TTLCache(maxsize=AUTH_CACHE_MAX_ENTRIES, ttl=AUTH_CACHE_TTL)
+
+class Identity:
+    """The verified claims of a token, with the roles as a frozenset"""
+    __slots__ = ('subject', 'roles', 'expires_at')
+
+    def __init__(self, subject, roles, expires_at):
+        self.subject = subject
+        self.roles = roles
+        self.expires_at = expires_at
 
 def create_token(email, roles):
     now = datetime.datetime.now(tz=datetime.timezone.utc)
@@ -19,17 +37,45 @@ def create_token(email, roles):
     }
     return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
-def decode_token(token):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        return payload
-    except jwt.ExpiredSignatureError:
-        return 'Token expired. Please log in again.'
-    except jwt.InvalidTokenError:
-        return 'Invalid token. Please log in again.'
+def _roles(claim):
+    if isinstance(claim, str):
+        return frozenset((claim,))
+    if isinstance(claim, (list, tuple)):
+        return frozenset(role for role in claim if isinstance(role, str))
+    return frozenset()
+
+def verify_token(token):
+    # Raises jwt.ExpiredSignatureError or jwt.InvalidTokenError. Only tokens
+    # that verified are cached, so a bad token is rejected again every time
+    key = hashlib.sha256(token.encode()).digest()
+    identity = _token_cache.get(key)
+    if identity is not cache.MISSING:
+        # The cache clock is monotonic; make sure the wall clock agrees
+        if identity.expires_at is None or time.time() < identity.expires_at:
+            return identity
+        raise jwt.ExpiredSignatureError('Signature has expired')
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    exp = payload.get('exp')
+    identity = Identity(payload.get('sub'), _roles(payload.get('roles')), float(exp) if exp is not None else None)
 
+    ttl = AUTH_CACHE_TTL if identity.expires_at is None else identity.expires_at - time.time()
+    if ttl > 0:
+        _token_cache.set(key, identity, ttl=ttl)
+    return identity
+
+def clear_token_cache():
+    _token_cache.clear()
+
+def cache_stats():
+    return _token_cache.stats()
+
+def _error(status, error, message):
+    return jsonify({'error': error, 'message': message}), status
 
 def role_required(*roles):
+    required = frozenset(roles)
+
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
@@ -39,20 +85,19 @@ def role_required(*roles):
                 # Check for token in headers if not found in cookies
                 token = request.headers.get('Authorization')
                 if not token:
-                    return jsonify({'message': 'Token is missing! You do not have permission to access this endpoint!'}), 401
+                    return _error(401, 'token_missing', 'Token is missing! You do not have permission to access this endpoint!')
 
             try:
-                # Decode the token
-                payload = decode_token(token)
-                # Check for required roles
-                if not any(role in payload['roles'] for role in roles):
-                    return jsonify({'message': 'You do not have permission to access this endpoint!'}), 403
-            except jwt.ExpiredSignatureError as e:
-                return jsonify({'message': str(e)}), 401
-            except jwt.InvalidTokenError as e:
-                return jsonify({'message': str(e)}), 401
-            except Exception as e:
-                return jsonify({'message': str(e)}), 401
+                with metrics.span('auth', 'verify_token'):
+                    identity = verify_token(token)
+            except jwt.ExpiredSignatureError:
+                return _error(401, 'token_expired', 'Token expired. Please log in again.')
+            except jwt.InvalidTokenError:
+                return _error(401, 'token_invalid', 'Invalid token. Please log in again.')
+
+            # Check for required roles
+            if required.isdisjoint(identity.roles):
+                return _error(403, 'forbidden', 'You do not have permission to access this endpoint!')
 
             return f(*args, **kwargs)
         return decorated_function
@@ -0,0 +1,15 @@
+def run_loop(stop, step, wait, on_error):
+    # Body of the background threads (outbox dispatcher, availability job,
+    # replica tailer): calls step() until the `stop` event is set, and
+    # wait(result) after each call to pause until the next one. An exception
+    # from step is passed to on_error as 'Type: message' and wait gets None;
+    # the work is retried on the next round, as letting the exception end
+    # the thread would stop it until the process restarts
+    while not stop.is_set():
+        try:
+            result = step()
+        except Exception as e:
+            on_error(f'{type(e).__name__}: {e}')
+            result = None
+
+        wait(result)
@@ -0,0 +1,69 @@
+"""Authentication overhead per request, with and without the token cache.
+
+    python benchmarks/bench_auth.py [--requests N] [--tokens N]
+
+Each request runs auth.role_required inside a Flask request context, with
+the token taken round-robin from a small pool like a busy service sees.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'benchmark-secret')
+
+from flask import Flask
+import auth
+import cache
+
+app = Flask(__name__)
+
+@auth.role_required('admin', 'sales')
+def endpoint():
+    return 'ok'
+
+def run(tokens, requests):
+    contexts = [
+        app.test_request_context('/', headers={'Authorization': token})
+        for token in tokens
+    ]
+    timings = []
+    for i in range(requests):
+        ctx = contexts[i % len(contexts)]
+        with ctx:
+            start = time.perf_counter()
+            endpoint()
+            timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    return {
+        "mean_us": sum(timings) / len(timings) * 1e6,
+        "p50_us": timings[len(timings) // 2] * 1e6,
+        "p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--tokens', type=int, default=50, help='Distinct tokens in use')
+    args = parser.parse_args()
+
+    auth.SECRET_KEY = os.environ['SECRET_KEY']
+    tokens = [auth.create_token(f'user{i}@example.com', ['sales']) for i in range(args.tokens)]
+
+    # A cache that can't hold anything verifies every token, like before
+    auth._token_cache = cache.TTLCache(maxsize=0)
+    uncached = run(tokens, args.requests)
+
+    auth._token_cache = cache.TTLCache(maxsize=auth.AUTH_CACHE_MAX_ENTRIES, ttl=auth.AUTH_CACHE_TTL)
+    cached = run(tokens, args.requests)
+
+    print(f'{args.requests} requests, {args.tokens} distinct tokens')
+    print(f'{"":10} {"mean":>10} {"p50":>10} {"p99":>10}')
+    for name, result in (('uncached', uncached), ('cached', cached)):
+        print(f'{name:10} {result["mean_us"]:>8.1f}us {result["p50_us"]:>8.1f}us {result["p99_us"]:>8.1f}us')
+    print(f'speedup    {uncached["mean_us"] / cached["mean_us"]:.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Database queries and latency of a burst of identical reads, with and
+without coalescing.
+
+    python benchmarks/bench_coalescing.py [--rows 50000] [--callers 32] [--bursts 20]
+
+Seeds a temporary database with synthetic subscriptions, then sends bursts
+of --callers concurrent requests for the same data through the app, each
+caller from its own thread with its own token, like a dashboard refresh
+by many users. The cache is cleared before every burst, as a write does.
+For GET /subscriptions/current and GET /subscriptions/<id> it reports the
+database queries per burst (db spans from metrics.py) and the p50/p99/max
+latency of the requests, with CACHE_COALESCE off and on.
+
+One caller of every burst has a token without the required role and must
+be refused, so authorization stays per caller when results are shared.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+WORKDIR = tempfile.mkdtemp(prefix='bench-coalescing-')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'bench.db')
+os.environ['OUTBOX_ENABLED'] = 'false'
+os.environ['AVAILABILITY_JOB_ENABLED'] = 'false'
+
+import app
+import auth
+import cache
+import db
+import metrics
+import subscription
+
+LOCATIONS = ['Copenhagen', 'Aarhus', 'Odense', 'Aalborg', 'Esbjerg', None]
+
+def seed(rows):
+    random.seed(42)
+    today = date.today()
+    app.init_schema()
+    with db.connection() as conn:
+        batch = []
+        for i in range(rows):
+            start = today - timedelta(days=random.randint(0, 1500))
+            duration = random.choice((3, 6, 12, 24, 36))
+            batch.append((
+                random.randint(1, 20000), start.isoformat(), (start + timedelta(days=duration * 30)).isoformat(),
+                duration, random.randint(0, 60000), random.choice((12000, 18000, 24000)),
+                random.choice((2999, 3999, 4500, 5999, 6500)), random.choice(LOCATIONS), random.random() < 0.5
+            ))
+        conn.executemany(subscription.INSERT_QUERY, batch)
+
+def db_queries(name):
+    entry = metrics.SPAN_SECONDS.snapshot().get(('db', name))
+    return entry[2] if entry else 0
+
+def burst(path, tokens):
+    # Every caller waits at the barrier, so they all ask at the same moment
+    barrier = threading.Barrier(len(tokens))
+    results = [None] * len(tokens)
+
+    def caller(index):
+        client = app.app.test_client()
+        barrier.wait()
+        start = time.perf_counter()
+        response = client.get(path, headers={'Authorization': tokens[index]})
+        results[index] = (time.perf_counter() - start, response.status_code)
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(len(tokens))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--callers', type=int, default=32, help='Concurrent requests per burst')
+    parser.add_argument('--bursts', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'Seeding {args.rows} subscriptions...')
+    seed(args.rows)
+
+    auth.SECRET_KEY = 'bench-coalescing'
+    # A token per caller, like separate users, and one without the admin role
+    tokens = [auth.create_token(f'user{i}@example.com', ['admin']) for i in range(args.callers - 1)]
+    tokens.append(auth.create_token('finance@example.com', ['finance']))
+    cases = [
+        ('GET /subscriptions/current', '/subscriptions/current', 'get_active_subscriptions'),
+        ('GET /subscriptions/<id>', f'/subscriptions/{args.rows // 2}', 'get_subscription_by_id'),
+    ]
+
+    print(f'\n{args.bursts} bursts of {args.callers} concurrent requests, cache cleared before each')
+    print(f'{"":40} {"queries/burst":>14} {"p50":>10} {"p99":>10} {"max":>10}')
+    failed = False
+    for name, path, span in cases:
+        for coalesce in (False, True):
+            cache.CACHE_COALESCE = coalesce
+            burst(path, tokens)
+            queries = db_queries(span)
+            latencies = []
+            for _ in range(args.bursts):
+                subscription.clear_cache()
+                results = burst(path, tokens)
+                latencies += [latency for latency, _ in results]
+                statuses = [status for _, status in results]
+                if statuses[:-1] != [200] * (args.callers - 1) or statuses[-1] != 403:
+                    failed = True
+            queries = (db_queries(span) - queries) / args.bursts
+            label = f'{name}, coalescing {"on" if coalesce else "off"}'
+            print(f'{label:40} {queries:>14.1f} '
+                  f'{percentile(latencies, 0.5) * 1000:>8.2f}ms {percentile(latencies, 0.99) * 1000:>8.2f}ms '
+                  f'{max(latencies) * 1000:>8.2f}ms')
+
+    if failed:
+        print('FAILED: a caller got a status other than 200, or the caller without the role was not refused')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    finally:
+        shutil.rmtree(WORKDIR)
@@ -0,0 +1,179 @@
+"""Columnar (NumPy) reports against the row-dict approach.
+
+    python benchmarks/bench_columnar.py [--rows 1000000]
+
+Seeds a temporary database with synthetic subscriptions and times, for
+each report, loading the data and computing the report from the list of
+dicts returned by subscription.get_subscriptions() versus from
+columnar.ColumnStore. Both must give the same result. Also times an
+incremental refresh after a few hundred writes against a full reload.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+WORKDIR = tempfile.mkdtemp(prefix='bench-columnar-')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'bench.db')
+
+import db
+import subscription
+import columnar
+
+LOCATIONS = ['Copenhagen', 'Aarhus', 'Odense', 'Aalborg', 'Esbjerg', None]
+
+def seed(rows):
+    # The aggregate and change log triggers are dropped while seeding, they
+    # are not what is measured here and would make seeding a lot slower
+    random.seed(42)
+    epoch = date(2019, 1, 1)
+    subscription.create_table()
+    with db.connection() as conn:
+        triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+        for trigger in triggers:
+            conn.execute(f'DROP TRIGGER {trigger["name"]}')
+
+        batch = []
+        for i in range(rows):
+            start = epoch + timedelta(days=random.randint(0, 2500))
+            duration = random.choice((3, 6, 12, 24, 36))
+            end = start + timedelta(days=duration * 30)
+            batch.append((
+                random.randint(1, 20000), start.isoformat(), end.isoformat(), duration,
+                random.randint(0, 60000), random.choice((12000, 18000, 24000)),
+                random.choice((2999, 3999, 4500, 5999, 6500)), random.choice(LOCATIONS), random.random() < 0.5
+            ))
+            if len(batch) == 100000:
+                conn.executemany(subscription.INSERT_QUERY, batch)
+                batch = []
+        conn.executemany(subscription.INSERT_QUERY, batch)
+
+        for trigger in triggers:
+            conn.execute(trigger['sql'])
+
+# ----------------------------------------------------- Row-dict reports
+def _days(value):
+    return date.fromisoformat(value).toordinal() - date(1970, 1, 1).toordinal()
+
+def _month_index(day):
+    d = date(1970, 1, 1) + timedelta(days=day)
+    return (d.year - 1970) * 12 + d.month - 1
+
+def rows_utilization(rows, first, last):
+    periods = [(_days(r['subscription_start_date']), _days(r['subscription_end_date']) + 1, r['car_id']) for r in rows]
+    fleet = len({car for _, _, car in periods})
+    months = []
+    for index in range(first, last + 1):
+        month_start, month_end = columnar._month_start_day(index), columnar._month_start_day(index + 1)
+        car_days = 0
+        active = 0
+        for start, end, _ in periods:
+            overlap = min(end, month_end) - max(start, month_start)
+            if overlap > 0:
+                car_days += overlap
+                active += 1
+        months.append({
+            "month": columnar._month_name(index),
+            "active_subscriptions": active,
+            "subscribed_car_days": car_days,
+            "utilization": round(car_days / (fleet * (month_end - month_start)), 4),
+        })
+    return [200, {"fleet_cars": fleet, "months": months}]
+
+def rows_revenue_projection(rows, first, months):
+    revenue = [0] * months
+    billed = [0] * months
+    for r in rows:
+        start = _month_index(_days(r['subscription_start_date'])) - first
+        for i in range(max(start, 0), min(start + max(r['subscription_duration_months'], 1), months)):
+            revenue[i] += r['monthly_subscription_price']
+            billed[i] += 1
+    return [200, [
+        {"month": columnar._month_name(first + i), "revenue": revenue[i], "subscriptions": billed[i]}
+        for i in range(months)
+    ]]
+
+def rows_overage(rows):
+    overage = sorted(r['km_driven_during_subscription'] - r['contracted_km'] for r in rows)
+    over = [o for o in overage if o > 0]
+    return {"over_contracted": len(over), "total_overage_km": sum(over), "max": overage[-1]}
+
+# ----------------------------------------------------- Benchmark
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--writes', type=int, default=500, help='Writes before the incremental refresh')
+    args = parser.parse_args()
+
+    print(f'Seeding {args.rows} subscriptions...')
+    seed(args.rows)
+    first, last = columnar._month_index('2022-01'), columnar._month_index('2022-12')
+
+    # The reports read every row as a dict, so the dicts are made up front
+    rows, rows_load = timed(lambda: list(subscription.get_subscriptions()[1]))
+    tracemalloc.start()
+    loaded = list(subscription.get_subscriptions()[1])
+    rows_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del loaded
+
+    store = columnar.ColumnStore(refresh_interval=0)
+    snapshot, columnar_load = timed(store.refresh)
+
+    reports = [
+        ('utilization 12 months',
+         lambda: rows_utilization(rows, first, last),
+         lambda: columnar.utilization('2022-01', '2022-12', snapshot)),
+        ('revenue projection 24 months',
+         lambda: rows_revenue_projection(rows, first, 24),
+         lambda: columnar.revenue_projection(24, '2022-01', snapshot)),
+        ('overage distribution',
+         lambda: rows_overage(rows),
+         lambda: columnar.overage_distribution(10, None, snapshot)),
+    ]
+
+    print(f'\n{"":32} {"row dicts":>12} {"columnar":>12} {"speedup":>9}')
+    print(f'{"load":32} {rows_load:>11.2f}s {columnar_load:>11.2f}s {rows_load / columnar_load:>8.1f}x')
+    print(f'{"memory":32} {rows_memory / 2**20:>10.0f}MB {snapshot.nbytes / 2**20:>10.0f}MB {rows_memory / snapshot.nbytes:>8.1f}x')
+
+    for name, rows_report, columnar_report in reports:
+        expected, rows_seconds = timed(rows_report)
+        result, columnar_seconds = timed(columnar_report)
+        if name == 'overage distribution':
+            result = result[1]
+            same = (result["over_contracted"], result["total_overage_km"]) == (expected["over_contracted"], expected["total_overage_km"])
+        else:
+            same = expected == result
+        print(f'{name:32} {rows_seconds:>11.3f}s {columnar_seconds:>11.3f}s {rows_seconds / columnar_seconds:>8.1f}x'
+              f'{"" if same else "  RESULTS DIFFER"}')
+
+    ids = [row['subscription_id'] for row in random.sample(rows, args.writes)]
+    for id in ids[:args.writes // 2]:
+        subscription.update_subscription(id, {"monthly_subscription_price": 1})
+    for id in ids[args.writes // 2:]:
+        subscription.delete_item_by_id(id)
+    for _ in range(args.writes // 2):
+        subscription.add_subscription({"car_id": 1, "subscription_start_date": "2022-01-01", "subscription_end_date": "2022-12-31"})
+
+    refreshed, incremental = timed(store.refresh)
+    reloaded, full = timed(columnar.ColumnStore().refresh)
+    same = all((refreshed[name] == reloaded[name]).all() for name in columnar.COLUMNS if name != 'location')
+    print(f'\nAfter {args.writes + args.writes // 2} writes: incremental refresh {incremental * 1000:.0f}ms, '
+          f'full reload {full * 1000:.0f}ms{"" if same else "  SNAPSHOTS DIFFER"}')
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKDIR)
@@ -0,0 +1,129 @@
+"""CPU cost of encoding list responses, per 10k rows.
+
+    python benchmarks/bench_serialization.py [--rows 10000] [--repeat 20]
+
+Seeds a temporary database with synthetic subscriptions, then measures
+the CPU time (time.process_time) of fetching them and building the body
+of GET /subscriptions:
+
+  - jsonify on row dicts: sqlite3.Row rows turned into dicts and encoded
+    by Flask's default JSON provider (the path before serialization.py)
+  - template: tuples formatted into the stdlib template of serialization.py
+  - orjson: tuples encoded by orjson, if it is installed
+
+and the cost of compressing the body with gzip, and brotli if installed.
+Every encoder must produce the same JSON.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+WORKDIR = tempfile.mkdtemp(prefix='bench-serialization-')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'bench.db')
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import db
+import subscription
+import serialization
+
+LOCATIONS = ['Copenhagen', 'Aarhus', 'Odense', 'Aalborg', 'Esbjerg', 'København', None]
+
+def seed(rows):
+    random.seed(42)
+    epoch = date(2019, 1, 1)
+    subscription.create_table()
+    with db.connection() as conn:
+        batch = []
+        for i in range(rows):
+            start = epoch + timedelta(days=random.randint(0, 2500))
+            duration = random.choice((3, 6, 12, 24, 36))
+            batch.append((
+                random.randint(1, 20000), start.isoformat(), (start + timedelta(days=duration * 30)).isoformat(),
+                duration, random.randint(0, 60000), random.choice((12000, 18000, 24000)),
+                random.choice((2999, 3999.5, 4500, 5999, 6500)), random.choice(LOCATIONS), random.random() < 0.5
+            ))
+        conn.executemany(subscription.INSERT_QUERY, batch)
+
+def cpu(f, repeat):
+    # Best of `repeat` runs, in seconds of CPU time
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        result = f()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def fetch(row_factory):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.row_factory = row_factory
+        cur.execute(f'SELECT {", ".join(subscription.COLUMNS)} FROM {subscription.TABLE_NAME}')
+        return cur.fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per case, the fastest counts')
+    args = parser.parse_args()
+
+    print(f'Seeding {args.rows} subscriptions...')
+    seed(args.rows)
+    scale = 10000 / args.rows
+
+    flask_app = Flask(__name__)
+    flask_json = DefaultJSONProvider(flask_app)
+
+    def jsonify_dicts():
+        rows = [dict(row) for row in fetch(db.sqlite3.Row)]
+        with flask_app.app_context():
+            return flask_json.response(rows).get_data()
+
+    def encoded(encoder):
+        def run():
+            serialization.ENCODER = encoder
+            return serialization.dumps(db.RowSet(subscription.COLUMNS, fetch(None))) + b'\n'
+        return run
+
+    cases = [('jsonify on row dicts', jsonify_dicts), ('template', encoded('stdlib'))]
+    if serialization.orjson is not None:
+        cases.append(('orjson', encoded('orjson')))
+
+    fetch_ms = cpu(lambda: fetch(None), args.repeat)[1] * 1000 * scale
+    print(f'\nCPU per 10k rows{"":24} {"total ms":>10} {"encode ms":>10} {"speedup":>9}')
+    print(f'{"fetch tuples only":40} {fetch_ms:>10.1f}')
+
+    expected = baseline = None
+    for name, case in cases:
+        body, seconds = cpu(case, args.repeat)
+        total_ms = seconds * 1000 * scale
+        if expected is None:
+            expected, baseline = body, total_ms - fetch_ms
+        same = json.loads(body) == json.loads(expected)
+        print(f'{name:40} {total_ms:>10.1f} {total_ms - fetch_ms:>10.1f} '
+              f'{baseline / (total_ms - fetch_ms):>8.1f}x{"" if same else "  OUTPUT DIFFERS"}')
+
+    encodings = [('gzip', level) for level in (1, 6, 9)]
+    if serialization.brotli is not None:
+        encodings += [('br', quality) for quality in (1, 4, 11)]
+
+    print(f'\nCompressing {len(expected) / 2**20:.1f}MB{"":23} {"ms":>10} {"ratio":>10}')
+    for encoding, level in encodings:
+        setting = 'GZIP_LEVEL' if encoding == 'gzip' else 'BROTLI_QUALITY'
+        setattr(serialization, setting, level)
+        compressed, seconds = cpu(lambda: serialization.compress_bytes(expected, encoding), args.repeat)
+        print(f'{f"{encoding}, {setting}={level}":40} {seconds * 1000 * scale:>10.1f} {len(expected) / len(compressed):>9.1f}x')
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKDIR)
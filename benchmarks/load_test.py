@@ -0,0 +1,143 @@
+"""Throughput of the gunicorn server as the number of workers grows.
+
+    python benchmarks/load_test.py [--workers 1,2,4] [--path /subscriptions?limit=50]
+
+For every worker count a fresh gunicorn is started on a seeded copy of the
+database and loaded by several client processes over keep-alive
+connections for a fixed duration. Reports requests per second and latency
+percentiles for each run.
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+SECRET_KEY = 'load-test-secret'
+
+def seed(path, rows):
+    env = dict(os.environ, DB_PATH=path)
+    script = (
+        'import db, subscription\n'
+        'subscription.create_table()\n'
+        f'rows = [(i % 500, "2024-01-01", "2026-12-31", 3, 1000, 1500, 4999, "Aarhus", False) for i in range({rows})]\n'
+        'with db.connection() as conn:\n'
+        '    conn.executemany(subscription.INSERT_QUERY, rows)\n'
+    )
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True)
+
+def start_server(db_path, port, workers, threads, **extra_env):
+    env = dict(
+        os.environ,
+        DB_PATH=db_path,
+        PORT=str(port),
+        SECRET_KEY=SECRET_KEY,
+        WEB_CONCURRENCY=str(workers),
+        GUNICORN_THREADS=str(threads),
+        OUTBOX_ENABLED='false',
+        AVAILABILITY_JOB_ENABLED='false',
+        **extra_env
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('gunicorn did not start')
+
+def stop_server(server):
+    # The same SIGTERM a container stop sends; workers drain and exit
+    server.send_signal(signal.SIGTERM)
+    server.wait(timeout=60)
+
+def client(args):
+    port, path, token, duration = args
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {'Authorization': token}
+    latencies = []
+    errors = 0
+    end = time.perf_counter() + duration
+
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies, errors
+
+def run(port, path, token, clients, duration):
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(client, [(port, path, token, duration)] * clients)
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    return {
+        "requests_per_second": len(latencies) / duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "errors": sum(result[1] for result in results),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default=f'1,2,{os.cpu_count()}', help='Comma separated worker counts')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker')
+    parser.add_argument('--clients', type=int, default=os.cpu_count() * 2, help='Concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per run')
+    parser.add_argument('--rows', type=int, default=10000, help='Subscriptions in the seeded database')
+    parser.add_argument('--path', default='/subscriptions?limit=50')
+    parser.add_argument('--port', type=int, default=5080)
+    args = parser.parse_args()
+
+    os.environ['SECRET_KEY'] = SECRET_KEY
+    import auth
+    auth.SECRET_KEY = SECRET_KEY
+    token = auth.create_token('load-test@example.com', ['admin'])
+
+    workdir = tempfile.mkdtemp(prefix='load-test-')
+    try:
+        seeded = os.path.join(workdir, 'seed.db')
+        seed(seeded, args.rows)
+
+        print(f'GET {args.path}, {args.clients} clients, {args.duration:g}s per run, {args.threads} threads per worker')
+        print(f'{"workers":>8} {"req/s":>10} {"p50":>10} {"p99":>10} {"errors":>8}')
+        for workers in (int(w) for w in args.workers.split(',')):
+            db_path = os.path.join(workdir, f'workers-{workers}.db')
+            shutil.copy(seeded, db_path)
+            server = start_server(db_path, args.port, workers, args.threads)
+            try:
+                result = run(args.port, args.path, token, args.clients, args.duration)
+            finally:
+                stop_server(server)
+            print(f'{workers:>8} {result["requests_per_second"]:>10.0f} {result["p50_ms"]:>8.2f}ms '
+                  f'{result["p99_ms"]:>8.2f}ms {result["errors"]:>8}')
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""Replication lag, convergence and the staleness bound of read replicas.
+
+    python benchmarks/replication_lag.py [--replicas 2] [--writes 100] [--rows 10000]
+
+Starts a primary and --replicas replicas as separate gunicorn servers, each
+on its own database file, seeds the primary and waits for the replicas'
+first copy. Then:
+
+- lag: subscriptions are created on the primary one at a time and polled
+  for on every replica until they can be read. Reports the time from the
+  primary's response to the row being readable (p50, p99, max)
+- convergence: updates and deletes on the primary, after which every
+  replica must return the same rows and aggregates as the primary
+- writes sent to a replica must be refused with 403
+- staleness bound: with the primary stopped, reads on the replicas must
+  turn into 503 within REPLICATION_MAX_STALENESS (plus a poll), and
+  succeed again once the primary is back
+
+Exits with 1 if any check fails.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from load_test import SECRET_KEY, seed, start_server, stop_server
+
+def request(port, method, path, token, body=None, timeout=30):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    headers = {'Authorization': token}
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+        body = json.dumps(body)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.getheaders(), response.read()
+    finally:
+        conn.close()
+
+def replication_stats(port, token):
+    status, _, body = request(port, 'GET', '/health', token)
+    return json.loads(body)['replication'] if status == 200 else None
+
+def wait_caught_up(primary, replicas, token, timeout=120):
+    # Until every replica has applied the primary's last seq
+    seq = replication_stats(primary, token)['seq']
+    deadline = time.time() + timeout
+    pending = set(replicas)
+    while pending and time.time() < deadline:
+        for port in list(pending):
+            stats = replication_stats(port, token)
+            if stats and stats['applied_seq'] is not None and stats['applied_seq'] >= seq and stats['staleness_seconds'] is not None:
+                pending.discard(port)
+        time.sleep(0.05)
+    return not pending
+
+def wait_visible(port, token, id, interval, timeout):
+    # Seconds until GET /subscriptions/<id> succeeds on the replica
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        while time.perf_counter() - start < timeout:
+            conn.request('GET', f'/subscriptions/{id}', headers={'Authorization': token})
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                return time.perf_counter() - start
+            time.sleep(interval)
+    finally:
+        conn.close()
+    return None
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def new_subscription(rng, car_id):
+    return {
+        "car_id": car_id,
+        "subscription_start_date": "2026-01-01",
+        "subscription_end_date": "2026-07-01",
+        "subscription_duration_months": 6,
+        "km_driven_during_subscription": rng.randint(0, 20000),
+        "contracted_km": 12000,
+        "monthly_subscription_price": rng.choice((2999, 3999, 4999)),
+        "delivery_location": rng.choice(('Aarhus', 'Odense', None)),
+        "has_delivery_insurance": rng.random() < 0.5,
+    }
+
+def measure_lag(primary, replicas, token, writes, spacing, interval, timeout):
+    rng = random.Random(1)
+    lags = {port: [] for port in replicas}
+    missing = 0
+
+    with ThreadPoolExecutor(len(replicas)) as executor:
+        for i in range(writes):
+            # A random pause, so writes don't line up with the replicas' polls
+            time.sleep(rng.uniform(0, spacing))
+            status, _, body = request(primary, 'POST', '/subscriptions/batch', token,
+                                      [{"op": "create", "data": new_subscription(rng, 20_000_000 + i)}])
+            id = json.loads(body)['results'][0]['result'].get('subscription_id') if status == 200 else None
+            if id is None:
+                missing += 1
+                continue
+
+            results = executor.map(lambda port: (port, wait_visible(port, token, id, interval, timeout)), replicas)
+            for port, lag in results:
+                if lag is None:
+                    missing += 1
+                else:
+                    lags[port].append(lag)
+
+    return lags, missing
+
+def converge(primary, replicas, token, rows):
+    rng = random.Random(2)
+    operations = (
+        [{"op": "update", "id": rng.randint(1, rows), "data": {"monthly_subscription_price": rng.randint(2000, 7000)}}
+         for _ in range(200)]
+        + [{"op": "delete", "id": id} for id in rng.sample(range(1, rows + 1), 50)]
+    )
+    status, _, _ = request(primary, 'POST', '/subscriptions/batch', token, operations)
+    if status not in (200, 207):
+        return [f'batch on the primary failed with {status}']
+
+    if not wait_caught_up(primary, replicas, token):
+        return ['replicas did not catch up']
+
+    failures = []
+    for path in ('/subscriptions?stream=ndjson', '/analytics/revenue/monthly', '/analytics/km-overage'):
+        expected = request(primary, 'GET', path, token)[2]
+        for port in replicas:
+            if request(port, 'GET', path, token)[2] != expected:
+                failures.append(f'replica on {port} differs from the primary on GET {path}')
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=10000, help='Subscriptions seeded on the primary')
+    parser.add_argument('--writes', type=int, default=100, help='Writes whose lag is measured')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers per server')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='REPLICATION_POLL_INTERVAL of the replicas')
+    parser.add_argument('--max-staleness', type=float, default=3, help='REPLICATION_MAX_STALENESS of the replicas')
+    parser.add_argument('--port', type=int, default=5090, help='Port of the primary, replicas use the next ones')
+    args = parser.parse_args()
+
+    os.environ['SECRET_KEY'] = SECRET_KEY
+    import auth
+    auth.SECRET_KEY = SECRET_KEY
+    token = auth.create_token('replication-test@example.com', ['admin'])
+
+    workdir = tempfile.mkdtemp(prefix='replication-')
+    primary_db = os.path.join(workdir, 'primary.db')
+    primary_port = args.port
+    replica_ports = [args.port + 1 + i for i in range(args.replicas)]
+    replica_env = dict(
+        REPLICATION_ROLE='replica',
+        REPLICATION_PRIMARY_URL=f'http://127.0.0.1:{primary_port}',
+        REPLICATION_POLL_INTERVAL=str(args.poll_interval),
+        REPLICATION_MAX_STALENESS=str(args.max_staleness),
+    )
+    servers = []
+    failures = []
+
+    try:
+        seed(primary_db, args.rows)
+        primary = start_server(primary_db, primary_port, args.workers, 4)
+        servers.append(primary)
+
+        start = time.perf_counter()
+        for i, port in enumerate(replica_ports):
+            servers.append(start_server(os.path.join(workdir, f'replica-{i}.db'), port, args.workers, 4, **replica_env))
+        if not wait_caught_up(primary_port, replica_ports, token):
+            raise RuntimeError('The replicas did not make their first copy')
+        print(f'{args.replicas} replicas copied {args.rows} subscriptions in {time.perf_counter() - start:.2f}s')
+
+        # ----- Lag
+        lags, missing = measure_lag(
+            primary_port, replica_ports, token, args.writes, args.poll_interval, 0.002, args.max_staleness * 4
+        )
+        print(f'\nLag from a write on the primary to a read on the replica, {args.writes} writes, '
+              f'REPLICATION_POLL_INTERVAL={args.poll_interval:g}')
+        print(f'{"replica":>10} {"p50":>10} {"p99":>10} {"max":>10}')
+        for port, values in lags.items():
+            if values:
+                print(f'{port:>10} {percentile(values, 0.5) * 1000:>8.1f}ms {percentile(values, 0.99) * 1000:>8.1f}ms '
+                      f'{max(values) * 1000:>8.1f}ms')
+        if missing:
+            failures.append(f'{missing} writes never showed up on a replica')
+
+        # ----- Convergence
+        converge_failures = converge(primary_port, replica_ports, token, args.rows)
+        failures += converge_failures
+        print(f'\nConvergence after updates and deletes: {"failed" if converge_failures else "ok"}')
+
+        # ----- Writes to a replica
+        status = request(replica_ports[0], 'POST', '/subscriptions', token, new_subscription(random.Random(3), 1))[0]
+        if status != 403:
+            failures.append(f'a write to a replica returned {status}, not 403')
+        print(f'Write to a replica: {status}')
+
+        # ----- Staleness bound
+        status, headers, _ = request(replica_ports[0], 'GET', '/subscriptions/1', token)
+        staleness = dict(headers).get('X-Replica-Staleness')
+        print(f'X-Replica-Staleness while the primary is up: {staleness}')
+        if staleness is None:
+            failures.append('a replica read has no X-Replica-Staleness header')
+
+        stop_server(primary)
+        servers.remove(primary)
+        stopped = time.perf_counter()
+        refused_after = None
+        while time.perf_counter() - stopped < args.max_staleness + args.poll_interval + 5:
+            if request(replica_ports[0], 'GET', '/subscriptions/1', token)[0] == 503:
+                refused_after = time.perf_counter() - stopped
+                break
+            time.sleep(0.05)
+        print(f'Primary stopped, replica reads refused after: '
+              f'{f"{refused_after:.2f}s" if refused_after is not None else "never"} (max staleness {args.max_staleness:g}s)')
+        if refused_after is None or refused_after > args.max_staleness + args.poll_interval + 1:
+            failures.append('stale reads were served past REPLICATION_MAX_STALENESS')
+
+        primary = start_server(primary_db, primary_port, args.workers, 4)
+        servers.append(primary)
+        restarted = time.perf_counter()
+        recovered_after = None
+        while time.perf_counter() - restarted < 30:
+            if request(replica_ports[0], 'GET', '/subscriptions/1', token)[0] == 200:
+                recovered_after = time.perf_counter() - restarted
+                break
+            time.sleep(0.05)
+        print(f'Primary restarted, replica reads served again after: '
+              f'{f"{recovered_after:.2f}s" if recovered_after is not None else "never"}')
+        if recovered_after is None:
+            failures.append('the replica did not recover after the primary restarted')
+
+    finally:
+        for server in servers:
+            stop_server(server)
+        shutil.rmtree(workdir)
+
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,639 @@
+"""Benchmark and load-test suite for the subscription service.
+
+    python benchmarks/suite.py [--rows 10k,1M] [--save-baseline]
+
+For every database size a synthetic database is seeded (the same data for
+the same size every time) and then:
+
+- every public function of subscription.py is called repeatedly in a
+  separate process, for --budget seconds or --max-iterations calls
+- every route of app.py is loaded over HTTP for --duration seconds by
+  --clients client processes, against gunicorn with a stub admin gateway
+  (stub_gateway.py)
+- a fresh process imports the app, creates the schema and serves its
+  first request and the OpenAPI spec, --startup-runs times, both with the
+  prebuilt spec and with flasgger building it from the YAML files
+
+p50/p99 latency, throughput and RSS are reported for each. The results are
+compared with --baseline if it exists, and the suite exits with 1 if any
+of them got worse by more than --tolerance. --save-baseline stores the
+results as the new baseline instead. Baselines are only comparable on the
+same machine and with the same options.
+
+Seeded databases are kept in --data-dir when it is given, so large sizes
+are only seeded once.
+"""
+import argparse
+import http.client
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from load_test import SECRET_KEY, start_server, stop_server
+
+LOCATIONS = ['Copenhagen', 'Aarhus', 'Odense', 'Aalborg', 'Esbjerg', None]
+SUBSCRIPTIONS_PER_CAR = 20
+# Cars created by the benchmarks are numbered from here, so they never
+# collide with the seeded ones
+NEW_CARS = 10_000_000
+MIN_ITERATIONS = 3
+
+def _size(value):
+    multiplier = {'k': 1_000, 'M': 1_000_000}.get(value[-1], 1)
+    return int(float(value.rstrip('kM')) * multiplier)
+
+def _in_child(db_path, function, *args):
+    # The database path is read when db.py is imported, so code that
+    # imports it runs in a fresh process for every database
+    os.environ['DB_PATH'] = db_path
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, args)
+
+def _rss_mb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as file:
+                total += next(int(line.split()[1]) for line in file if line.startswith('VmRSS:'))
+        except (OSError, StopIteration):
+            pass
+    return round(total / 1024, 1)
+
+def _process_tree(pid):
+    # The gunicorn master and its workers
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                if int(file.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            pass
+    return pids
+
+def _summary(timings, elapsed, errors=0):
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "errors": errors,
+        "p50_ms": round(timings[len(timings) // 2] * 1000, 4),
+        "p99_ms": round(timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1000, 4),
+        "throughput": round(len(timings) / elapsed, 1),
+    }
+
+# ----------------------------------------------------- Seeding
+def seed(rows):
+    # Every car has a run of consecutive, non-overlapping subscriptions
+    # going back from around today, the latest of which is mostly active.
+    # The triggers are dropped while inserting and the aggregates rebuilt
+    # afterwards, which is a lot faster for large sizes
+    import db
+    import subscription
+    import analytics
+
+    rng = random.Random(rows)
+    today = date.today()
+    fleet = max(rows // SUBSCRIPTIONS_PER_CAR, 1)
+
+    subscription.create_table()
+    with db.connection() as conn:
+        triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+        for trigger in triggers:
+            conn.execute(f'DROP TRIGGER {trigger["name"]}')
+
+        batch = []
+        for car_id in range(1, fleet + 1):
+            count = SUBSCRIPTIONS_PER_CAR if car_id < fleet else rows - (fleet - 1) * SUBSCRIPTIONS_PER_CAR
+            end = today + timedelta(days=rng.randint(-30, 300))
+            for _ in range(count):
+                duration = rng.choice((3, 6, 12, 24, 36))
+                start = end - timedelta(days=duration * 30)
+                contracted = rng.choice((12000, 18000, 24000)) * duration // 12
+                batch.append((
+                    car_id, start.isoformat(), end.isoformat(), duration, rng.randint(0, contracted * 2),
+                    contracted, rng.choice((2999, 3999, 4500, 5999, 6500)), rng.choice(LOCATIONS), rng.random() < 0.5
+                ))
+                end = start - timedelta(days=rng.randint(1, 60))
+
+                if len(batch) == 100000:
+                    conn.executemany(subscription.INSERT_QUERY, batch)
+                    batch = []
+        conn.executemany(subscription.INSERT_QUERY, batch)
+
+        for trigger in triggers:
+            conn.execute(trigger['sql'])
+
+    analytics.reconcile_aggregates(rebuild=True)
+    db.close_idle()
+
+def seeded_database(data_dir, rows):
+    path = os.path.join(data_dir, f'seed-{rows}.db')
+    if not os.path.exists(path):
+        print(f'Seeding {rows} subscriptions...', flush=True)
+        start = time.perf_counter()
+        partial = f'{path}.{uuid.uuid4().hex}'
+        _in_child(partial, seed, rows)
+        os.replace(partial, path)
+        print(f'Seeded in {time.perf_counter() - start:.1f}s', flush=True)
+    return path
+
+def _copy_database(source, target):
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    shutil.copy(source, target)
+    return target
+
+# ----------------------------------------------------- Microbenchmarks
+def micro_cases(rows):
+    # (function name, variant, callable). Reads come first and deletes
+    # last, so reads never run into deleted rows
+    import db
+    import subscription
+
+    rng = random.Random(1)
+    fleet = max(rows // SUBSCRIPTIONS_PER_CAR, 1)
+    today = date.today().isoformat()
+    new_cars = itertools.count(NEW_CARS)
+    doomed = itertools.count(rows, -1)
+
+    def random_id():
+        return rng.randint(1, rows)
+
+    def new_subscription():
+        return {
+            "car_id": next(new_cars), "subscription_start_date": today,
+            "subscription_end_date": (date.today() + timedelta(days=365)).isoformat(),
+            "subscription_duration_months": 12, "km_driven_during_subscription": 0, "contracted_km": 18000,
+            "monthly_subscription_price": 4500, "delivery_location": "Aarhus", "has_delivery_insurance": True,
+        }
+
+    def uncached(function, *args):
+        def call():
+            subscription.clear_cache()
+            return function(*args)
+        return call
+
+    def in_transaction(function):
+        def call():
+            with db.connection() as conn:
+                return function(conn.cursor())
+        return call
+
+    def first_rows(count):
+        def call():
+            stream = subscription.iter_subscriptions(rng.randint(0, max(rows - count, 0)))
+            for _ in itertools.islice(stream, count):
+                pass
+            stream.close()
+        return call
+
+    def first_batch():
+        batches = subscription.iter_subscription_batches(rng.randint(0, max(rows - subscription.STREAM_BATCH_SIZE, 0)))
+        next(batches, None)
+        batches.close()
+
+    return [
+        ('get_subscriptions', 'car_id filter', lambda: subscription.get_subscriptions(filters={'car_id': rng.randint(1, fleet)})),
+        ('get_subscriptions', 'active_on filter, price sort',
+         lambda: subscription.get_subscriptions(fields=['subscription_id'], filters={'active_on': today, 'location': 'Aarhus'},
+                                                sort='monthly_subscription_price')),
+        ('get_subscriptions_page', '50 rows', lambda: subscription.get_subscriptions_page(random_id(), 50)),
+        ('iter_subscriptions', '1000 rows', first_rows(1000)),
+        ('iter_subscription_batches', 'first batch', first_batch),
+        ('get_subscription_by_id', 'cached', lambda: subscription.get_subscription_by_id(1)),
+        ('get_subscription_by_id', 'uncached', lambda: uncached(subscription.get_subscription_by_id, random_id())()),
+        ('get_active_subscriptions', 'cached', subscription.get_active_subscriptions),
+        ('get_active_subscriptions', 'uncached', uncached(subscription.get_active_subscriptions)),
+        ('get_active_subscriptions_total_price', 'cached', subscription.get_active_subscriptions_total_price),
+        ('get_active_subscriptions_total_price', 'uncached', uncached(subscription.get_active_subscriptions_total_price)),
+        ('car_is_available', '', in_transaction(lambda cur: subscription.car_is_available(cur, rng.randint(1, fleet), today))),
+        ('find_booking_conflict', '30 days', in_transaction(lambda cur: subscription.find_booking_conflict(
+            cur, rng.randint(1, fleet), today, (date.today() + timedelta(days=30)).isoformat()))),
+        ('get_free_windows', 'one year', lambda: subscription.get_free_windows(rng.randint(1, fleet))),
+        ('cache_stats', '', subscription.cache_stats),
+        ('clear_cache', '', subscription.clear_cache),
+        ('check_query_plans', '', subscription.check_query_plans),
+        ('create_table', '', subscription.create_table),
+        ('migrate', '', subscription.migrate),
+        ('prune_change_log', '', lambda: subscription.prune_change_log(7)),
+        ('add_subscription', '', lambda: subscription.add_subscription(new_subscription())),
+        ('update_subscription', 'price', lambda: subscription.update_subscription(random_id(), {"monthly_subscription_price": rng.randint(2000, 7000)})),
+        ('queue_car_availability', '', in_transaction(lambda cur: subscription.queue_car_availability(cur, rng.randint(1, fleet), True))),
+        ('apply_batch', '10 operations', lambda: subscription.apply_batch(
+            [{"op": "create", "data": new_subscription()} for _ in range(5)]
+            + [{"op": "update", "id": random_id(), "data": {"contracted_km": 24000}} for _ in range(4)]
+            + [{"op": "delete", "id": next(doomed)}]
+        )),
+        ('delete_item_by_id', '', lambda: subscription.delete_item_by_id(next(doomed))),
+    ]
+
+def run_micro(rows, budget, max_iterations, only):
+    import resource
+    import subscription
+
+    cases = micro_cases(rows)
+    public = {
+        name for name, function in inspect.getmembers(subscription, inspect.isfunction)
+        if function.__module__ == 'subscription' and not name.startswith('_')
+    }
+    missing = public - {name for name, _, _ in cases}
+    if missing:
+        raise SystemExit(f'No microbenchmark for subscription.{", subscription.".join(sorted(missing))}')
+
+    results = {}
+    for function, variant, call in cases:
+        name = f'{function} ({variant})' if variant else function
+        if only and only not in name:
+            continue
+
+        # One untimed call first, so the cached variants measure cache hits
+        call()
+        timings = []
+        errors = 0
+        deadline = time.perf_counter() + budget
+        while len(timings) < max_iterations and (len(timings) < MIN_ITERATIONS or time.perf_counter() < deadline):
+            start = time.perf_counter()
+            result = call()
+            timings.append(time.perf_counter() - start)
+            if isinstance(result, list) and result and isinstance(result[0], int) and result[0] >= 500:
+                errors += 1
+
+        results[name] = {**_summary(timings, sum(timings), errors), "rss_mb": _rss_mb([os.getpid()])}
+    results["peak"] = {"rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    return results
+
+# ----------------------------------------------------- HTTP load
+def _json(value):
+    return json.dumps(value).encode(), 'application/json'
+
+def _new_subscription(context):
+    start = date.today()
+    return {
+        "car_id": next(context['new_cars']), "subscription_start_date": start.isoformat(),
+        "subscription_end_date": (start + timedelta(days=365)).isoformat(), "subscription_duration_months": 12,
+        "km_driven_during_subscription": 0, "contracted_km": 18000, "monthly_subscription_price": 4500,
+        "delivery_location": "Odense", "has_delivery_insurance": False,
+    }
+
+def _csv_upload(context):
+    boundary = uuid.uuid4().hex
+    start = date.today()
+    end = start + timedelta(days=365)
+    lines = [
+        'SubscriptionId,CarId,SubscriptionStartDate,SubscriptionEndDate,SubscriptionDurationMonths,'
+        'KmDrivenDuringSubscription,ContractedKm,MonthlySubscriptionPrice,DeliveryLocation,HasDeliveryInsurance'
+    ]
+    for i in range(20):
+        lines.append(f'{i},{next(context["new_cars"])},{start:%d/%m/%Y},{end:%d/%m/%Y},12,0,18000,4500,Aalborg,TRUE')
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="bench.csv"\r\n'
+        f'Content-Type: text/csv\r\n\r\n' + '\r\n'.join(lines) + f'\r\n--{boundary}--\r\n'
+    ).encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+def _created_subscription(conn, headers, context):
+    # Untimed: creates the subscription the timed DELETE removes
+    body, content_type = _json([{"op": "create", "data": _new_subscription(context)}])
+    conn.request('POST', '/subscriptions/batch', body=body, headers={**headers, 'Content-Type': content_type})
+    response = conn.getresponse()
+    return {"created": json.loads(response.read())["results"][0]["result"]["subscription_id"]}
+
+# name, route rule, method, path, body, prepare. In paths {id} is a random
+# seeded subscription, {car} a random seeded car and {tail} the id 1000
+# rows before the last one
+SCENARIOS = [
+    ('GET /', '/', 'GET', '/', None, None),
+    ('GET /subscriptions?limit=50', '/subscriptions', 'GET', '/subscriptions?limit=50&after_id={id}', None, None),
+    ('GET /subscriptions?car_id', '/subscriptions', 'GET', '/subscriptions?car_id={car}', None, None),
+    ('GET /subscriptions?stream=ndjson', '/subscriptions', 'GET', '/subscriptions?stream=ndjson&after_id={tail}', None, None),
+    ('GET /subscriptions/<id>', '/subscriptions/<int:id>', 'GET', '/subscriptions/{id}', None, None),
+    ('GET /subscriptions/current', '/subscriptions/current', 'GET', '/subscriptions/current', None, None),
+    ('GET /subscriptions/current/total-price', '/subscriptions/current/total-price', 'GET',
+     '/subscriptions/current/total-price', None, None),
+    ('GET /subscriptions/current/cars', '/subscriptions/current/cars', 'GET', '/subscriptions/current/cars', None, None),
+    ('GET /subscriptions/<id>/car', '/subscriptions/<int:id>/car', 'GET', '/subscriptions/{id}/car', None, None),
+    ('GET /cars/<car_id>/free-windows', '/cars/<int:car_id>/free-windows', 'GET', '/cars/{car}/free-windows', None, None),
+    ('GET /analytics/revenue/monthly', '/analytics/revenue/monthly', 'GET', '/analytics/revenue/monthly', None, None),
+    ('GET /analytics/revenue/locations', '/analytics/revenue/locations', 'GET', '/analytics/revenue/locations', None, None),
+    ('GET /analytics/km-overage', '/analytics/km-overage', 'GET', '/analytics/km-overage', None, None),
+    ('GET /analytics/utilization', '/analytics/utilization', 'GET', '/analytics/utilization', None, None),
+    ('GET /analytics/revenue/projection', '/analytics/revenue/projection', 'GET', '/analytics/revenue/projection', None, None),
+    ('GET /analytics/km-overage/distribution', '/analytics/km-overage/distribution', 'GET',
+     '/analytics/km-overage/distribution', None, None),
+    ('GET /replication/changes', '/replication/changes', 'GET', '/replication/changes?after_seq={tail}', None, None),
+    ('GET /replication/snapshot', '/replication/snapshot', 'GET', '/replication/snapshot?after_id={id}', None, None),
+    ('GET /metrics', '/metrics', 'GET', '/metrics', None, None),
+    ('GET /admin/profiler', '/admin/profiler', 'GET', '/admin/profiler', None, None),
+    ('POST /admin/profiler/stop', '/admin/profiler/<action>', 'POST', '/admin/profiler/stop', None, None),
+    ('GET /health', '/health', 'GET', '/health', None, None),
+    ('POST /subscriptions', '/subscriptions', 'POST', '/subscriptions', lambda c: _json(_new_subscription(c)), None),
+    ('POST /subscriptions/batch', '/subscriptions/batch', 'POST', '/subscriptions/batch',
+     lambda c: _json([{"op": "create", "data": _new_subscription(c)} for _ in range(5)]
+                     + [{"op": "update", "id": c['random_id'](), "data": {"contracted_km": 24000}} for _ in range(5)]), None),
+    ('PATCH /subscriptions/<id>', '/subscriptions/<int:id>', 'PATCH', '/subscriptions/{id}',
+     lambda c: _json({"monthly_subscription_price": c['rng'].randint(2000, 7000)}), None),
+    ('POST /admin/subscriptions/import', '/admin/subscriptions/import', 'POST', '/admin/subscriptions/import', _csv_upload, None),
+    ('DELETE /subscriptions/<id>', '/subscriptions/<int:id>', 'DELETE', '/subscriptions/{created}', None, _created_subscription),
+]
+
+def app_routes():
+    # (rule, method) of every route of the app, without flasgger's own
+    import app
+    return [
+        (rule.rule, method)
+        for rule in app.app.url_map.iter_rules()
+        if rule.endpoint != 'static' and not rule.endpoint.startswith('flasgger.')
+        for method in rule.methods - {'HEAD', 'OPTIONS'}
+    ]
+
+def http_client(args):
+    port, scenario_index, token, duration, rows, client_index = args
+    _, _, method, path, body, prepare = SCENARIOS[scenario_index]
+    rng = random.Random(client_index)
+    fleet = max(rows // SUBSCRIPTIONS_PER_CAR, 1)
+    context = {
+        "rng": rng,
+        "random_id": lambda: rng.randint(1, rows),
+        "new_cars": itertools.count(NEW_CARS + (scenario_index * 1000 + client_index + 1) * 1_000_000),
+    }
+    headers = {'Authorization': token}
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    latencies = []
+    errors = 0
+    end = time.perf_counter() + duration
+
+    while time.perf_counter() < end:
+        try:
+            values = prepare(conn, headers, context) if prepare else {}
+            url = path.format(id=context['random_id'](), car=rng.randint(1, fleet), tail=max(rows - 1000, 0), **values)
+            request_headers = headers
+            payload = None
+            if body:
+                payload, content_type = body(context)
+                request_headers = {**headers, 'Content-Type': content_type}
+
+            start = time.perf_counter()
+            conn.request(method, url, body=payload, headers=request_headers)
+            response = conn.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            if response.status >= 400:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    return latencies, errors
+
+def start_gateway(port, latency_ms):
+    env = dict(os.environ, STUB_PORT=str(port), STUB_LATENCY_MS=str(latency_ms))
+    gateway = subprocess.Popen(
+        [sys.executable, 'stub_gateway.py'], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/stats')
+            conn.getresponse().read()
+            return gateway
+        except OSError:
+            time.sleep(0.2)
+    gateway.kill()
+    raise RuntimeError('The stub gateway did not start')
+
+def run_http(db_path, rows, args, token):
+    routes = set(_in_child(db_path, app_routes))
+    missing = routes - {(rule, method) for _, rule, method, _, _, _ in SCENARIOS}
+    if missing:
+        raise SystemExit('No load test for ' + ', '.join(f'{method} {rule}' for rule, method in sorted(missing)))
+
+    gateway = start_gateway(args.gateway_port, args.gateway_latency_ms)
+    server = start_server(
+        db_path, args.port, args.workers, args.threads,
+        ADMIN_GATEWAY_URL=f'http://127.0.0.1:{args.gateway_port}',
+        ADMIN_EMAIL='benchmark@example.com',
+        ADMIN_PASSWORD='benchmark',
+        GUNICORN_MAX_REQUESTS='0',
+    )
+    results = {}
+    try:
+        for index, (name, *_) in enumerate(SCENARIOS):
+            if args.only and args.only not in name:
+                continue
+            with multiprocessing.Pool(args.clients) as pool:
+                client_results = pool.map(
+                    http_client, [(args.port, index, token, args.duration, rows, i) for i in range(args.clients)]
+                )
+            latencies = [latency for result in client_results for latency in result[0]]
+            if not latencies:
+                results[name] = {"count": 0, "errors": sum(result[1] for result in client_results)}
+                continue
+            errors = sum(result[1] for result in client_results)
+            results[name] = {**_summary(latencies, args.duration, errors), "rss_mb": _rss_mb(_process_tree(server.pid))}
+    finally:
+        stop_server(server)
+        gateway.terminate()
+        gateway.wait()
+    return results
+
+# ----------------------------------------------------- Startup
+STARTUP_SCRIPT = """
+import json, os, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.init_schema()
+schema = time.perf_counter()
+client = app.app.test_client()
+client.get('/subscriptions/1', headers={'Authorization': os.environ['BENCH_TOKEN']})
+first_request = time.perf_counter()
+client.get('/apispec.json')
+spec = time.perf_counter()
+with open('/proc/self/status') as file:
+    rss = next(int(line.split()[1]) for line in file if line.startswith('VmRSS:'))
+print(json.dumps({
+    "import app": imported - start,
+    "init schema": schema - imported,
+    "first request": first_request - schema,
+    "first GET /apispec.json": spec - first_request,
+    "rss_mb": round(rss / 1024, 1),
+}))
+"""
+
+def run_startup(db_path, workdir, runs, token):
+    spec = os.path.join(workdir, 'openapi.json')
+    subprocess.run([sys.executable, 'manage.py', 'build-openapi', '--output', spec],
+                   cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+    results = {}
+    for mode in ('static', 'dynamic'):
+        env = dict(os.environ, DB_PATH=db_path, SWAGGER_MODE=mode, OPENAPI_SPEC=spec, BENCH_TOKEN=token,
+                   OUTBOX_ENABLED='false', AVAILABILITY_JOB_ENABLED='false')
+        phases = {}
+        rss = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=ROOT, env=env,
+                                    check=True, capture_output=True, text=True).stdout
+            timings = json.loads(output.strip().splitlines()[-1])
+            rss.append(timings.pop("rss_mb"))
+            for phase, seconds in timings.items():
+                phases.setdefault(phase, []).append(seconds)
+
+        for phase, timings in phases.items():
+            results[f'{phase} ({mode} spec)'] = {**_summary(timings, sum(timings)), "rss_mb": max(rss)}
+    return results
+
+# ----------------------------------------------------- Baseline
+# Lower is better for latency and memory, higher for throughput
+METRICS = (('p50_ms', 1), ('p99_ms', 1), ('throughput', -1), ('rss_mb', 1))
+
+def compare(results, baseline, tolerance, min_delta_ms, min_delta_mb):
+    regressions = []
+    for size, kinds in results.items():
+        for kind, cases in kinds.items():
+            for name, current in cases.items():
+                previous = baseline.get(size, {}).get(kind, {}).get(name)
+                if not previous:
+                    continue
+                if current.get("errors", 0) > previous.get("errors", 0):
+                    regressions.append(f'{size} {kind} {name}: {current["errors"]} errors, was {previous["errors"]}')
+                for metric, direction in METRICS:
+                    if metric not in current or metric not in previous or not previous[metric]:
+                        continue
+                    # Too few samples for the p99 to mean anything
+                    if metric == 'p99_ms' and min(current["count"], previous["count"]) < 200:
+                        continue
+                    change = (current[metric] - previous[metric]) / previous[metric] * direction
+                    floor = min_delta_mb if metric == 'rss_mb' else min_delta_ms if metric.endswith('_ms') else 0
+                    if change > tolerance and abs(current[metric] - previous[metric]) > floor:
+                        regressions.append(
+                            f'{size} {kind} {name}: {metric} {current[metric]} vs {previous[metric]} ({change:+.0%})'
+                        )
+    return regressions
+
+def print_results(title, results):
+    print(f'\n{title}')
+    print(f'{"":52} {"count":>7} {"errors":>7} {"p50":>11} {"p99":>11} {"per second":>11} {"RSS":>9}')
+    for name, result in results.items():
+        if "p50_ms" not in result:
+            continue
+        print(f'{name:52} {result["count"]:>7} {result["errors"]:>7} {result["p50_ms"]:>9.3f}ms {result["p99_ms"]:>9.3f}ms '
+              f'{result["throughput"]:>11.1f} {result["rss_mb"]:>7.1f}MB')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='10k', help='Comma separated database sizes, e.g. 10k,1M,10M')
+    parser.add_argument('--data-dir', help='Keep seeded databases here and reuse them')
+    parser.add_argument('--budget', type=float, default=2, help='Seconds per microbenchmark')
+    parser.add_argument('--max-iterations', type=int, default=1000, help='Calls per microbenchmark')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds per route')
+    parser.add_argument('--clients', type=int, default=os.cpu_count() * 2, help='Concurrent client processes')
+    parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per gunicorn worker')
+    parser.add_argument('--port', type=int, default=5080)
+    parser.add_argument('--gateway-port', type=int, default=5099)
+    parser.add_argument('--gateway-latency-ms', type=float, default=5, help='Latency added by the stub gateway')
+    parser.add_argument('--only', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--skip-http', action='store_true')
+    parser.add_argument('--startup-runs', type=int, default=5, help='Fresh processes per startup measurement, 0 to skip')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=os.path.join(ROOT, 'benchmarks', 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression (default 0.25)')
+    parser.add_argument('--min-delta-ms', type=float, default=0.1, help='Ignore latency changes below this')
+    parser.add_argument('--min-delta-mb', type=float, default=10, help='Ignore RSS changes below this')
+    args = parser.parse_args()
+
+    os.environ['SECRET_KEY'] = SECRET_KEY
+    import auth
+    auth.SECRET_KEY = SECRET_KEY
+    token = auth.create_token('benchmark@example.com', ['admin'])
+
+    workdir = tempfile.mkdtemp(prefix='bench-suite-')
+    data_dir = args.data_dir or workdir
+    os.makedirs(data_dir, exist_ok=True)
+    results = {}
+    try:
+        for rows in (_size(value) for value in args.rows.split(',')):
+            seeded = seeded_database(data_dir, rows)
+            results[str(rows)] = {}
+
+            if not args.skip_micro:
+                db_path = _copy_database(seeded, os.path.join(workdir, 'micro.db'))
+                micro = _in_child(db_path, run_micro, rows, args.budget, args.max_iterations, args.only)
+                results[str(rows)]["micro"] = micro
+                print_results(f'subscription.py, {rows} subscriptions', micro)
+                print(f'Peak RSS {micro["peak"]["rss_mb"]}MB')
+
+            if args.startup_runs:
+                db_path = _copy_database(seeded, os.path.join(workdir, 'startup.db'))
+                startup = run_startup(db_path, workdir, args.startup_runs, token)
+                results[str(rows)]["startup"] = startup
+                print_results(f'Startup, {args.startup_runs} runs', startup)
+
+            if not args.skip_http:
+                db_path = _copy_database(seeded, os.path.join(workdir, 'http.db'))
+                load = run_http(db_path, rows, args, token)
+                results[str(rows)]["http"] = load
+                print_results(f'HTTP, {rows} subscriptions, {args.clients} clients, {args.workers} workers', load)
+    finally:
+        shutil.rmtree(workdir)
+
+    document = {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "date": date.today().isoformat(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(document, file, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        # Sizes that were not run keep their previous baseline
+        document["results"] = {**baseline.get("results", {}), **results}
+        with open(args.baseline, 'w') as file:
+            json.dump(document, file, indent=2)
+        print(f'\nBaseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline at {args.baseline}, run with --save-baseline to store one')
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline["results"], args.tolerance, args.min_delta_ms, args.min_delta_mb)
+    if regressions:
+        print(f'\n{len(regressions)} regressions against {args.baseline}:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+
+    print(f'\nNo regressions against {args.baseline}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
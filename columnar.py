@@ -0,0 +1,334 @@
+import threading
+import time
+import os
+from datetime import datetime
+from dotenv import load_dotenv
+import db
+from subscription import TABLE_NAME, CHANGES_TABLE
+
+# Load environment variables from .env file
+load_dotenv()
+COLUMNAR_REFRESH_INTERVAL = float(os.getenv('COLUMNAR_REFRESH_INTERVAL', 5))
+COLUMNAR_FULL_RELOAD_RATIO = float(os.getenv('COLUMNAR_FULL_RELOAD_RATIO', 0.2))
+LOAD_BATCH_SIZE = 50000
+# Longest month range a report covers
+MAX_REPORT_MONTHS = 120
+
+# Dates are stored as days since 1970-01-01; missing or invalid ones as
+# NO_DATE, the int32 minimum. NumPy is only imported on the first report
+NO_DATE = -2**31
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+
+# Column -> (dtype, SQL expression reading it)
+COLUMNS = {
+    'subscription_id': ('int64', 'subscription_id'),
+    'car_id': ('int32', 'COALESCE(car_id, 0)'),
+    'start': ('int32', f'COALESCE(CAST(julianday(subscription_start_date) - {UNIX_EPOCH_JULIAN_DAY} AS INTEGER), {NO_DATE})'),
+    'end': ('int32', f'COALESCE(CAST(julianday(subscription_end_date) - {UNIX_EPOCH_JULIAN_DAY} AS INTEGER), {NO_DATE})'),
+    'duration_months': ('int16', 'COALESCE(subscription_duration_months, 0)'),
+    'km_driven': ('int32', 'COALESCE(km_driven_during_subscription, 0)'),
+    'contracted_km': ('int32', 'COALESCE(contracted_km, 0)'),
+    'price': ('int32', 'COALESCE(monthly_subscription_price, 0)'),
+    # Dictionary encoded, see ColumnStore.locations; -1 is no location
+    'location': ('int16', 'delivery_location'),
+    'has_delivery_insurance': ('bool', 'COALESCE(has_delivery_insurance, 0)'),
+}
+SELECT_COLUMNS = ', '.join(expression for _, expression in COLUMNS.values())
+
+class Snapshot:
+    """The subscriptions table as one NumPy array per column, sorted by
+    subscription_id. Never modified; a refresh builds a new one"""
+
+    def __init__(self, columns, locations, seq):
+        self.columns = columns
+        self.locations = locations
+        self.seq = seq
+
+    def __len__(self):
+        return len(self.columns['subscription_id'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+class ColumnStore:
+    """In-memory columnar copy of the subscriptions table for reports.
+
+    Loaded once, then kept up to date from the subscription_changes log:
+    only the rows changed since the last refresh are read again. Falls
+    back to a full reload when the log has been pruned past the last
+    refresh or a large part of the table changed"""
+
+    def __init__(self, refresh_interval=COLUMNAR_REFRESH_INTERVAL, full_reload_ratio=COLUMNAR_FULL_RELOAD_RATIO):
+        self.refresh_interval = refresh_interval
+        self.full_reload_ratio = full_reload_ratio
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._location_codes = {}
+        self._full_loads = 0
+        self._incremental_refreshes = 0
+        self._last_refresh_seconds = None
+
+    # ----------------------------------------------------- Loading
+    def _location_code(self, location):
+        if location is None:
+            return -1
+        code = self._location_codes.get(location)
+        if code is None:
+            code = self._location_codes[location] = len(self._location_codes)
+        return code
+
+    def _read(self, cur, where='', params=()):
+        import numpy as np
+        cur.execute(f'SELECT {SELECT_COLUMNS} FROM {TABLE_NAME} {where} ORDER BY subscription_id', params)
+
+        parts = {name: [] for name in COLUMNS}
+        while True:
+            rows = cur.fetchmany(LOAD_BATCH_SIZE)
+            if not rows:
+                break
+
+            for (name, (dtype, _)), values in zip(COLUMNS.items(), zip(*rows)):
+                if name == 'location':
+                    values = [self._location_code(value) for value in values]
+                parts[name].append(np.array(values, dtype=dtype))
+
+        return {
+            name: np.concatenate(chunks) if chunks else np.empty(0, dtype=COLUMNS[name][0])
+            for name, chunks in parts.items()
+        }
+
+    def _last_seq(self, cur):
+        cur.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (CHANGES_TABLE,))
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+    def _locations(self):
+        locations = [None] * len(self._location_codes)
+        for location, code in self._location_codes.items():
+            locations[code] = location
+        return tuple(locations)
+
+    def refresh(self):
+        import numpy as np
+        started = time.perf_counter()
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.row_factory = None
+            # One read transaction, so the rows match the sequence number
+            cur.execute('BEGIN')
+            seq = self._last_seq(cur)
+            snapshot = self._snapshot
+
+            if snapshot is not None and seq == snapshot.seq:
+                return snapshot
+
+            changed = None
+            if snapshot is not None:
+                cur.execute(f'SELECT MIN(seq) FROM {CHANGES_TABLE}')
+                first = cur.fetchone()[0]
+                # Nothing was pruned that this snapshot hasn't seen yet
+                if first is not None and first <= snapshot.seq + 1:
+                    cur.execute(
+                        f'SELECT DISTINCT subscription_id FROM {CHANGES_TABLE} WHERE seq > ? AND seq <= ?',
+                        (snapshot.seq, seq)
+                    )
+                    changed = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+                    if len(changed) > self.full_reload_ratio * max(len(snapshot), 1):
+                        changed = None
+
+            if changed is None:
+                self._location_codes = {}
+                columns = self._read(cur)
+                self._full_loads += 1
+            else:
+                fetched = self._read(
+                    cur,
+                    f'''WHERE subscription_id IN (
+                        SELECT subscription_id FROM {CHANGES_TABLE} WHERE seq > ? AND seq <= ?
+                    )''',
+                    (snapshot.seq, seq)
+                )
+                # Drop the old versions of changed rows (and deleted ones),
+                # then add the current versions
+                keep = ~np.isin(snapshot['subscription_id'], changed)
+                columns = {name: np.concatenate((snapshot[name][keep], fetched[name])) for name in COLUMNS}
+                ids = columns['subscription_id']
+                if len(fetched['subscription_id']) and np.any(ids[1:] < ids[:-1]):
+                    order = np.argsort(ids, kind='stable')
+                    columns = {name: column[order] for name, column in columns.items()}
+                self._incremental_refreshes += 1
+
+        self._snapshot = Snapshot(columns, self._locations(), seq)
+        self._last_refresh_seconds = time.perf_counter() - started
+        return self._snapshot
+
+    def snapshot(self):
+        # Checks for changes at most every refresh_interval seconds. While
+        # one thread refreshes, the others keep using the current snapshot
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.refresh_interval:
+            return snapshot
+
+        if not self._lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            snapshot = self.refresh()
+            self._checked_at = time.monotonic()
+            return snapshot
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "rows": len(snapshot) if snapshot is not None else None,
+            "bytes": snapshot.nbytes if snapshot is not None else None,
+            "seq": snapshot.seq if snapshot is not None else None,
+            "full_loads": self._full_loads,
+            "incremental_refreshes": self._incremental_refreshes,
+            "last_refresh_ms": round(self._last_refresh_seconds * 1000, 3) if self._last_refresh_seconds is not None else None,
+        }
+
+store = ColumnStore()
+
+# ----------------------------------------------------- Helpers
+def _month_index(value):
+    # 'YYYY-MM' -> months since 1970-01
+    month = datetime.strptime(value, '%Y-%m')
+    return (month.year - 1970) * 12 + month.month - 1
+
+def _month_name(index):
+    return f'{1970 + index // 12:04d}-{index % 12 + 1:02d}'
+
+def _month_start_day(index):
+    import numpy as np
+    return int(np.datetime64(_month_name(index), 'M').astype('datetime64[D]').astype(np.int64))
+
+def _months_of(days):
+    import numpy as np
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+def _current_month_index():
+    return _month_index(datetime.now().strftime('%Y-%m'))
+
+def _valid_periods(snapshot):
+    start, end = snapshot['start'], snapshot['end']
+    return (start != NO_DATE) & (end != NO_DATE) & (end >= start)
+
+# ----------------------------------------------------- Reports
+def utilization(start_month=None, end_month=None, snapshot=None):
+    import numpy as np
+    # Subscribed car-days per month relative to the cars that have ever
+    # had a subscription. Defaults to the last 12 months
+    try:
+        last = _month_index(end_month) if end_month else _current_month_index()
+        first = _month_index(start_month) if start_month else last - 11
+    except ValueError:
+        return [400, {"error": "from and to must be months in the format YYYY-MM"}]
+    if first > last:
+        return [400, {"error": "from must not be after to"}]
+    if last - first >= MAX_REPORT_MONTHS:
+        return [400, {"error": f"from and to can be at most {MAX_REPORT_MONTHS} months apart"}]
+
+    snapshot = snapshot or store.snapshot()
+    valid = _valid_periods(snapshot)
+    if not valid.any():
+        return [404, {"message": "No subscriptions found"}]
+
+    start = snapshot['start'][valid].astype(np.int64)
+    end = snapshot['end'][valid].astype(np.int64) + 1
+    fleet = len(np.unique(snapshot['car_id'][valid]))
+
+    months = []
+    for index in range(first, last + 1):
+        month_start, month_end = _month_start_day(index), _month_start_day(index + 1)
+        overlap = np.clip(np.minimum(end, month_end) - np.maximum(start, month_start), 0, None)
+        car_days = int(overlap.sum())
+        months.append({
+            "month": _month_name(index),
+            "active_subscriptions": int(np.count_nonzero(overlap)),
+            "subscribed_car_days": car_days,
+            "utilization": round(car_days / (fleet * (month_end - month_start)), 4),
+        })
+
+    return [200, {"fleet_cars": fleet, "months": months}]
+
+def revenue_projection(months=12, start_month=None, snapshot=None):
+    import numpy as np
+    # Expected revenue per month from the contracted durations: every
+    # subscription is billed for subscription_duration_months months (at
+    # least one) from its start month
+    try:
+        first = _month_index(start_month) if start_month else _current_month_index()
+    except ValueError:
+        return [400, {"error": "from must be a month in the format YYYY-MM"}]
+    if not 1 <= months <= MAX_REPORT_MONTHS:
+        return [400, {"error": f"months must be between 1 and {MAX_REPORT_MONTHS}"}]
+
+    snapshot = snapshot or store.snapshot()
+    valid = snapshot['start'] != NO_DATE
+    if not valid.any():
+        return [404, {"message": "No subscriptions found"}]
+
+    start = _months_of(snapshot['start'][valid]) - first
+    end = start + np.maximum(snapshot['duration_months'][valid], 1)
+    price = snapshot['price'][valid].astype(np.int64)
+
+    # Add at the first billed month, subtract after the last, then sum up
+    opens = np.clip(start, 0, months)
+    closes = np.clip(end, 0, months)
+    revenue = np.cumsum(
+        np.bincount(opens, weights=price, minlength=months + 1)
+        - np.bincount(closes, weights=price, minlength=months + 1)
+    )[:months]
+    billed = np.cumsum(
+        np.bincount(opens, minlength=months + 1) - np.bincount(closes, minlength=months + 1)
+    )[:months]
+
+    return [200, [
+        {"month": _month_name(first + i), "revenue": int(revenue[i]), "subscriptions": int(billed[i])}
+        for i in range(months)
+    ]]
+
+def overage_distribution(bins=10, location=None, snapshot=None):
+    import numpy as np
+    # Distribution of km driven minus contracted km
+    if not 1 <= bins <= 100:
+        return [400, {"error": "bins must be between 1 and 100"}]
+
+    snapshot = snapshot or store.snapshot()
+    selected = np.ones(len(snapshot), dtype=bool)
+    if location is not None:
+        code = snapshot.locations.index(location) if location in snapshot.locations else -2
+        selected = snapshot['location'] == code
+    if not selected.any():
+        return [404, {"message": "No subscriptions found"}]
+
+    overage = snapshot['km_driven'][selected].astype(np.int64) - snapshot['contracted_km'][selected]
+    over = overage[overage > 0]
+    p50, p90, p99 = np.percentile(overage, [50, 90, 99])
+
+    histogram = []
+    if len(over):
+        counts, edges = np.histogram(over, bins=bins, range=(0, int(over.max())))
+        histogram = [
+            {"from_km": int(edges[i]), "to_km": int(edges[i + 1]), "subscriptions": int(counts[i])}
+            for i in range(bins)
+        ]
+
+    return [200, {
+        "subscriptions": int(len(overage)),
+        "over_contracted": int(len(over)),
+        "share_over_contracted": round(len(over) / len(overage), 4),
+        "mean_overage_km": round(float(overage.mean()), 1),
+        "p50_overage_km": round(float(p50), 1),
+        "p90_overage_km": round(float(p90), 1),
+        "p99_overage_km": round(float(p99), 1),
+        "total_overage_km": int(over.sum()),
+        "histogram": histogram,
+    }]
@@ -0,0 +1,182 @@
+import sqlite3
+import threading
+import queue
+import time
+import os
+from collections.abc import Sequence
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+DB_PATH = os.getenv('DB_PATH', "subscriptions.db")
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 268435456))
+DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', 256))
+
+class RowSet(Sequence):
+    """Query result kept as the row tuples plus their column names.
+
+    Reads like a list of dicts, but a dict is only made for the row being
+    read, so cached results stay small and serialization.py can encode the
+    tuples directly"""
+
+    __slots__ = ('fields', 'rows')
+
+    def __init__(self, fields, rows):
+        self.fields = tuple(fields)
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RowSet(self.fields, self.rows[index])
+        return dict(zip(self.fields, self.rows[index]))
+
+    def __iter__(self):
+        fields = self.fields
+        return (dict(zip(fields, row)) for row in self.rows)
+
+    def column(self, name):
+        index = self.fields.index(name)
+        return [row[index] for row in self.rows]
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections shared between threads"""
+
+    def __init__(self, path, size, timeout):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._inherited = []
+        self._init_state()
+
+    def _init_state(self):
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+
+    def _reset_after_fork(self):
+        # A forked worker must not use its parent's connections. Closing them
+        # here could disturb the parent's locks and WAL, so they are only set
+        # aside and the child opens its own
+        self._inherited.extend(self._idle.queue)
+        self._init_state()
+
+    def close_idle(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self._lock:
+                self._open -= 1
+
+    def _connect(self):
+        # Statements are compiled once per connection and reused from the
+        # sqlite3 statement cache for as long as the connection lives
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        with self._lock:
+            self._open += 1
+        return conn
+
+    def acquire(self):
+        start = time.perf_counter()
+        waited = not self._slots.acquire(blocking=False)
+        if waited and not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise sqlite3.OperationalError('Timed out waiting for a database connection')
+
+        wait_time = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += wait_time
+                self._max_wait = max(self._max_wait, wait_time)
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self._connect()
+            except Exception:
+                self._release_slot()
+                raise
+
+    def release(self, conn, discard=False):
+        if discard:
+            conn.close()
+            with self._lock:
+                self._open -= 1
+        else:
+            self._idle.put(conn)
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "acquired": self._acquired,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "avg_wait_ms": round(self._wait_time / self._waits * 1000, 3) if self._waits else 0.0,
+                "max_wait_ms": round(self._max_wait * 1000, 3),
+            }
+
+_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+os.register_at_fork(after_in_child=_pool._reset_after_fork)
+
+@contextmanager
+def connection():
+    conn = _pool.acquire()
+    try:
+        # Commit on success, roll back on error
+        with conn:
+            yield conn
+    finally:
+        # Don't hand a connection with a dangling transaction back to the pool
+        _pool.release(conn, discard=conn.in_transaction)
+
+def close_idle():
+    # Called by the server before forking workers, so no open connection
+    # is inherited in the first place
+    _pool.close_idle()
+
+def pool_stats():
+    return _pool.stats()
@@ -0,0 +1,380 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+import random
+import time
+import os
+import jwt
+from dotenv import load_dotenv
+import cache
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+ADMIN_EMAIL = os.getenv('ADMIN_EMAIL')
+ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
+ADMIN_GATEWAY_URL = os.getenv('ADMIN_GATEWAY_URL')
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv('GATEWAY_CONNECT_TIMEOUT', 3.05))
+GATEWAY_READ_TIMEOUT = float(os.getenv('GATEWAY_READ_TIMEOUT', 10))
+GATEWAY_RETRIES = int(os.getenv('GATEWAY_RETRIES', 2))
+GATEWAY_RETRY_BACKOFF = float(os.getenv('GATEWAY_RETRY_BACKOFF', 0.2))
+GATEWAY_POOL_SIZE = int(os.getenv('GATEWAY_POOL_SIZE', 20))
+GATEWAY_BREAKER_THRESHOLD = int(os.getenv('GATEWAY_BREAKER_THRESHOLD', 5))
+GATEWAY_BREAKER_RESET = float(os.getenv('GATEWAY_BREAKER_RESET', 30))
+GATEWAY_TOKEN_REFRESH_MARGIN = float(os.getenv('GATEWAY_TOKEN_REFRESH_MARGIN', 60))
+GATEWAY_FANOUT_CONCURRENCY = int(os.getenv('GATEWAY_FANOUT_CONCURRENCY', 16))
+CAR_CACHE_TTL = float(os.getenv('CAR_CACHE_TTL', 10))
+CAR_CACHE_MAX_ENTRIES = int(os.getenv('CAR_CACHE_MAX_ENTRIES', 4096))
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+class GatewayError(Exception):
+    """The admin gateway could not be reached or kept failing"""
+    status = 502
+
+class CircuitOpenError(GatewayError):
+    """Calls are short-circuited while the gateway is considered down"""
+    status = 503
+
+class AuthenticationError(GatewayError):
+    """Logging in to the admin gateway failed"""
+    status = 401
+
+class CredentialManager:
+    """Keeps the admin gateway token, refreshing it before it expires.
+
+    Only one thread logs in at a time. While a still valid token is being
+    refreshed the other threads keep using it; once it has expired they
+    wait for the new one"""
+
+    def __init__(self, login, refresh_margin=GATEWAY_TOKEN_REFRESH_MARGIN):
+        self._login = login
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._logins = 0
+        self._failed_logins = 0
+
+    def get(self):
+        token, expires_at = self._token, self._expires_at
+        now = time.time()
+        if token and now < expires_at - self.refresh_margin:
+            return token
+
+        if token and now < expires_at:
+            if not self._lock.acquire(blocking=False):
+                return token
+        else:
+            self._lock.acquire()
+
+        try:
+            # Another thread may have logged in while this one waited
+            if self._token is not token and time.time() < self._expires_at:
+                return self._token
+            return self._refresh()
+        finally:
+            self._lock.release()
+
+    def refresh(self, stale_token):
+        # Called after a 401. Concurrent callers holding the same rejected
+        # token share one login
+        with self._lock:
+            if self._token is not None and self._token != stale_token:
+                return self._token
+            return self._refresh()
+
+    def _refresh(self):
+        token = self._login()
+        if token is None:
+            self._failed_logins += 1
+            raise AuthenticationError('Authentication failed')
+
+        self._logins += 1
+        self._token = token
+        self._expires_at = _token_expiry(token)
+        return token
+
+    def stats(self):
+        expires_in = self._expires_at - time.time() if self._token else None
+        return {
+            "logins": self._logins,
+            "failed_logins": self._failed_logins,
+            "token_expires_in_seconds": round(expires_in) if expires_in is not None and expires_in != float('inf') else None,
+        }
+
+def _token_expiry(token):
+    # The gateway token is a JWT; its signature is the gateway's business,
+    # only the expiry is needed here. Tokens without one are used until a 401
+    try:
+        exp = jwt.decode(token, options={"verify_signature": False}).get('exp')
+    except jwt.InvalidTokenError:
+        exp = None
+    return float(exp) if exp is not None else float('inf')
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and lets a single trial
+    call through once `reset_timeout` seconds have passed"""
+
+    def __init__(self, threshold=GATEWAY_BREAKER_THRESHOLD, reset_timeout=GATEWAY_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (self._opened_at is None and self._failures >= self.threshold):
+                self._opened += 1
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._state(),
+                "consecutive_failures": self._failures,
+                "times_opened": self._opened,
+            }
+
+class GatewayClient:
+    """Client for the admin gateway with a pooled keep-alive session,
+    timeouts, jittered retries, a circuit breaker and latency metrics"""
+
+    def __init__(self, base_url=ADMIN_GATEWAY_URL, email=ADMIN_EMAIL, password=ADMIN_PASSWORD,
+                 timeout=(GATEWAY_CONNECT_TIMEOUT, GATEWAY_READ_TIMEOUT), retries=GATEWAY_RETRIES,
+                 backoff=GATEWAY_RETRY_BACKOFF, pool_size=GATEWAY_POOL_SIZE, breaker=None):
+        self.base_url = base_url
+        self.email = email
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self.credentials = CredentialManager(self._login)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._car_cache = cache.TTLCache(maxsize=CAR_CACHE_MAX_ENTRIES, ttl=CAR_CACHE_TTL)
+        self._executor = None
+
+    @property
+    def session(self):
+        # Created on the first call, so importing requests doesn't slow down
+        # the start of processes that never call the gateway
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._new_session()
+        return self._session
+
+    def _new_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Content-Type'] = 'application/json'
+        # The token is sent explicitly by authenticated_request, so the
+        # session must not hold on to a stale copy from the login response
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def _reset_after_fork(self):
+        # Keep-alive sockets and locks can't be shared with the parent
+        # process; the token is still valid and is kept
+        self._session = None
+        self._lock = threading.Lock()
+        self.breaker._lock = threading.Lock()
+        self.credentials._lock = threading.Lock()
+        self._car_cache._lock = threading.Lock()
+        self._executor = None
+
+    # ----------------------------------------------------- Transport
+    def request(self, method, path, name=None, idempotent=None, **kwargs):
+        # Only idempotent calls are retried. Failed requests and 5xx
+        # responses count as failures for the circuit breaker
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        attempts = 1 + self.retries if idempotent else 1
+        name = name or f'{method} {path}'
+        kwargs.setdefault('timeout', self.timeout)
+
+        import requests
+        transient = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                self._record(name, 0.0, error=True)
+                raise CircuitOpenError('Admin gateway circuit is open')
+
+            start = time.perf_counter()
+            response = None
+            try:
+                response = self.session.request(method, f'{self.base_url}{path}', **kwargs)
+            except requests.RequestException as e:
+                error = e
+            finally:
+                # Whatever was raised, the outcome reaches the breaker, so a
+                # half-open trial call always ends
+                failed = response is None or response.status_code >= 500
+                self._record(name, time.perf_counter() - start, error=failed)
+                if failed:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+
+            if response is None:
+                # Errors like an invalid ADMIN_GATEWAY_URL don't go away by retrying
+                if attempt == attempts - 1 or not isinstance(error, transient):
+                    raise GatewayError(f'Admin gateway request failed: {error}') from error
+                self._sleep(attempt)
+                continue
+
+            if failed and attempt < attempts - 1:
+                self._sleep(attempt)
+                continue
+
+            return response
+
+    def _fan_out(self, function, items):
+        # The pool is shared by all requests, so the number of concurrent
+        # calls to the gateway stays bounded however many come in
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=GATEWAY_FANOUT_CONCURRENCY,
+                                                    thread_name_prefix='gateway-fanout')
+            executor = self._executor
+        return list(executor.map(function, items))
+
+    def _sleep(self, attempt):
+        # Full jitter exponential backoff
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _record(self, name, seconds, error=False):
+        metrics.SPAN_SECONDS.observe(seconds, kind='gateway', name=name)
+        with self._lock:
+            call = self._calls.setdefault(name, {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            call["count"] += 1
+            call["errors"] += int(error)
+            call["total_seconds"] += seconds
+            call["max_seconds"] = max(call["max_seconds"], seconds)
+
+    def stats(self):
+        with self._lock:
+            calls = {
+                name: {
+                    "count": call["count"],
+                    "errors": call["errors"],
+                    "avg_ms": round(call["total_seconds"] / call["count"] * 1000, 3) if call["count"] else 0.0,
+                    "max_ms": round(call["max_seconds"] * 1000, 3),
+                }
+                for name, call in self._calls.items()
+            }
+        return {
+            "circuit_breaker": self.breaker.stats(),
+            "credentials": self.credentials.stats(),
+            "car_cache": self._car_cache.stats(),
+            "calls": calls
+        }
+
+    def authenticated_request(self, method, path, **kwargs):
+        # Sends the gateway token with the call. A 401 means the token was
+        # revoked or expired early, so log in again and replay the call once
+        token = self.credentials.get()
+        response = self.request(method, path, cookies={'Authorization': token}, **kwargs)
+
+        if response.status_code == 401:
+            token = self.credentials.refresh(token)
+            response = self.request(method, path, cookies={'Authorization': token}, **kwargs)
+
+        return response
+
+    # ----------------------------------------------------- Admin gateway API
+    def _login(self):
+        response = self.request(
+            'POST', '/user/login', name='POST /user/login', idempotent=True,
+            json={"email": self.email, "password": self.password}
+        )
+        if response.status_code != 200:
+            return None
+        return response.cookies.get('Authorization')
+
+    def get_car(self, car_id):
+        return self.authenticated_request('GET', f'/car/cars/{car_id}', name='GET /car/cars/{id}')
+
+    def get_car_info(self, car_id):
+        # [status, result] for one car. Found cars are cached for a few
+        # seconds, since the same cars are looked up again and again
+        result = self._car_cache.get(car_id)
+        if result is not cache.MISSING:
+            return [200, result]
+
+        try:
+            response = self.get_car(car_id)
+        except GatewayError as e:
+            return [e.status, {"message": str(e)}]
+
+        result = response_json(response)
+        if response.status_code == 200:
+            self._car_cache.set(car_id, result)
+        return [response.status_code, result]
+
+    def get_car_infos(self, car_ids):
+        # Looks up every distinct car once, concurrently, so the time taken
+        # is that of the slowest call rather than the sum of all of them
+        car_ids = list(dict.fromkeys(car_ids))
+        return dict(zip(car_ids, self._fan_out(self.get_car_info, car_ids)))
+
+    def update_car_availability(self, car_id, is_available):
+        # Setting the flag to a fixed value is safe to repeat
+        response = self.authenticated_request(
+            'PATCH', f'/car/cars/{car_id}', name='PATCH /car/cars/{id}', idempotent=True,
+            json={"is_available": is_available}
+        )
+        self._car_cache.invalidate(car_id)
+        return response
+
+def response_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {"message": response.text}
+
+client = GatewayClient()
+os.register_at_fork(after_in_child=client._reset_after_fork)
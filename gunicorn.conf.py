@@ -0,0 +1,75 @@
+# Production server configuration: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import shutil
+import tempfile
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5006)}"
+
+# One process per core (plus one so a core isn't idle while a worker
+# waits on SQLite), each with a few threads for requests blocked on I/O.
+# GUNICORN_WORKER_CLASS=gevent runs async workers instead (pip install gevent)
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+
+# Import the app once in the master process so workers fork ready to serve
+preload_app = True
+
+# On SIGTERM workers stop accepting, finish their requests and exit
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Restart workers now and then to bound memory growth
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+# Workers write their metrics here so /metrics reports all of them, not
+# just the worker that happens to serve the scrape (see metrics.py)
+_metrics_tempdir = None
+if not os.getenv('METRICS_DIR'):
+    _metrics_tempdir = tempfile.mkdtemp(prefix='subscriptions-metrics-')
+    os.environ['METRICS_DIR'] = _metrics_tempdir
+
+def on_starting(server):
+    # Create the schema and apply the migrations once, before any worker runs
+    import subscription
+    subscription.create_table()
+
+    # Counters start from zero with every server start
+    directory = os.environ['METRICS_DIR']
+    for filename in os.listdir(directory):
+        if filename.endswith('.json'):
+            os.remove(os.path.join(directory, filename))
+
+def on_exit(server):
+    if _metrics_tempdir:
+        shutil.rmtree(_metrics_tempdir, ignore_errors=True)
+
+def pre_fork(server, worker):
+    # Don't let workers inherit the connections opened while preloading
+    import db
+    db.close_idle()
+
+def post_worker_init(worker):
+    import app
+    app.start_background_tasks()
+
+def child_exit(server, worker):
+    # Runs in the master. Folds the worker's metrics into the totals of
+    # exited workers, so METRICS_DIR holds one file per live worker
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+def worker_exit(server, worker):
+    # Lets an outbox batch in flight finish before the process exits
+    import app
+    app.stop_background_tasks(timeout=graceful_timeout)
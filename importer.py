@@ -0,0 +1,216 @@
+import sqlite3
+import csv
+import time
+import os
+from datetime import date
+from dotenv import load_dotenv
+import db
+import subscription
+
+# Load environment variables from .env file
+load_dotenv()
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 10000))
+IMPORT_REJECTS_DIR = os.getenv('IMPORT_REJECTS_DIR', 'rejects')
+
+# CSV header -> position in subscription.INSERT_QUERY
+CSV_COLUMNS = (
+    'CarId',
+    'SubscriptionStartDate',
+    'SubscriptionEndDate',
+    'SubscriptionDurationMonths',
+    'KmDrivenDuringSubscription',
+    'ContractedKm',
+    'MonthlySubscriptionPrice',
+    'DeliveryLocation',
+    'HasDeliveryInsurance',
+)
+
+def _parse_date(value):
+    # Fixed format DD/MM/YYYY -> YYYY-MM-DD, without going through strptime.
+    # date() rejects days the month doesn't have, e.g. 31/02
+    if len(value) != 10 or value[2] != '/' or value[5] != '/':
+        raise ValueError(f"Invalid date '{value}', expected DD/MM/YYYY")
+
+    day, month, year = value[:2], value[3:5], value[6:]
+    if not (day.isdigit() and month.isdigit() and year.isdigit()):
+        raise ValueError(f"Invalid date '{value}', expected DD/MM/YYYY")
+    try:
+        date(int(year), int(month), int(day))
+    except ValueError:
+        raise ValueError(f"Invalid date '{value}'")
+
+    return f'{year}-{month}-{day}'
+
+def _parse_bool(value):
+    if value == 'TRUE':
+        return True
+    if value == 'FALSE':
+        return False
+    raise ValueError(f"Invalid boolean '{value}', expected TRUE or FALSE")
+
+def _parse_row(fields, positions):
+    if len(fields) < len(positions):
+        raise ValueError(f"Expected at least {len(positions)} columns, got {len(fields)}")
+
+    (car_id, start, end, duration, km_driven, contracted_km,
+     price, location, insurance) = (fields[i].strip() for i in positions)
+
+    start_date = _parse_date(start)
+    end_date = _parse_date(end)
+    if end_date < start_date:
+        raise ValueError("Subscription ends before it starts")
+
+    return (
+        int(car_id),
+        start_date,
+        end_date,
+        int(duration),
+        int(km_driven),
+        int(contracted_km),
+        int(price),
+        location,
+        _parse_bool(insurance),
+    )
+
+def _count_lines(file, length):
+    # Lines in the `length` bytes after the header, so rejects of a resumed
+    # import are numbered as in the whole file. Leaves the file right after them
+    lines = 0
+    while length > 0:
+        chunk = file.read(min(length, 1 << 20))
+        if not chunk:
+            break
+        lines += chunk.count(b'\n')
+        length -= len(chunk)
+    return lines
+
+def import_csv(file, offset=0, batch_size=IMPORT_BATCH_SIZE, rejects=None):
+    # Streams subscriptions from a binary CSV file into the database, one
+    # transaction per batch, and next_offset is the byte offset after the
+    # last committed row, so an interrupted import can be resumed from
+    # there. Invalid rows and rows overlapping another subscription of the
+    # same car are written to `rejects` (a text file) with the reason appended
+    started = time.perf_counter()
+    imported = 0
+    rejected = 0
+
+    header_line = file.readline()
+    try:
+        header = next(csv.reader([header_line.decode('utf-8-sig')]))
+    except UnicodeDecodeError:
+        return [400, {"error": "The CSV file must be UTF-8 encoded"}]
+    missing = [column for column in CSV_COLUMNS if column not in header]
+    if missing:
+        return [400, {"error": f"Missing CSV columns: {', '.join(missing)}"}]
+
+    positions = [header.index(column) for column in CSV_COLUMNS]
+    position = max(offset, len(header_line))
+    line_number = 1 + _count_lines(file, position - len(header_line))
+
+    rejects_writer = csv.writer(rejects) if rejects is not None else None
+    if rejects_writer is not None and rejects.tell() == 0:
+        rejects_writer.writerow(header + ['Error'])
+
+    def result(status, **extra):
+        seconds = time.perf_counter() - started
+        return [status, {
+            "rows_imported": imported,
+            "rows_rejected": rejected,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(imported / seconds) if seconds else imported,
+            "next_offset": position,
+            **extra
+        }]
+
+    def flush(batch, batch_rejects):
+        nonlocal imported, rejected
+        if batch:
+            inserted = 0
+            with db.connection() as conn:
+                # Rows are inserted one by one under the write lock, so each
+                # is checked against the committed ones and the rows before it
+                conn.execute('BEGIN IMMEDIATE')
+                cur = conn.cursor()
+                for number, fields, row in batch:
+                    conflict = subscription.find_booking_conflict(cur, row[0], row[1], row[2])
+                    if conflict is not None:
+                        batch_rejects.append(fields + [f"Line {number}: Car is already subscribed from {conflict[1]} to {conflict[2]}"])
+                        continue
+                    cur.execute(subscription.INSERT_QUERY, row)
+                    inserted += 1
+            imported += inserted
+
+        # Rejects are only recorded once their batch is committed, so
+        # resuming from next_offset doesn't report them twice
+        rejected += len(batch_rejects)
+        if rejects_writer is not None:
+            rejects_writer.writerows(batch_rejects)
+
+    try:
+        batch = []
+        batch_rejects = []
+        batch_end = position
+
+        for line in file:
+            batch_end += len(line)
+            line_number += 1
+            try:
+                text = line.decode('utf-8').rstrip('\r\n')
+            except UnicodeDecodeError as e:
+                # Kept in the rejects file with the bad bytes replaced
+                text = line.decode('utf-8', errors='replace').rstrip('\r\n')
+                batch_rejects.append(text.split(',') + [f"Line {line_number}: not valid UTF-8 at byte {e.start}"])
+                continue
+            if not text:
+                continue
+
+            # Plain split is a lot faster than the csv module and enough
+            # unless a field is quoted
+            fields = next(csv.reader([text])) if '"' in text else text.split(',')
+            try:
+                batch.append((line_number, fields, _parse_row(fields, positions)))
+            except ValueError as e:
+                batch_rejects.append(fields + [f"Line {line_number}: {e}"])
+
+            if len(batch) >= batch_size:
+                flush(batch, batch_rejects)
+                position = batch_end
+                batch = []
+                batch_rejects = []
+
+        flush(batch, batch_rejects)
+        position = batch_end
+
+    except sqlite3.Error as e:
+        return result(500, error=str(e))
+
+    finally:
+        if imported:
+            subscription.clear_cache()
+
+    return result(201)
+
+def _import_with_rejects_file(file, rejects_path, offset, batch_size):
+    existed = os.path.exists(rejects_path)
+
+    with open(rejects_path, 'a', newline='') as rejects:
+        status, result = import_csv(file, offset, batch_size, rejects)
+
+    if result.get("rows_rejected"):
+        result["rejects_file"] = rejects_path
+    elif not existed:
+        os.remove(rejects_path)
+
+    return [status, result]
+
+def import_csv_file(path, offset=0, batch_size=IMPORT_BATCH_SIZE, rejects_path=None):
+    with open(path, 'rb') as file:
+        return _import_with_rejects_file(file, rejects_path or f'{path}.rejects.csv', offset, batch_size)
+
+def import_csv_upload(file, filename, offset=0, batch_size=IMPORT_BATCH_SIZE):
+    # Rejects of uploaded files are kept in IMPORT_REJECTS_DIR
+    os.makedirs(IMPORT_REJECTS_DIR, exist_ok=True)
+    name = os.path.basename(filename or 'upload.csv')
+    rejects_path = os.path.join(IMPORT_REJECTS_DIR, f'{time.strftime("%Y%m%d%H%M%S")}-{name}.rejects.csv')
+
+    return _import_with_rejects_file(file, rejects_path, offset, batch_size)
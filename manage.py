@@ -0,0 +1,108 @@
+import argparse
+import json
+import sys
+import os
+import subscription
+import analytics
+import importer
+import scheduler
+
+# ----------------------------------------------------- Commands
+def check_query_plans(args):
+    scans = subscription.check_query_plans()
+
+    for name, plan in scans.items():
+        print(f'{name}: {" / ".join(plan)}')
+
+    if scans:
+        print(f'{len(scans)} filter queries fall back to a table scan')
+        return 1
+
+    print('All filter queries are served by an index')
+    return 0
+
+def import_csv(args):
+    status, result = importer.import_csv_file(args.path, args.offset, args.batch_size, args.rejects)
+    print(json.dumps(result, indent=2))
+
+    return 0 if status == 201 else 1
+
+def reconcile_aggregates(args):
+    status, result = analytics.reconcile_aggregates(rebuild=not args.check)
+    print(json.dumps(result, indent=2))
+
+    if status != 200:
+        return 1
+    # In check mode differences are an error, otherwise they have been fixed
+    return 1 if args.check and not result["consistent"] else 0
+
+def recompute_availability(args):
+    # The queued updates are delivered by the outbox dispatcher of a running service
+    print(json.dumps(scheduler.availability_job.run(), indent=2))
+    return 0
+
+def migrate(args):
+    version = subscription.create_table()
+    print(f'Schema is at version {version}')
+    return 0
+
+def build_openapi(args):
+    # Build time step: the server serves the file instead of building the
+    # spec from the YAML files with flasgger on every start
+    os.environ['SWAGGER_MODE'] = 'dynamic'
+    import app
+    from swagger.config import OPENAPI_SPEC
+
+    response = app.app.test_client().get('/apispec.json')
+    if response.status_code != 200:
+        print(f'Building the spec failed with {response.status_code}')
+        return 1
+
+    output = args.output or OPENAPI_SPEC
+    with open(output, 'w') as file:
+        json.dump(response.json, file, sort_keys=True, separators=(',', ':'))
+    print(f'Wrote {output} ({len(response.json["paths"])} paths)')
+    return 0
+
+# ----------------------------------------------------- Main
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Subscription microservice management commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('migrate', help='Apply pending schema migrations').set_defaults(handler=migrate)
+
+    openapi_parser = commands.add_parser('build-openapi', help='Build the OpenAPI spec served by the service')
+    openapi_parser.add_argument('--output', default=None, help='Defaults to OPENAPI_SPEC (swagger/openapi.json)')
+    openapi_parser.set_defaults(handler=build_openapi, schema=False)
+
+    commands.add_parser(
+        'check-query-plans',
+        help='Fail if a supported filter on GET /subscriptions falls back to a table scan'
+    ).set_defaults(handler=check_query_plans)
+
+    commands.add_parser(
+        'recompute-availability',
+        help='Queue availability updates for cars whose subscriptions started or ended since the last run'
+    ).set_defaults(handler=recompute_availability)
+
+    reconcile_parser = commands.add_parser(
+        'reconcile-aggregates',
+        help='Rebuild the revenue and km overage aggregates from the subscriptions table and report differences'
+    )
+    reconcile_parser.add_argument('--check', action='store_true', help='Only report differences, exit 1 if there are any')
+    reconcile_parser.set_defaults(handler=reconcile_aggregates)
+
+    import_parser = commands.add_parser('import-csv', help='Bulk import subscriptions from a CSV file')
+    import_parser.add_argument('path', nargs='?', default='subscriptions.csv', help='CSV file to import')
+    import_parser.add_argument('--offset', type=int, default=0, help='Byte offset to resume an interrupted import from')
+    import_parser.add_argument('--batch-size', type=int, default=importer.IMPORT_BATCH_SIZE, help='Rows per transaction')
+    import_parser.add_argument('--rejects', help='File for rejected rows. Defaults to <path>.rejects.csv')
+    import_parser.set_defaults(handler=import_csv)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'schema', True):
+        subscription.create_table()
+    return args.handler(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
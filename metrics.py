@@ -0,0 +1,339 @@
+import threading
+import bisect
+import json
+import sys
+import time
+import os
+from collections import Counter as Tally
+from contextlib import contextmanager
+from functools import wraps
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.01))
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', 300))
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {key: value for key, value in self._values.items()}
+
+    @staticmethod
+    def merge(values, other):
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._values.items()}
+
+    @staticmethod
+    def merge(values, other):
+        for key, (counts, total, count) in other.items():
+            entry = values.setdefault(key, [[0] * len(counts), 0.0, 0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+            entry[2] += count
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time until the response headers are sent', ('route', 'method', 'status')
+)
+RESPONSE_BYTES = Counter('http_response_bytes_total', 'Response body bytes sent', ('route', 'method'))
+SPAN_SECONDS = Histogram(
+    'span_duration_seconds', 'Time spent in instrumented operations (db, auth, gateway)', ('kind', 'name')
+)
+ROWS = Counter('db_rows_returned_total', 'Rows returned by database reads', ('name',))
+REPLICATED = Counter(
+    'replication_rows_applied_total', 'Subscription rows copied from the primary by a read replica', ('op',)
+)
+DEAD_LETTERS = Counter(
+    'outbox_dead_letters_total', 'Car availability updates moved to the dead-letter table', ('reason',)
+)
+REGISTRY = (REQUEST_SECONDS, RESPONSE_BYTES, SPAN_SECONDS, ROWS, REPLICATED, DEAD_LETTERS)
+
+# ----------------------------------------------------- Instrumentation
+@contextmanager
+def span(kind, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - start, kind=kind, name=name)
+
+def timed(kind, name=None, rows=False):
+    # Decorator for functions returning [status, result]. With rows, the
+    # rows of a successful result are counted: the length of a list or RowSet
+    # result, of the one under the key `rows` if it's a string, or else one
+    def decorator(f):
+        label = name or f.__name__.lstrip('_')
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = f(*args, **kwargs)
+            finally:
+                SPAN_SECONDS.observe(time.perf_counter() - start, kind=kind, name=label)
+
+            if rows and result[0] == 200:
+                data = result[1][rows] if isinstance(rows, str) else result[1]
+                ROWS.inc(1 if isinstance(data, dict) else len(data), name=label)
+            return result
+        return wrapper
+    return decorator
+
+# ----------------------------------------------------- Exposition
+# With several worker processes every worker writes its metrics to
+# METRICS_DIR and /metrics adds up all of them. When a worker exits, the
+# master adds its file to DEAD_FILE and removes it (see mark_process_dead),
+# so counters never go backwards and recycled workers don't pile up
+DEAD_FILE = 'dead.json'
+
+def _snapshot():
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+def _encode(snapshot):
+    return {name: [[list(key), value] for key, value in values.items()] for name, values in snapshot.items()}
+
+def _write(path, data):
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(data, file)
+    os.replace(f'{path}.tmp', path)
+
+def _read(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def _merge(merged, data):
+    metrics = {metric.name: metric for metric in REGISTRY}
+    for name, values in data.items():
+        if name in metrics:
+            metrics[name].merge(merged[name], {tuple(key): value for key, value in values})
+
+def flush():
+    directory = os.getenv('METRICS_DIR')
+    if not directory:
+        return
+
+    _write(os.path.join(directory, f'{os.getpid()}.json'), _encode(_snapshot()))
+
+def mark_process_dead(pid):
+    # Called by the gunicorn master after a worker exited. While both files
+    # exist, DEAD_FILE lists the pid so readers don't count it twice
+    directory = os.getenv('METRICS_DIR')
+    if not directory:
+        return
+
+    path = os.path.join(directory, f'{pid}.json')
+    worker = _read(path)
+    if worker is None:
+        return
+
+    dead_path = os.path.join(directory, DEAD_FILE)
+    merged = {metric.name: {} for metric in REGISTRY}
+    _merge(merged, _read(dead_path) or {})
+    _merge(merged, worker)
+    data = _encode(merged)
+
+    _write(dead_path, {**data, "pids": [pid]})
+    os.remove(path)
+    _write(dead_path, {**data, "pids": []})
+
+def _collect():
+    merged = _snapshot()
+    directory = os.getenv('METRICS_DIR')
+    if not directory:
+        return merged
+
+    skip = {f'{os.getpid()}.json', DEAD_FILE}
+    dead = _read(os.path.join(directory, DEAD_FILE))
+    if dead is not None:
+        _merge(merged, dead)
+        skip.update(f'{pid}.json' for pid in dead.get('pids', ()))
+
+    for filename in os.listdir(directory):
+        if filename.endswith('.json') and filename not in skip:
+            data = _read(os.path.join(directory, filename))
+            if data is not None:
+                _merge(merged, data)
+    return merged
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render():
+    # Prometheus text exposition format
+    collected = _collect()
+    lines = []
+    for metric in REGISTRY:
+        values = collected[metric.name]
+        kind = 'histogram' if isinstance(metric, Histogram) else 'counter'
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {kind}')
+
+        for key, value in sorted(values.items()):
+            if kind == 'counter':
+                lines.append(f'{metric.name}{_labels(metric.labels, key)} {value}')
+                continue
+
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket in zip(metric.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f'{metric.name}_bucket{_labels(metric.labels, key, le)} {cumulative}')
+            lines.append(f'{metric.name}_sum{_labels(metric.labels, key)} {total}')
+            lines.append(f'{metric.name}_count{_labels(metric.labels, key)} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+class Flusher:
+    """Writes this process's metrics to METRICS_DIR in the background"""
+
+    def __init__(self, interval=METRICS_FLUSH_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if os.getenv('METRICS_DIR') and (self._thread is None or not self._thread.is_alive()):
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        try:
+            flush()
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                flush()
+            except OSError:
+                pass
+
+flusher = Flusher()
+
+# ----------------------------------------------------- Sampling profiler
+class SamplingProfiler:
+    """Samples the stacks of all threads every `interval` seconds while
+    running. The result is in the folded format read by flamegraph.pl and
+    speedscope: one line per distinct stack, root first, with its count"""
+
+    def __init__(self, interval=PROFILER_INTERVAL, max_seconds=PROFILER_MAX_SECONDS):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stacks = Tally()
+        self._samples = 0
+        self._started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = Tally()
+            self._samples = 0
+            self._started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        # Stops by itself after max_seconds, in case it is forgotten
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                with self._lock:
+                    self._stacks[';'.join(reversed(stack))] += 1
+            with self._lock:
+                self._samples += 1
+
+    def folded(self):
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self.running,
+                "pid": os.getpid(),
+                "started_at": self._started_at,
+                "samples": self._samples,
+                "stacks": len(self._stacks),
+                "interval_seconds": self.interval,
+            }
+
+profiler = SamplingProfiler()
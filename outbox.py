@@ -0,0 +1,188 @@
+import sqlite3
+import threading
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import background
+import db
+import gateway
+import metrics
+from subscription import DEAD_LETTER_TABLE, OUTBOX_TABLE
+
+# Load environment variables from .env file
+load_dotenv()
+OUTBOX_ENABLED = os.getenv('OUTBOX_ENABLED', 'true').lower() == 'true'
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 8))
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', 60))
+OUTBOX_RETRY_BACKOFF = float(os.getenv('OUTBOX_RETRY_BACKOFF', 2))
+OUTBOX_MAX_BACKOFF = float(os.getenv('OUTBOX_MAX_BACKOFF', 300))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+
+# Client errors that are worth retrying; any other 4xx won't change on a retry
+RETRYABLE_STATUSES = (408, 429)
+
+class OutboxDispatcher:
+    """Background thread delivering queued car availability updates to the
+    car service in batches, retrying failed ones with exponential backoff.
+    Updates the car service rejects, or that fail OUTBOX_MAX_ATTEMPTS times,
+    are moved to the dead-letter table"""
+
+    def __init__(self, client=None, batch_size=OUTBOX_BATCH_SIZE, concurrency=OUTBOX_CONCURRENCY,
+                 poll_interval=OUTBOX_POLL_INTERVAL):
+        self.client = client or gateway.client
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._delivered = 0
+        self._failed = 0
+        self._dead = 0
+        self._last_error = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='outbox-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def notify(self):
+        # Called after a commit that queued updates, so they go out right away
+        self._wake.set()
+
+    def _run(self):
+        background.run_loop(self._stop, self.dispatch_once, self._wait, self._record_error)
+
+    def _wait(self, sent):
+        # Keep draining while there is a backlog, otherwise wait for a
+        # notify or the next poll
+        if not sent or sent < self.batch_size:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _record_error(self, error):
+        with self._lock:
+            self._last_error = error
+
+    def _claim(self):
+        # Leasing the rows keeps other workers' dispatchers off them while
+        # they are being delivered
+        now = time.time()
+        with db.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                f''' SELECT car_id, is_available, version, attempts
+                FROM {OUTBOX_TABLE}
+                WHERE next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ? ''',
+                (now, self.batch_size)
+            ).fetchall()
+
+            conn.executemany(
+                f'UPDATE {OUTBOX_TABLE} SET next_attempt_at = ? WHERE car_id = ?',
+                [(now + OUTBOX_LEASE_SECONDS, row['car_id']) for row in rows]
+            )
+
+        return [dict(row) for row in rows]
+
+    def _deliver(self, row):
+        # Returns the row, the error or None, and whether the error is
+        # permanent, so the update is not retried
+        try:
+            response = self.client.update_car_availability(row['car_id'], bool(row['is_available']))
+            if response.status_code < 400:
+                return row, None, False
+            permanent = response.status_code < 500 and response.status_code not in RETRYABLE_STATUSES
+            return row, f'{response.status_code}: {gateway.response_json(response)}', permanent
+
+        except gateway.GatewayError as e:
+            return row, str(e), False
+        except Exception as e:
+            # Fails just this row, which is retried with backoff
+            return row, f'{type(e).__name__}: {e}', False
+
+    def dispatch_once(self):
+        rows = self._claim()
+        if not rows:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            outcomes = list(executor.map(self._deliver, rows))
+
+        delivered = []
+        failed = []
+        dead = []
+        for row, error, permanent in outcomes:
+            if error is None:
+                delivered.append((row['car_id'], row['version']))
+                continue
+
+            attempts = row['attempts'] + 1
+            if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                dead.append((attempts, error, row['car_id'], row['version'], 'rejected' if permanent else 'max_attempts'))
+            else:
+                backoff = min(OUTBOX_RETRY_BACKOFF * 2 ** row['attempts'], OUTBOX_MAX_BACKOFF)
+                failed.append((attempts, time.time() + backoff, error, row['car_id'], row['version']))
+
+        # Matching on version leaves rows alone that got a newer value while
+        # this batch was in flight
+        with db.connection() as conn:
+            conn.executemany(f'DELETE FROM {OUTBOX_TABLE} WHERE car_id = ? AND version = ?', delivered)
+            conn.executemany(
+                f''' UPDATE {OUTBOX_TABLE}
+                SET attempts = ?, next_attempt_at = ?, last_error = ?
+                WHERE car_id = ? AND version = ? ''',
+                failed
+            )
+            conn.executemany(
+                f''' INSERT OR REPLACE INTO {DEAD_LETTER_TABLE} (car_id, is_available, attempts, last_error, created_at)
+                SELECT car_id, is_available, ?, ?, created_at FROM {OUTBOX_TABLE}
+                WHERE car_id = ? AND version = ? ''',
+                [entry[:4] for entry in dead]
+            )
+            conn.executemany(f'DELETE FROM {OUTBOX_TABLE} WHERE car_id = ? AND version = ?', [entry[2:4] for entry in dead])
+
+        for entry in dead:
+            metrics.DEAD_LETTERS.inc(reason=entry[4])
+
+        with self._lock:
+            self._delivered += len(delivered)
+            self._failed += len(failed) + len(dead)
+            self._dead += len(dead)
+            if failed or dead:
+                self._last_error = failed[-1][2] if failed else dead[-1][1]
+
+        return len(rows)
+
+    def stats(self):
+        try:
+            with db.connection() as conn:
+                pending = conn.execute(f'SELECT COUNT(*) FROM {OUTBOX_TABLE}').fetchone()[0]
+                dead_letters = conn.execute(f'SELECT COUNT(*) FROM {DEAD_LETTER_TABLE}').fetchone()[0]
+        except sqlite3.Error:
+            pending = dead_letters = None
+
+        with self._lock:
+            return {
+                "running": self._thread is not None and self._thread.is_alive(),
+                "pending": pending,
+                "delivered": self._delivered,
+                "failed_attempts": self._failed,
+                "dead_lettered": self._dead,
+                "dead_letters": dead_letters,
+                "last_error": self._last_error,
+            }
+
+dispatcher = OutboxDispatcher()
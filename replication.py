@@ -0,0 +1,454 @@
+import json
+import math
+import sqlite3
+import threading
+import time
+import os
+from flask import g, jsonify, request
+from dotenv import load_dotenv
+import auth
+import background
+import db
+import metrics
+import subscription
+from subscription import TABLE_NAME, CHANGES_TABLE, REPLICATION_TABLE, COLUMNS
+
+# Load environment variables from .env file
+load_dotenv()
+# primary takes the writes; a replica copies the primary's data and serves reads
+REPLICATION_ROLE = os.getenv('REPLICATION_ROLE', 'primary')
+REPLICATION_PRIMARY_URL = os.getenv('REPLICATION_PRIMARY_URL')
+# Sent to the primary. Without it the replica signs its own with SECRET_KEY
+REPLICATION_TOKEN = os.getenv('REPLICATION_TOKEN')
+REPLICATION_POLL_INTERVAL = float(os.getenv('REPLICATION_POLL_INTERVAL', 1))
+REPLICATION_BATCH_SIZE = int(os.getenv('REPLICATION_BATCH_SIZE', 1000))
+REPLICATION_MAX_STALENESS = float(os.getenv('REPLICATION_MAX_STALENESS', 10))
+REPLICATION_LEASE_SECONDS = float(os.getenv('REPLICATION_LEASE_SECONDS', 10))
+REPLICATION_TIMEOUT = float(os.getenv('REPLICATION_TIMEOUT', 10))
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv('CHANGE_LOG_RETENTION_DAYS', 7))
+
+MAX_FEED_SIZE = 10000
+# Requests a replica serves from its copy (reads) or refuses (writes)
+REPLICATED_PATHS = ('/subscriptions', '/cars', '/analytics', '/admin/subscriptions')
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+def _role():
+    if REPLICATION_ROLE not in ('primary', 'replica'):
+        raise RuntimeError(f"REPLICATION_ROLE must be primary or replica, not '{REPLICATION_ROLE}'")
+    if REPLICATION_ROLE == 'replica' and not REPLICATION_PRIMARY_URL:
+        raise RuntimeError('A replica needs REPLICATION_PRIMARY_URL')
+    return REPLICATION_ROLE
+
+ROLE = _role()
+
+# Rows are written with the primary's id and version. Unchanged rows are
+# skipped, so they don't go through the triggers again
+UPSERT_QUERY = f''' INSERT INTO {TABLE_NAME} ({", ".join(COLUMNS)})
+    VALUES ({", ".join("?" * len(COLUMNS))})
+    ON CONFLICT (subscription_id) DO UPDATE SET
+        {", ".join(f"{column} = excluded.{column}" for column in COLUMNS[1:])}
+    WHERE ({", ".join(COLUMNS[1:])}) IS NOT ({", ".join(f"excluded.{column}" for column in COLUMNS[1:])}) '''
+
+class ReplicationError(Exception):
+    pass
+
+# ----------------------------------------------------- Change feed
+# Served by every node from its own change log, so a replica can be the
+# primary of another one
+def _sequence(cur):
+    # Last seq handed out. AUTOINCREMENT never reuses one and a rolled back
+    # insert gives its seq back, so the log has no gaps until it is pruned
+    row = cur.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (CHANGES_TABLE,)).fetchone()
+    return row[0] if row else 0
+
+def _select_rows(cur, ids):
+    cur.row_factory = None
+    cur.execute(
+        f'''SELECT {", ".join(COLUMNS)} FROM {TABLE_NAME}
+        WHERE subscription_id IN (SELECT value FROM json_each(?))
+        ORDER BY subscription_id''',
+        (json.dumps(ids),)
+    )
+    return db.RowSet(COLUMNS, cur.fetchall())
+
+@metrics.timed('db')
+def get_changes(after_seq=0, limit=REPLICATION_BATCH_SIZE):
+    """The subscriptions changed after `after_seq` in the change log: the
+    current row of every one still there and the ids of the deleted ones.
+
+    `reset` is true when the log no longer reaches back to `after_seq`
+    (pruned, or a different database), and the reader must copy the table
+    again from get_snapshot"""
+    if after_seq < 0 or not 1 <= limit <= MAX_FEED_SIZE:
+        return [400, {"error": f"after_seq must be 0 or more and limit between 1 and {MAX_FEED_SIZE}"}]
+
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            # One read transaction, so the rows are at least as new as the changes
+            cur.execute('BEGIN')
+            primary_seq = _sequence(cur)
+            oldest = cur.execute(f'SELECT MIN(seq) FROM {CHANGES_TABLE}').fetchone()[0]
+            first = oldest if oldest is not None else primary_seq + 1
+
+            result = {
+                "after_seq": after_seq,
+                "through_seq": after_seq,
+                "primary_seq": primary_seq,
+                "reset": first > after_seq + 1 or after_seq > primary_seq,
+                "upserts": [],
+                "deletes": [],
+            }
+            if result["reset"]:
+                return [200, result]
+
+            changes = cur.execute(
+                f'SELECT seq, subscription_id FROM {CHANGES_TABLE} WHERE seq > ? ORDER BY seq LIMIT ?',
+                (after_seq, limit)
+            ).fetchall()
+            if not changes:
+                return [200, result]
+
+            ids = list(dict.fromkeys(row[1] for row in changes))
+            rows = _select_rows(cur, ids)
+            found = set(rows.column('subscription_id'))
+
+            result["through_seq"] = changes[-1][0]
+            result["upserts"] = rows
+            result["deletes"] = [id for id in ids if id not in found]
+            return [200, result]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+@metrics.timed('db')
+def get_snapshot(after_id=0, limit=REPLICATION_BATCH_SIZE):
+    """A page of the whole table in subscription_id order, with the change
+    log seq it was read at. Rows changed while a reader pages through are
+    in the change log after the first page's seq"""
+    if after_id < 0 or not 1 <= limit <= MAX_FEED_SIZE:
+        return [400, {"error": f"after_id must be 0 or more and limit between 1 and {MAX_FEED_SIZE}"}]
+
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('BEGIN')
+            seq = _sequence(cur)
+            cur.row_factory = None
+            cur.execute(
+                f'''SELECT {", ".join(COLUMNS)} FROM {TABLE_NAME}
+                WHERE subscription_id > ? ORDER BY subscription_id LIMIT ?''',
+                (after_id, limit)
+            )
+            rows = cur.fetchall()
+
+        return [200, {
+            "seq": seq,
+            "subscriptions": db.RowSet(COLUMNS, rows),
+            "next_after_id": rows[-1][0] if len(rows) == limit else None,
+        }]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+# ----------------------------------------------------- Replica
+def _read_state(cur):
+    return cur.execute(
+        f'SELECT applied_seq, primary_seq, caught_up_at, leader, last_error FROM {REPLICATION_TABLE} WHERE id = 1'
+    ).fetchone()
+
+def _apply_rows(cur, upserts, deletes):
+    cur.executemany(UPSERT_QUERY, [tuple(row[column] for column in COLUMNS) for row in upserts])
+    cur.executemany(f'DELETE FROM {TABLE_NAME} WHERE subscription_id = ?', [(id,) for id in deletes])
+    metrics.REPLICATED.inc(len(upserts), op='upsert')
+    metrics.REPLICATED.inc(len(deletes), op='delete')
+
+class ReplicaTailer:
+    """Background thread keeping this node's database a copy of the
+    primary's. The first run copies the whole table from the snapshot
+    feed, then every poll applies the changes after the last applied seq.
+
+    Every worker runs one, but only the holder of the lease in
+    replication_state polls the primary. Each batch is applied in one
+    transaction together with the new applied_seq, and only if no other
+    worker applied it first, so the copy never goes back in time.
+
+    The copy is caught up as of the start of the last poll that reached
+    the primary's seq; staleness is the time since then"""
+
+    def __init__(self, primary_url=REPLICATION_PRIMARY_URL, poll_interval=REPLICATION_POLL_INTERVAL,
+                 batch_size=REPLICATION_BATCH_SIZE, lease_seconds=REPLICATION_LEASE_SECONDS):
+        self.primary_url = (primary_url or '').rstrip('/')
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._thread = None
+        self._session = None
+        self._token = None
+        self._token_at = 0.0
+        self._seen_seq = None
+        self._pruned_at = 0.0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='replica-tailer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def name(self):
+        # Read at call time, as workers fork after the tailer is created
+        return f'pid {os.getpid()}'
+
+    def _run(self):
+        background.run_loop(self._stop, self._poll, self._wait, self._record_error)
+
+    def _poll(self):
+        # Returns whether there is a backlog left
+        if not self._lead():
+            return False
+        behind = self.sync_once()
+        self._prune()
+        return behind
+
+    def _wait(self, behind):
+        # Keep going while there is a backlog, otherwise wait for the next poll
+        if not behind:
+            self._stop.wait(self.poll_interval)
+
+    def _lead(self):
+        # Takes or renews the lease. It only saves the primary duplicate
+        # polls; applying is safe without it
+        now = time.time()
+        try:
+            with db.connection() as conn:
+                cur = conn.execute(
+                    f'''UPDATE {REPLICATION_TABLE} SET leader = ?, lease_until = ?
+                    WHERE id = 1 AND (leader = ? OR lease_until < ?)''',
+                    (self.name, now + self.lease_seconds, self.name, now)
+                )
+                return cur.rowcount == 1
+        except sqlite3.OperationalError:
+            # Locked by the leader copying the table
+            return False
+
+    def _prune(self):
+        # The replica's own change log feeds columnar.py, and the
+        # availability job that prunes it on the primary doesn't run here
+        if time.time() - self._pruned_at > 86400:
+            subscription.prune_change_log(CHANGE_LOG_RETENTION_DAYS)
+            self._pruned_at = time.time()
+
+    def _record_error(self, error):
+        try:
+            with db.connection() as conn:
+                conn.execute(f'UPDATE {REPLICATION_TABLE} SET last_error = ? WHERE id = 1', (error,))
+        except sqlite3.Error:
+            pass
+
+    # ----------------------------------------------------- Fetching
+    def _auth_token(self):
+        if REPLICATION_TOKEN:
+            return REPLICATION_TOKEN
+        # Tokens are valid for a day, a fresh one is signed every hour
+        if self._token is None or time.time() - self._token_at > 3600:
+            self._token = auth.create_token('replica', ['replication'])
+            self._token_at = time.time()
+        return self._token
+
+    def _get(self, path, params):
+        import requests
+
+        if self._session is None:
+            self._session = requests.Session()
+        try:
+            response = self._session.get(
+                self.primary_url + path, params=params, timeout=REPLICATION_TIMEOUT,
+                headers={'Authorization': self._auth_token()}
+            )
+        except requests.RequestException as e:
+            raise ReplicationError(f'{path}: {e}')
+
+        if response.status_code != 200:
+            raise ReplicationError(f'{path}: {response.status_code} {response.text[:200]}')
+        return response.json()
+
+    # ----------------------------------------------------- Applying
+    def _state(self):
+        with db.connection() as conn:
+            return _read_state(conn.cursor())
+
+    def _save_state(self, cur, applied_seq, primary_seq, caught_up_at=None):
+        cur.execute(
+            f'''UPDATE {REPLICATION_TABLE} SET
+                applied_seq = ?,
+                primary_seq = ?,
+                caught_up_at = MAX(COALESCE(caught_up_at, 0), COALESCE(?, 0)),
+                last_error = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = 1''',
+            (applied_seq, primary_seq, caught_up_at)
+        )
+
+    def _applied(self, applied_seq):
+        self._seen_seq = applied_seq
+        subscription.clear_cache()
+
+    def sync_once(self):
+        """Applies one batch of changes, or copies the table when there is no
+        copy yet or the primary's log doesn't reach back far enough. Returns
+        True while the replica is behind"""
+        applied_seq = self._state()['applied_seq']
+        if applied_seq is None:
+            self.resync(None)
+            return True
+
+        started = time.time()
+        feed = self._get('/replication/changes', {'after_seq': applied_seq, 'limit': self.batch_size})
+        if feed['reset']:
+            self.resync(applied_seq)
+            return True
+
+        caught_up = feed['through_seq'] >= feed['primary_seq']
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            if _read_state(cur)['applied_seq'] != feed['after_seq']:
+                # Another worker applied it meanwhile
+                return True
+
+            _apply_rows(cur, feed['upserts'], feed['deletes'])
+            self._save_state(cur, feed['through_seq'], feed['primary_seq'], started if caught_up else None)
+
+        if feed['upserts'] or feed['deletes']:
+            self._applied(feed['through_seq'])
+        return not caught_up
+
+    def resync(self, applied_seq):
+        """Copies the whole table, in one transaction so readers never see
+        half of it. Local rows missing from a page are deleted. Changes
+        made on the primary while paging are applied after, from the seq
+        of the first page"""
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            if _read_state(cur)['applied_seq'] != applied_seq:
+                return
+
+            seq = None
+            after_id = 0
+            while True:
+                page = self._get('/replication/snapshot', {'after_id': after_id, 'limit': self.batch_size})
+                if seq is None:
+                    seq = page['seq']
+
+                rows = page['subscriptions']
+                last_id = page['next_after_id']
+                copied = {row['subscription_id'] for row in rows}
+                if last_id is None:
+                    local = cur.execute(f'SELECT subscription_id FROM {TABLE_NAME} WHERE subscription_id > ?', (after_id,))
+                else:
+                    local = cur.execute(
+                        f'SELECT subscription_id FROM {TABLE_NAME} WHERE subscription_id > ? AND subscription_id <= ?',
+                        (after_id, last_id)
+                    )
+                deleted = [row[0] for row in local.fetchall() if row[0] not in copied]
+
+                _apply_rows(cur, rows, deleted)
+                if last_id is None:
+                    break
+                after_id = last_id
+
+            self._save_state(cur, seq, seq)
+
+        self._applied(seq)
+
+    # ----------------------------------------------------- Serving
+    def staleness(self):
+        """Seconds since the copy was last caught up with the primary, None
+        before the first time"""
+        state = self._state()
+        if state['applied_seq'] != self._seen_seq:
+            # Reads cached by this worker may predate what another one applied
+            self._seen_seq = state['applied_seq']
+            subscription.clear_cache()
+
+        if not state['caught_up_at']:
+            return None
+        return max(time.time() - state['caught_up_at'], 0.0)
+
+    def stats(self):
+        try:
+            state = self._state()
+            staleness = self.staleness()
+        except sqlite3.Error as e:
+            return {"role": "replica", "primary": self.primary_url, "error": str(e)}
+
+        applied_seq, primary_seq = state['applied_seq'], state['primary_seq']
+        return {
+            "role": "replica",
+            "primary": self.primary_url,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "leader": state['leader'] == self.name,
+            "applied_seq": applied_seq,
+            "primary_seq": primary_seq,
+            "behind": primary_seq - applied_seq if primary_seq is not None and applied_seq is not None else None,
+            "staleness_seconds": round(staleness, 3) if staleness is not None else None,
+            "max_staleness_seconds": REPLICATION_MAX_STALENESS,
+            "last_error": state['last_error'],
+        }
+
+tailer = ReplicaTailer()
+
+def stats():
+    if ROLE == 'replica':
+        return tailer.stats()
+
+    try:
+        with db.connection() as conn:
+            seq = _sequence(conn)
+    except sqlite3.Error:
+        seq = None
+    return {"role": "primary", "seq": seq}
+
+# ----------------------------------------------------- Request hooks
+# Registered by app.py on replicas only
+def guard_request():
+    """before_request hook: writes to replicated data belong on the primary,
+    and reads are refused while the copy is staler than
+    REPLICATION_MAX_STALENESS"""
+    if not request.path.startswith(REPLICATED_PATHS):
+        return None
+
+    if request.method not in READ_METHODS:
+        return jsonify({"error": "This is a read replica, send writes to the primary", "primary": tailer.primary_url}), 403
+
+    try:
+        staleness = tailer.staleness()
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+    g.replica_staleness = staleness
+    if staleness is None or staleness > REPLICATION_MAX_STALENESS:
+        response = jsonify({
+            "error": "The replica is too far behind the primary",
+            "staleness_seconds": round(staleness, 3) if staleness is not None else None,
+            "max_staleness_seconds": REPLICATION_MAX_STALENESS,
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(math.ceil(tailer.poll_interval))
+        return response
+
+    return None
+
+def add_staleness_header(response):
+    staleness = g.get('replica_staleness')
+    if staleness is not None:
+        response.headers['X-Replica-Staleness'] = f'{staleness:.3f}'
+    return response
@@ -0,0 +1,183 @@
+import threading
+import time
+import os
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+import background
+import db
+import outbox
+import subscription
+from subscription import TABLE_NAME
+
+# Load environment variables from .env file
+load_dotenv()
+AVAILABILITY_JOB_ENABLED = os.getenv('AVAILABILITY_JOB_ENABLED', 'true').lower() == 'true'
+AVAILABILITY_JOB_CHUNK_SIZE = int(os.getenv('AVAILABILITY_JOB_CHUNK_SIZE', 500))
+AVAILABILITY_JOB_DELAY = float(os.getenv('AVAILABILITY_JOB_DELAY', 5))
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv('CHANGE_LOG_RETENTION_DAYS', 7))
+
+JOB_NAME = 'car_availability'
+
+class AvailabilityJob:
+    """Pushes the cars whose availability changed at a day boundary to the
+    car service, through the outbox.
+
+    Only cars with a subscription starting or ending across the boundary
+    can change, and those are found with range queries on the start and
+    end date indexes. Cars are processed in chunks, one transaction each,
+    and the cursor is saved with every chunk so an interrupted run resumes
+    where it stopped"""
+
+    def __init__(self, chunk_size=AVAILABILITY_JOB_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._runs = 0
+        self._last_run = None
+        self._last_error = None
+
+    # ----------------------------------------------------- Scheduling
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='availability-job', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _loop(self):
+        # Catch up on start, then run shortly after every midnight
+        background.run_loop(self._stop, self._run_daily, self._wait, self._record_error)
+
+    def _run_daily(self):
+        subscription.prune_change_log(CHANGE_LOG_RETENTION_DAYS)
+        return self.run()
+
+    def _wait(self, result):
+        now = datetime.now()
+        next_run = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        self._stop.wait((next_run - now).total_seconds() + AVAILABILITY_JOB_DELAY)
+
+    def _record_error(self, error):
+        with self._lock:
+            self._last_error = error
+
+    # ----------------------------------------------------- Job
+    def _progress(self, cur):
+        cur.execute(
+            'SELECT last_completed_date, target_date, cursor FROM job_progress WHERE job = ?',
+            (JOB_NAME,)
+        )
+        return cur.fetchone()
+
+    def _save_progress(self, cur, last_completed, target, cursor):
+        cur.execute(
+            ''' INSERT INTO job_progress (job, last_completed_date, target_date, cursor, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (job) DO UPDATE SET
+                last_completed_date = excluded.last_completed_date,
+                target_date = excluded.target_date,
+                cursor = excluded.cursor,
+                updated_at = excluded.updated_at ''',
+            (JOB_NAME, last_completed, target, cursor)
+        )
+
+    def _changed_cars(self, cur, since, today, after_car_id):
+        # Subscriptions starting after `since` up to today, or ending on
+        # `since` up to yesterday, are the only ones whose state differs.
+        # Both are range scans on the date indexes, which can't also page by
+        # car_id, so the few cars of a day are deduplicated and paged here
+        car_ids = set()
+        cur.execute(
+            f''' SELECT car_id FROM {TABLE_NAME}
+            WHERE subscription_start_date > ? AND subscription_start_date <= ? ''',
+            (since, today)
+        )
+        car_ids.update(row[0] for row in cur)
+        cur.execute(
+            f''' SELECT car_id FROM {TABLE_NAME}
+            WHERE subscription_end_date >= ? AND subscription_end_date < ? ''',
+            (since, today)
+        )
+        car_ids.update(row[0] for row in cur)
+
+        return sorted(car_id for car_id in car_ids if car_id is not None and car_id > after_car_id)[:self.chunk_size]
+
+    def run(self, today=None):
+        today = (today or date.today()).isoformat()
+        started = time.perf_counter()
+        checked = 0
+        changed = 0
+        chunks = 0
+
+        while True:
+            with db.connection() as conn:
+                cur = conn.cursor()
+                # Serializes runs across workers; a second one finds the
+                # progress already advanced
+                cur.execute('BEGIN IMMEDIATE')
+
+                progress = self._progress(cur)
+                last_completed = progress['last_completed_date'] if progress else None
+                if last_completed is None:
+                    # First run: nothing is known about earlier days
+                    last_completed = (date.fromisoformat(today) - timedelta(days=1)).isoformat()
+                if last_completed >= today:
+                    break
+
+                # Resume an interrupted run for today. One interrupted on an
+                # earlier day starts over with the range widened to today
+                resuming = progress is not None and progress['target_date'] == today and progress['cursor'] is not None
+                cursor = progress['cursor'] if resuming else -1
+
+                car_ids = self._changed_cars(cur, last_completed, today, cursor)
+                for car_id in car_ids:
+                    before = subscription.car_is_available(cur, car_id, last_completed)
+                    after = subscription.car_is_available(cur, car_id, today)
+                    if before != after:
+                        subscription.queue_car_availability(cur, car_id, after)
+                        changed += 1
+
+                checked += len(car_ids)
+                chunks += 1
+
+                if len(car_ids) < self.chunk_size:
+                    self._save_progress(cur, today, None, None)
+                else:
+                    self._save_progress(cur, progress['last_completed_date'] if progress else None, today, car_ids[-1])
+                    continue
+                break
+
+        seconds = time.perf_counter() - started
+        with self._lock:
+            if chunks:
+                self._runs += 1
+                self._last_run = {
+                    "date": today,
+                    "finished_at": datetime.now().isoformat(timespec='seconds'),
+                    "seconds": round(seconds, 3),
+                    "chunks": chunks,
+                    "cars_checked": checked,
+                    "cars_changed": changed,
+                }
+                self._last_error = None
+
+        if changed:
+            outbox.dispatcher.notify()
+
+        return {"date": today, "cars_checked": checked, "cars_changed": changed, "seconds": round(seconds, 3)}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self._thread is not None and self._thread.is_alive(),
+                "runs": self._runs,
+                "last_run": self._last_run,
+                "last_error": self._last_error,
+            }
+
+availability_job = AvailabilityJob()
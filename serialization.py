@@ -0,0 +1,194 @@
+import json
+import os
+import zlib
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from operator import itemgetter
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+from dotenv import load_dotenv
+from db import RowSet
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Load environment variables from .env file
+load_dotenv()
+# auto uses orjson if it is installed and the standard library otherwise
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto')
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 1))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 4))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/html')
+
+def _encoder():
+    if JSON_ENCODER not in ('auto', 'orjson', 'stdlib'):
+        raise RuntimeError(f"JSON_ENCODER must be auto, orjson or stdlib, not '{JSON_ENCODER}'")
+    if JSON_ENCODER == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_ENCODER is orjson, but orjson is not installed')
+    return 'orjson' if orjson is not None and JSON_ENCODER != 'stdlib' else 'stdlib'
+
+ENCODER = _encoder()
+
+if orjson is not None:
+    # Dates go to Flask's default like with jsonify (HTTP dates, not ISO 8601)
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    ORJSON_SORTED_OPTIONS = ORJSON_OPTIONS | orjson.OPT_SORT_KEYS
+
+# ----------------------------------------------------- Encoding
+# The output is the same as jsonify's: compact, with sorted keys
+def _default(obj):
+    if isinstance(obj, RowSet):
+        return list(obj)
+    return DefaultJSONProvider.default(obj)
+
+def dumps(obj):
+    if isinstance(obj, RowSet):
+        return b'[' + encode_rows(obj) + b']'
+    if ENCODER == 'orjson':
+        return orjson.dumps(obj, default=_default, option=ORJSON_SORTED_OPTIONS)
+    return json.dumps(obj, default=_default, sort_keys=True, separators=(',', ':')).encode()
+
+@lru_cache(maxsize=64)
+def _layout(fields):
+    # The keys in sorted order, a getter taking a row's values in that order
+    # and the stdlib template of one encoded row, e.g. '{"car_id":%s,...}'
+    order = sorted(range(len(fields)), key=fields.__getitem__)
+    keys = tuple(fields[i] for i in order)
+    getter = itemgetter(*order) if len(order) > 1 else lambda row, i=order[0]: (row[i],)
+    template = '{' + ','.join(encode_basestring_ascii(key).replace('%', '%%') + ':%s' for key in keys) + '}'
+    return keys, getter, template
+
+def _value(value):
+    kind = type(value)
+    if kind is str:
+        return encode_basestring_ascii(value)
+    if value is None:
+        return 'null'
+    if kind is int:
+        return int.__repr__(value)
+    if kind is float and value - value == 0.0:
+        return float.__repr__(value)
+    return json.dumps(value, default=_default, sort_keys=True, separators=(',', ':'))
+
+def _encode_column(values):
+    # A column usually holds one type, so it is encoded by a C function
+    # mapped over it, or through a memo of its distinct values when there
+    # are NULLs too. Only values of one type share a memo, as 1 == 1.0 == True
+    types = set(map(type, values))
+    if types == {int}:
+        return list(map(int.__repr__, values))
+    if types == {str}:
+        return list(map(encode_basestring_ascii, values))
+    if len(types - {type(None)}) <= 1 and types <= {int, float, str, type(None)}:
+        memo = {value: _value(value) for value in set(values)}
+        return list(map(memo.__getitem__, values))
+    return list(map(_value, values))
+
+def encode_rows(rows, separator=','):
+    """Encode the rows of a RowSet as JSON objects joined by `separator`.
+
+    orjson gets one short-lived dict per row, which is faster than any
+    template in Python. Without it the values are encoded a column at a
+    time and formatted into a template built once per set of columns,
+    which skips the dicts and json.dumps' per-value dispatch (see
+    benchmarks/bench_serialization.py)"""
+    keys, getter, template = _layout(rows.fields)
+
+    if ENCODER == 'orjson':
+        if separator == ',':
+            encoded = orjson.dumps([dict(zip(keys, getter(row))) for row in rows.rows], default=_default, option=ORJSON_OPTIONS)
+            return encoded[1:-1]
+        return separator.encode().join(
+            [orjson.dumps(dict(zip(keys, getter(row))), default=_default, option=ORJSON_OPTIONS) for row in rows.rows]
+        )
+
+    columns = [_encode_column(column) for column in zip(*map(getter, rows.rows))]
+    return separator.join([template % values for values in zip(*columns)]).encode()
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, with jsonify encoding through dumps above.
+    Debug mode keeps Flask's indented output"""
+
+    default = staticmethod(_default)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b'\n', mimetype=self.mimetype)
+
+# ----------------------------------------------------- Compression
+def _negotiate():
+    # br is only offered when the brotli package is installed
+    offered = ('br', 'gzip') if brotli is not None else ('gzip',)
+    return request.accept_encodings.best_match(offered)
+
+def compress_bytes(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return zlib.compress(data, GZIP_LEVEL, wbits=31)
+
+def _compress_stream(chunks, encoding):
+    # Every chunk is flushed, so a client reading the stream gets the rows
+    # of a chunk as soon as it is sent
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def compress(response):
+    """after_request hook compressing JSON and text responses for clients
+    accepting gzip, or br when brotli is installed"""
+    if (response.mimetype not in COMPRESSIBLE_TYPES or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+
+    encoding = _negotiate()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    elif (response.content_length or 0) >= COMPRESS_MIN_BYTES:
+        response.set_data(compress_bytes(response.get_data(), encoding))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the ones the ETag was made from, so
+    # it becomes weak. If-None-Match compares weakly, so it still matches
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
@@ -0,0 +1,72 @@
+from flask import Flask, jsonify, request, make_response
+import datetime
+import random
+import time
+import os
+import jwt
+
+# Local stand-in for the admin gateway, used to exercise gateway.py and to
+# load test the service without the real car microservice:
+#   STUB_LATENCY_MS=20 python stub_gateway.py
+# and point ADMIN_GATEWAY_URL at http://localhost:5099
+STUB_PORT = int(os.getenv('STUB_PORT', 5099))
+STUB_LATENCY_MS = float(os.getenv('STUB_LATENCY_MS', 0))
+STUB_FAILURE_RATE = float(os.getenv('STUB_FAILURE_RATE', 0))
+STUB_TOKEN_TTL = int(os.getenv('STUB_TOKEN_TTL', 3600))
+STUB_SECRET = os.getenv('STUB_SECRET', 'stub-secret')
+
+app = Flask(__name__)
+cars = {}
+logins = 0
+
+@app.before_request
+def simulate_gateway():
+    if STUB_LATENCY_MS:
+        time.sleep(STUB_LATENCY_MS / 1000)
+    if random.random() < STUB_FAILURE_RATE:
+        return jsonify({"message": "Simulated gateway failure"}), 503
+
+def _authorized():
+    try:
+        jwt.decode(request.cookies.get('Authorization', ''), STUB_SECRET, algorithms=['HS256'])
+        return True
+    except jwt.InvalidTokenError:
+        return False
+
+@app.route('/user/login', methods=['POST'])
+def login():
+    global logins
+    data = request.get_json(silent=True) or {}
+    if not data.get('email'):
+        return jsonify({"message": "Invalid credentials"}), 401
+
+    logins += 1
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    token = jwt.encode(
+        {'sub': data['email'], 'roles': ['admin'], 'iat': now, 'exp': now + datetime.timedelta(seconds=STUB_TOKEN_TTL)},
+        STUB_SECRET, algorithm='HS256'
+    )
+    response = make_response(jsonify({"message": "Login successful"}))
+    response.set_cookie('Authorization', token)
+    return response
+
+@app.route('/car/cars/<int:car_id>', methods=['GET'])
+def get_car(car_id):
+    if not _authorized():
+        return jsonify({"message": "Token is invalid or expired"}), 401
+    return jsonify(cars.get(car_id, {"car_id": car_id, "brand": "Stub", "model": f"Model {car_id}", "is_available": True}))
+
+@app.route('/car/cars/<int:car_id>', methods=['PATCH'])
+def patch_car(car_id):
+    if not _authorized():
+        return jsonify({"message": "Token is invalid or expired"}), 401
+    car = cars.setdefault(car_id, {"car_id": car_id, "brand": "Stub", "model": f"Model {car_id}", "is_available": True})
+    car.update(request.get_json(silent=True) or {})
+    return jsonify({"message": "Car updated", "car": car})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"logins": logins, "cars": len(cars)})
+
+if __name__ == '__main__':
+    app.run(host='127.0.0.1', port=STUB_PORT, threaded=True)
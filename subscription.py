@@ -1,16 +1,375 @@
 import sqlite3
-from datetime import datetime
-import csv
-from dotenv import load_dotenv
-import os
-
-# Load environment variables from .env file
-load_dotenv()
-DB_PATH = os.getenv('DB_PATH', "subscriptions.db")
+import threading
+import time
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import db
+import cache
+import metrics
+
 TABLE_NAME = "subscriptions"
+OUTBOX_TABLE = "car_availability_outbox"
+DEAD_LETTER_TABLE = "car_availability_dead_letters"
+CHANGES_TABLE = "subscription_changes"
+REPLICATION_TABLE = "replication_state"
+COLUMNS = (
+    'subscription_id',
+    'car_id',
+    'subscription_start_date',
+    'subscription_end_date',
+    'subscription_duration_months',
+    'km_driven_during_subscription',
+    'contracted_km',
+    'monthly_subscription_price',
+    'delivery_location',
+    'has_delivery_insurance',
+    'version',
+)
+INSERT_QUERY = f''' INSERT OR IGNORE INTO {TABLE_NAME} 
+    ( 
+        car_id, 
+        subscription_start_date, 
+        subscription_end_date, 
+        subscription_duration_months, 
+        km_driven_during_subscription, 
+        contracted_km, 
+        monthly_subscription_price, 
+        delivery_location, 
+        has_delivery_insurance 
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '''
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+STREAM_BATCH_SIZE = 500
+# Free windows are looked up this far ahead when no end date is given
+FREE_WINDOWS_DAYS = 365
+AVAILABILITY_FIELDS = ('car_id', 'subscription_start_date', 'subscription_end_date')
+
+AGGREGATE_TABLES = ('agg_active_price_deltas', 'agg_monthly_revenue', 'agg_km_overage')
+AGGREGATED_COLUMNS = (
+    'subscription_start_date',
+    'subscription_end_date',
+    'km_driven_during_subscription',
+    'contracted_km',
+    'monthly_subscription_price',
+    'delivery_location',
+)
+
+def _aggregate_statements(row, sign):
+    # Adds (sign 1) or removes (sign -1) one subscription from the aggregate
+    # tables. Used by the triggers below with row NEW or OLD.
+    # - agg_active_price_deltas: +price on the start date and -price on the
+    #   day after the end date, so the sum up to a day is the monthly price
+    #   of the subscriptions active on that day
+    # - agg_monthly_revenue: the monthly price for every month billed, from
+    #   the start month up to but not including the end month (at least one)
+    # - agg_km_overage: km driven over the contracted km per location
+    start, end = f'{row}.subscription_start_date', f'{row}.subscription_end_date'
+    price = f'COALESCE({row}.monthly_subscription_price, 0)'
+    location = f"COALESCE({row}.delivery_location, '')"
+    km_driven = f'COALESCE({row}.km_driven_during_subscription, 0)'
+    contracted_km = f'COALESCE({row}.contracted_km, 0)'
+    return [
+        f'''INSERT INTO agg_active_price_deltas (day, price_delta, count_delta)
+        SELECT {start}, {sign} * {price}, {sign}
+        WHERE {start} IS NOT NULL AND {end} >= {start}
+        UNION ALL
+        SELECT date({end}, '+1 day'), {-sign} * {price}, {-sign}
+        WHERE {start} IS NOT NULL AND {end} >= {start} AND date({end}, '+1 day') IS NOT NULL
+        ON CONFLICT (day) DO UPDATE SET
+            price_delta = price_delta + excluded.price_delta,
+            count_delta = count_delta + excluded.count_delta''',
+        f'''INSERT INTO agg_monthly_revenue (month, delivery_location, revenue, subscriptions)
+        SELECT month, {location}, {sign} * {price}, {sign}
+        FROM calendar_months
+        WHERE {end} >= {start}
+        AND month >= substr({start}, 1, 7)
+        AND (month < substr({end}, 1, 7) OR month = substr({start}, 1, 7))
+        ON CONFLICT (month, delivery_location) DO UPDATE SET
+            revenue = revenue + excluded.revenue,
+            subscriptions = subscriptions + excluded.subscriptions''',
+        f'''INSERT INTO agg_km_overage (delivery_location, subscriptions, over_contracted, overage_km, km_driven, contracted_km)
+        SELECT {location}, {sign}, {sign} * ({km_driven} > {contracted_km}),
+            {sign} * MAX({km_driven} - {contracted_km}, 0), {sign} * {km_driven}, {sign} * {contracted_km}
+        WHERE true
+        ON CONFLICT (delivery_location) DO UPDATE SET
+            subscriptions = subscriptions + excluded.subscriptions,
+            over_contracted = over_contracted + excluded.over_contracted,
+            overage_km = overage_km + excluded.overage_km,
+            km_driven = km_driven + excluded.km_driven,
+            contracted_km = contracted_km + excluded.contracted_km''',
+    ]
+
+def _aggregate_cleanup_statements(row):
+    # Drops the aggregate rows a removed subscription emptied
+    location = f"COALESCE({row}.delivery_location, '')"
+    return [
+        f'''DELETE FROM agg_active_price_deltas
+        WHERE day IN ({row}.subscription_start_date, date({row}.subscription_end_date, '+1 day'))
+        AND price_delta = 0 AND count_delta = 0''',
+        f'DELETE FROM agg_monthly_revenue WHERE delivery_location = {location} AND subscriptions = 0',
+        f'DELETE FROM agg_km_overage WHERE delivery_location = {location} AND subscriptions = 0',
+    ]
+
+# Each aggregate table computed from scratch, mirroring what the triggers
+# maintain. Fills the tables when migration 4 creates them on a database
+# that already has subscriptions, and is compared against them by
+# analytics.reconcile_aggregates
+EXPECTED_AGGREGATES = {
+    'agg_active_price_deltas': f''' SELECT day, SUM(price_delta), SUM(count_delta) FROM (
+            SELECT subscription_start_date AS day,
+                COALESCE(monthly_subscription_price, 0) AS price_delta, 1 AS count_delta
+            FROM {TABLE_NAME}
+            WHERE subscription_start_date IS NOT NULL AND subscription_end_date >= subscription_start_date
+            UNION ALL
+            SELECT date(subscription_end_date, '+1 day'), -COALESCE(monthly_subscription_price, 0), -1
+            FROM {TABLE_NAME}
+            WHERE subscription_start_date IS NOT NULL AND subscription_end_date >= subscription_start_date
+            AND date(subscription_end_date, '+1 day') IS NOT NULL
+        )
+        GROUP BY day
+        HAVING SUM(price_delta) != 0 OR SUM(count_delta) != 0 ''',
+    'agg_monthly_revenue': f''' SELECT m.month, COALESCE(s.delivery_location, ''),
+            SUM(COALESCE(s.monthly_subscription_price, 0)), COUNT(*)
+        FROM {TABLE_NAME} s
+        JOIN calendar_months m
+            ON m.month >= substr(s.subscription_start_date, 1, 7)
+            AND (m.month < substr(s.subscription_end_date, 1, 7) OR m.month = substr(s.subscription_start_date, 1, 7))
+        WHERE s.subscription_end_date >= s.subscription_start_date
+        GROUP BY 1, 2 ''',
+    'agg_km_overage': f''' SELECT COALESCE(delivery_location, ''), COUNT(*),
+            SUM(COALESCE(km_driven_during_subscription, 0) > COALESCE(contracted_km, 0)),
+            SUM(MAX(COALESCE(km_driven_during_subscription, 0) - COALESCE(contracted_km, 0), 0)),
+            SUM(COALESCE(km_driven_during_subscription, 0)),
+            SUM(COALESCE(contracted_km, 0))
+        FROM {TABLE_NAME}
+        GROUP BY 1 ''',
+}
+
+def _trigger(name, event, statements):
+    body = ';\n    '.join(statements)
+    return f'CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {TABLE_NAME}\nBEGIN\n    {body};\nEND'
+
+# Versioned schema changes, applied in order on top of the base table.
+# The applied version is tracked in PRAGMA user_version
+MIGRATIONS = [
+    (1, [
+        f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_car_dates ON {TABLE_NAME} (car_id, subscription_start_date, subscription_end_date)',
+        f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_start_end ON {TABLE_NAME} (subscription_start_date, subscription_end_date)',
+        f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_end ON {TABLE_NAME} (subscription_end_date)',
+        f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_location_start ON {TABLE_NAME} (delivery_location, subscription_start_date)',
+        f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_price ON {TABLE_NAME} (monthly_subscription_price)',
+        f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_insurance_start ON {TABLE_NAME} (has_delivery_insurance, subscription_start_date)',
+        f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_km_overage ON {TABLE_NAME} ((km_driven_during_subscription - contracted_km))',
+    ]),
+    # Car availability updates waiting to be sent to the car service, see
+    # outbox.py. One row per car, so only the latest value is delivered
+    (2, [
+        f'''CREATE TABLE IF NOT EXISTS {OUTBOX_TABLE} 
+        (
+            car_id INTEGER PRIMARY KEY, 
+            is_available BOOLEAN NOT NULL, 
+            version INTEGER NOT NULL DEFAULT 1, 
+            attempts INTEGER NOT NULL DEFAULT 0, 
+            next_attempt_at REAL NOT NULL DEFAULT 0, 
+            last_error TEXT, 
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''',
+        f'CREATE INDEX IF NOT EXISTS idx_{OUTBOX_TABLE}_next_attempt ON {OUTBOX_TABLE} (next_attempt_at)',
+    ]),
+    # Progress of scheduled jobs, so an interrupted run resumes where it stopped
+    (3, [
+        '''CREATE TABLE IF NOT EXISTS job_progress 
+        (
+            job TEXT PRIMARY KEY, 
+            last_completed_date TEXT, 
+            target_date TEXT, 
+            cursor INTEGER, 
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+    # Revenue and km overage aggregates, kept up to date by triggers on every
+    # write, see _aggregate_statements and analytics.py
+    (4, [
+        '''CREATE TABLE IF NOT EXISTS calendar_months (month TEXT PRIMARY KEY) WITHOUT ROWID''',
+        '''INSERT OR IGNORE INTO calendar_months (month)
+        WITH RECURSIVE months (day) AS (
+            SELECT '1970-01-01'
+            UNION ALL
+            SELECT date(day, '+1 month') FROM months WHERE day < '2199-12-01'
+        )
+        SELECT substr(day, 1, 7) FROM months''',
+        '''CREATE TABLE IF NOT EXISTS agg_active_price_deltas 
+        (
+            day TEXT PRIMARY KEY, 
+            price_delta INTEGER NOT NULL, 
+            count_delta INTEGER NOT NULL
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS agg_monthly_revenue 
+        (
+            month TEXT NOT NULL, 
+            delivery_location TEXT NOT NULL, 
+            revenue INTEGER NOT NULL, 
+            subscriptions INTEGER NOT NULL, 
+            PRIMARY KEY (month, delivery_location)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS agg_km_overage 
+        (
+            delivery_location TEXT PRIMARY KEY, 
+            subscriptions INTEGER NOT NULL, 
+            over_contracted INTEGER NOT NULL, 
+            overage_km INTEGER NOT NULL, 
+            km_driven INTEGER NOT NULL, 
+            contracted_km INTEGER NOT NULL
+        ) WITHOUT ROWID''',
+        # Existing subscriptions, before the triggers take over
+        *(f'INSERT INTO {table} {query}' for table, query in EXPECTED_AGGREGATES.items()),
+        _trigger(f'trg_{TABLE_NAME}_aggregates_insert', 'INSERT', _aggregate_statements('NEW', 1)),
+        _trigger(
+            f'trg_{TABLE_NAME}_aggregates_update', f'UPDATE OF {", ".join(AGGREGATED_COLUMNS)}',
+            _aggregate_statements('OLD', -1) + _aggregate_statements('NEW', 1) + _aggregate_cleanup_statements('OLD')
+        ),
+        _trigger(
+            f'trg_{TABLE_NAME}_aggregates_delete', 'DELETE',
+            _aggregate_statements('OLD', -1) + _aggregate_cleanup_statements('OLD')
+        ),
+    ]),
+    # Log of changed subscription ids, so in-memory copies of the table
+    # (see columnar.py) can refresh just the rows that changed
+    (5, [
+        f'''CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} 
+        (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, 
+            subscription_id INTEGER NOT NULL, 
+            op TEXT NOT NULL, 
+            changed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''',
+        _trigger(f'trg_{TABLE_NAME}_changes_insert', 'INSERT', [
+            f"INSERT INTO {CHANGES_TABLE} (subscription_id, op) VALUES (NEW.subscription_id, 'insert')"
+        ]),
+        _trigger(f'trg_{TABLE_NAME}_changes_update', 'UPDATE', [
+            f"INSERT INTO {CHANGES_TABLE} (subscription_id, op) VALUES (NEW.subscription_id, 'update')"
+        ]),
+        _trigger(f'trg_{TABLE_NAME}_changes_delete', 'DELETE', [
+            f"INSERT INTO {CHANGES_TABLE} (subscription_id, op) VALUES (OLD.subscription_id, 'delete')"
+        ]),
+    ]),
+    # Bumped by every update, for optimistic concurrency, see _update
+    (6, [
+        f'ALTER TABLE {TABLE_NAME} ADD COLUMN version INTEGER NOT NULL DEFAULT 1',
+    ]),
+    # How far a read replica has copied the primary's change log, see
+    # replication.py. A single row, unused on the primary
+    (7, [
+        f'''CREATE TABLE IF NOT EXISTS {REPLICATION_TABLE} 
+        (
+            id INTEGER PRIMARY KEY CHECK (id = 1), 
+            applied_seq INTEGER, 
+            primary_seq INTEGER, 
+            caught_up_at REAL, 
+            leader TEXT, 
+            lease_until REAL NOT NULL DEFAULT 0, 
+            last_error TEXT, 
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''',
+        f'INSERT OR IGNORE INTO {REPLICATION_TABLE} (id) VALUES (1)',
+    ]),
+    # Outbox updates the dispatcher gave up on: rejected by the car service
+    # or out of attempts. The last one per car, kept for inspection
+    (8, [
+        f'''CREATE TABLE IF NOT EXISTS {DEAD_LETTER_TABLE} 
+        (
+            car_id INTEGER PRIMARY KEY, 
+            is_available BOOLEAN NOT NULL, 
+            attempts INTEGER NOT NULL, 
+            last_error TEXT, 
+            created_at TEXT NOT NULL, 
+            failed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+]
+
+# Cache for the hot read paths, invalidated by every write below
+_cache = cache.TTLCache()
+# Concurrent misses on the same cache key share one query, see _cached
+_flights = cache.SingleFlight()
+# Last change log seq this process has applied to its cache, when it was
+# last checked, and a lock so only one thread checks at a time, see _sync_cache
+_seen_seq = None
+_synced_at = 0.0
+_sync_lock = threading.Lock()
+# Changes read per check. A process further behind drops its whole cache
+SYNC_BATCH_SIZE = 1000
+
+def _date(value):
+    # Dates are compared as text, so only the zero-padded form is accepted
+    if datetime.strptime(value, '%Y-%m-%d').date().isoformat() != value:
+        raise ValueError(f"'{value}' is not a date in the format YYYY-MM-DD")
+    return value
+
+def _bool(value):
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError(f"'{value}' is not a boolean")
+
+def _int_value(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        return int(value)
+    raise ValueError(f"'{value}' is not an integer")
+
+def _date_value(value):
+    if not isinstance(value, str):
+        raise ValueError(f"'{value}' is not a date in the format YYYY-MM-DD")
+    return _date(value)
+
+def _bool_value(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        return _bool(value)
+    raise ValueError(f"'{value}' is not a boolean")
+
+def _text_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    raise ValueError(f"'{value}' is not a string")
+
+# Fields a PATCH may change -> value parser, in column order
+UPDATE_FIELDS = {
+    'car_id': _int_value,
+    'subscription_start_date': _date_value,
+    'subscription_end_date': _date_value,
+    'subscription_duration_months': _int_value,
+    'km_driven_during_subscription': _int_value,
+    'contracted_km': _int_value,
+    'monthly_subscription_price': _int_value,
+    'delivery_location': _text_value,
+    'has_delivery_insurance': _bool_value,
+}
+
+# Query parameter -> (WHERE clause, value parser). Every clause is backed by
+# an index from MIGRATIONS, see check_query_plans()
+FILTERS = {
+    'car_id': ('car_id = ?', int),
+    'location': ('delivery_location = ?', str),
+    'start_from': ('subscription_start_date >= ?', _date),
+    'start_to': ('subscription_start_date <= ?', _date),
+    'end_from': ('subscription_end_date >= ?', _date),
+    'end_to': ('subscription_end_date <= ?', _date),
+    'active_on': ('subscription_start_date <= ? AND subscription_end_date >= ?', _date),
+    'min_price': ('monthly_subscription_price >= ?', int),
+    'max_price': ('monthly_subscription_price <= ?', int),
+    'has_delivery_insurance': ('has_delivery_insurance = ?', _bool),
+    'over_contracted_km': ('(km_driven_during_subscription - contracted_km) {} 0', _bool),
+}
 
 def create_table(): 
-    with sqlite3.connect(DB_PATH) as conn: 
+    with db.connection() as conn: 
         cur = conn.cursor() 
         cur.execute(
             f'''CREATE TABLE IF NOT EXISTS {TABLE_NAME} 
@@ -27,107 +386,450 @@ def create_table():
                 has_delivery_insurance BOOLEAN DEFAULT FALSE 
             )'''
         )
-create_table()
-
-def _add_csv_to_db():
-    try: 
-        with sqlite3.connect(DB_PATH) as conn: 
-            cur = conn.cursor() 
-            # Open the CSV file 
-            with open('subscriptions.csv', 'r') as file: 
-                reader = csv.DictReader(file) 
-                for row in reader: 
-                    # Parse the dates from DD/MM/YYYY to YYYY-MM-DD 
-                    start_date = datetime.strptime(row['SubscriptionStartDate'], '%d/%m/%Y').strftime('%Y-%m-%d') 
-                    end_date = datetime.strptime(row['SubscriptionEndDate'], '%d/%m/%Y').strftime('%Y-%m-%d') 
-                    
-                    cur.execute( 
-                        f''' INSERT OR IGNORE INTO {TABLE_NAME} 
-                        ( 
-                            car_id, 
-                            subscription_start_date, 
-                            subscription_end_date, 
-                            subscription_duration_months, 
-                            km_driven_during_subscription, 
-                            contracted_km, 
-                            monthly_subscription_price, 
-                            delivery_location, 
-                            has_delivery_insurance 
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ''', 
-                        ( 
-                            row['CarId'], 
-                            start_date, 
-                            end_date, 
-                            row['SubscriptionDurationMonths'], 
-                            row['KmDrivenDuringSubscription'], 
-                            row['ContractedKm'], 
-                            row['MonthlySubscriptionPrice'], 
-                            row['DeliveryLocation'], 
-                            row['HasDeliveryInsurance'] == 'TRUE'
-                        ) 
-                    )
-                    
-        return [201, {"message": "CSV data imported successfully"}] 
-    
-    except sqlite3.Error as e: return [500, {"error": str(e)}]
-        
+    return migrate()
+
+def migrate():
+    with db.connection() as conn:
+        # Take the write lock before reading the version so concurrent
+        # workers don't apply the same migration twice
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+        for number, statements in MIGRATIONS:
+            if number > version:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+                version = number
+
+    return version
+
+def _car_id(cur, id):
+    cur.execute(f'SELECT car_id FROM {TABLE_NAME} WHERE subscription_id = ?', (id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def car_is_available(cur, car_id, day):
+    # A car is available unless one of its subscriptions is active on `day`
+    cur.execute(
+        f''' SELECT NOT EXISTS (
+            SELECT 1 FROM {TABLE_NAME} 
+            WHERE car_id = ? 
+            AND subscription_start_date <= ? 
+            AND subscription_end_date >= ? 
+        ) ''',
+        (car_id, day, day)
+    )
+    return bool(cur.fetchone()[0])
+
+def find_booking_conflict(cur, car_id, start, end, exclude_id=None):
+    # Returns (subscription_id, start, end) of a subscription of the car
+    # overlapping start..end, or None. The end date is the handover day,
+    # so a subscription may start on the day the previous one ends and end
+    # on the day the next one starts. Served from
+    # idx_subscriptions_car_dates alone: a seek to the car, a range on the
+    # start date and the end date compared in the index entries. Callers
+    # hold the write lock (BEGIN IMMEDIATE), so no booking can slip in
+    # between the check and their write
+    if car_id is None or start is None or end is None:
+        return None
+
+    cur.execute(
+        f''' SELECT subscription_id, subscription_start_date, subscription_end_date 
+        FROM {TABLE_NAME} 
+        WHERE car_id = ? 
+        AND subscription_start_date < ? 
+        AND subscription_end_date > ? 
+        AND subscription_id IS NOT ? 
+        LIMIT 1 ''',
+        (car_id, end, start, exclude_id)
+    )
+    row = cur.fetchone()
+    return tuple(row) if row else None
+
+def _booking_conflict(cur, data, exclude_id=None):
+    row = find_booking_conflict(
+        cur, data.get('car_id'), data.get('subscription_start_date'), data.get('subscription_end_date'), exclude_id
+    )
+    if row is None:
+        return None
+
+    return {
+        "error": f"Car {data.get('car_id')} is already subscribed from {row[1]} to {row[2]}",
+        "conflicting_subscription_id": row[0],
+    }
+
+def queue_car_availability(cur, car_id, is_available):
+    # Queued in the caller's transaction. A newer value for the same car
+    # replaces a pending one and is retried from scratch
+    cur.execute(
+        f''' INSERT INTO {OUTBOX_TABLE} (car_id, is_available) VALUES (?, ?) 
+        ON CONFLICT (car_id) DO UPDATE SET 
+            is_available = excluded.is_available, 
+            version = version + 1, 
+            attempts = 0, 
+            next_attempt_at = 0, 
+            last_error = NULL ''',
+        (car_id, is_available)
+    )
+
+def _enqueue_car_availability(cur, car_ids):
+    queued = []
+    today = _today()
+
+    for car_id in dict.fromkeys(car_ids):
+        if car_id is None:
+            continue
+
+        queue_car_availability(cur, car_id, car_is_available(cur, car_id, today))
+        queued.append(car_id)
+
+    return queued
+
+def _insert(cur, data):
+    cur.execute(
+        INSERT_QUERY, 
+        (
+            data.get('car_id'), 
+            data.get('subscription_start_date'), 
+            data.get('subscription_end_date'), 
+            data.get('subscription_duration_months', 3), 
+            data.get('km_driven_during_subscription'), 
+            data.get('contracted_km'), 
+            data.get('monthly_subscription_price'), 
+            data.get('delivery_location'), 
+            data.get('has_delivery_insurance', False)
+        )
+    )
+    id = cur.lastrowid
+
+    return id, _enqueue_car_availability(cur, [data.get('car_id')])
+
+def _parse_create(data):
+    # Checks the fields of a new subscription with the same parsers as a
+    # PATCH. Missing or null fields keep their column defaults
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
+
+    parsed = {}
+    for field, parse in UPDATE_FIELDS.items():
+        if data.get(field) is None:
+            continue
+        try:
+            parsed[field] = parse(data[field])
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid value for '{field}': {e}") from None
+
+    start, end = parsed.get('subscription_start_date'), parsed.get('subscription_end_date')
+    if start is not None and end is not None and end < start:
+        raise ValueError("Subscription ends before it starts")
+
+    return parsed
+
+@metrics.timed('db')
 def add_subscription(data):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        data = _parse_create(data)
+        with db.connection() as conn:
             cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+
+            conflict = _booking_conflict(cur, data)
+            if conflict:
+                return [409, conflict]
             
-            cur.execute(
-                f''' INSERT OR IGNORE INTO {TABLE_NAME} 
-                ( 
-                    car_id, 
-                    subscription_start_date, 
-                    subscription_end_date, 
-                    subscription_duration_months, 
-                    km_driven_during_subscription, 
-                    contracted_km, 
-                    monthly_subscription_price, 
-                    delivery_location, 
-                    has_delivery_insurance 
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ''', 
-                (
-                    data.get('car_id'), 
-                    data.get('subscription_start_date'), 
-                    data.get('subscription_end_date'), 
-                    data.get('subscription_duration_months', 3), 
-                    data.get('km_driven_during_subscription'), 
-                    data.get('contracted_km'), 
-                    data.get('monthly_subscription_price'), 
-                    data.get('delivery_location'), 
-                    data.get('has_delivery_insurance', False)
-                )
-            )
+            id, queued = _insert(cur, data)
+
+        _invalidate(id, data)
 
-        return [201, {"message": "New subscription added to database"}]
+        result = {"message": "New subscription added to database"}
+        if queued:
+            result["car_update"] = {"status": "queued", "car_ids": queued}
+
+        return [201, result]
+
+    except ValueError as e:
+        return [400, {"error": str(e)}]
 
     except sqlite3.Error as e:
         return [500, {"error": str(e)}]
     
-def get_subscriptions():
+def _filter_clauses(filters):
+    clauses = []
+    params = []
+
+    for name, raw in (filters or {}).items():
+        if name not in FILTERS:
+            raise ValueError(f"Unknown filter: {name}")
+
+        clause, parse = FILTERS[name]
+        try:
+            value = parse(raw)
+        except ValueError:
+            raise ValueError(f"Invalid value for {name}: {raw}")
+
+        if name == 'over_contracted_km':
+            clauses.append(clause.format('>' if value else '<='))
+            continue
+
+        clauses.append(clause)
+        params.extend([value] * clause.count('?'))
+
+    return clauses, params
+
+def _build_select(fields=None, after_id=None, limit=None, filters=None, sort=None, order='asc', max_limit=MAX_PAGE_SIZE):
+    fields = list(fields) if fields else list(COLUMNS)
+    unknown = [field for field in fields if field not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be at least 1" if max_limit is None else f"limit must be between 1 and {max_limit}")
+    if limit is not None and max_limit is not None and limit > max_limit:
+        raise ValueError(f"limit must be between 1 and {max_limit}")
+    if sort is not None and sort not in COLUMNS:
+        raise ValueError(f"Cannot sort by {sort}")
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be 'asc' or 'desc'")
+    if sort is not None and sort != 'subscription_id' and after_id is not None:
+        raise ValueError("after_id can only be combined with the default sort")
+
+    clauses, params = _filter_clauses(filters)
+
+    # With filters present the unary + stops SQLite from walking the table in
+    # rowid order to skip the sort, so the filter's index is used instead
+    cursor_column = '+subscription_id' if clauses else 'subscription_id'
+    if after_id is not None:
+        clauses.append(f'{cursor_column} > ?')
+        params.append(after_id)
+
+    # The cursor column is always selected last so the next page can be found,
+    # but it is only returned when it was asked for
+    query = f"SELECT {', '.join(fields)}, subscription_id FROM {TABLE_NAME}"
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+
+    if sort is None or sort == 'subscription_id':
+        query += f' ORDER BY {cursor_column}' + (' DESC' if order == 'desc' else '')
+    else:
+        sort_column = f'+{sort}' if clauses else sort
+        query += f' ORDER BY {sort_column} {order.upper()}, subscription_id'
+
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    return query, params, fields
+
+@metrics.timed('db', rows=True)
+def get_subscriptions(fields=None, filters=None, sort=None, order='asc'):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        query, params, fields = _build_select(fields, filters=filters, sort=sort, order=order)
+
+        with db.connection() as conn:
             cur = conn.cursor()
             
-            cur.execute(f'SELECT * FROM {TABLE_NAME}')
+            cur.execute(query, params)
             data = cur.fetchall()
             
             if not data:
                 return [404, {"message": "Subscriptions not found"}]
                     
-            return [200, [dict(row) for row in data]]
+            return [200, db.RowSet(fields, data)]
+
+    except ValueError as e:
+        return [400, {"error": str(e)}]
 
     except sqlite3.Error as e:
         return [500, {"error": str(e)}]
-    
+
+@metrics.timed('db', rows='subscriptions')
+def get_subscriptions_page(after_id=None, limit=MAX_PAGE_SIZE, fields=None, filters=None, sort=None, order='asc'):
+    try:
+        query, params, fields = _build_select(fields, after_id, limit, filters, sort, order)
+
+        with db.connection() as conn:
+            cur = conn.cursor()
+
+            cur.execute(query, params)
+            data = cur.fetchall()
+
+            # Keyset cursors only work while walking subscription_id upwards
+            keyset = sort in (None, 'subscription_id') and order == 'asc'
+            next_after_id = data[-1][-1] if keyset and len(data) == limit else None
+
+            return [200, {
+                "subscriptions": db.RowSet(fields, data),
+                "next_after_id": next_after_id
+            }]
+
+    except ValueError as e:
+        return [400, {"error": str(e)}]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+def iter_subscription_batches(after_id=None, fields=None, filters=None, sort=None, order='asc', limit=None):
+    # Validates eagerly, then yields RowSets of up to STREAM_BATCH_SIZE rows
+    # straight from the cursor so memory stays flat regardless of the table
+    # size. A stream has no page size, so limit is only bounded below
+    query, params, fields = _build_select(fields, after_id, limit, filters, sort, order, max_limit=None)
+
+    def batches():
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+
+            while True:
+                batch = cur.fetchmany(STREAM_BATCH_SIZE)
+                if not batch:
+                    break
+                metrics.ROWS.inc(len(batch), name='iter_subscriptions')
+                yield db.RowSet(fields, batch)
+
+    return batches()
+
+def iter_subscriptions(after_id=None, fields=None, filters=None, sort=None, order='asc', limit=None):
+    # Same as above, one row dict at a time
+    batches = iter_subscription_batches(after_id, fields, filters, sort, order, limit)
+    return (row for batch in batches for row in batch)
+
+def check_query_plans():
+    # Runs EXPLAIN QUERY PLAN for every supported filter and returns the ones
+    # that fall back to a full table scan
+    samples = {
+        'car_id': '1',
+        'location': 'Copenhagen',
+        'start_from': '2024-01-01',
+        'start_to': '2024-01-01',
+        'end_from': '2024-01-01',
+        'end_to': '2024-01-01',
+        'active_on': '2024-01-01',
+        'min_price': '1000',
+        'max_price': '1000',
+        'has_delivery_insurance': 'true',
+        'over_contracted_km': 'true',
+    }
+    scans = {}
+
+    with db.connection() as conn:
+        for name in FILTERS:
+            for sort in (None,) + COLUMNS:
+                query, params, _ = _build_select(filters={name: samples[name]}, sort=sort, limit=MAX_PAGE_SIZE)
+                plan = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+                if any(step.startswith('SCAN') for step in plan):
+                    scans[f'{name} sorted by {sort or "subscription_id"}'] = plan
+
+    return scans
+
+def prune_change_log(days):
+    # Readers that fall further behind than this reload in full
+    try:
+        with db.connection() as conn:
+            cur = conn.execute(
+                f"DELETE FROM {CHANGES_TABLE} WHERE changed_at < datetime('now', ?)",
+                (f'-{days} days',)
+            )
+            return [200, {"deleted": cur.rowcount}]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+def _today():
+    # Today's date in ISO format
+    return datetime.now().strftime('%Y-%m-%d')
+
+def _sync_cache():
+    # Every process has its own cache, and a write only invalidates the
+    # cache of the process that made it. At most every CACHE_SYNC_INTERVAL
+    # seconds a read also looks up the change log entries since the last
+    # check, which include writes by other processes (gunicorn workers, an
+    # import from manage.py), and invalidates the subscriptions they name
+    # and today's active entries
+    global _seen_seq, _synced_at
+    if time.monotonic() - _synced_at < cache.CACHE_SYNC_INTERVAL or not _sync_lock.acquire(blocking=False):
+        return
+
+    try:
+        _synced_at = time.monotonic()
+        with db.connection() as conn:
+            row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (CHANGES_TABLE,)).fetchone()
+            seq = row[0] if row else 0
+            if _seen_seq is None or seq - _seen_seq > SYNC_BATCH_SIZE or seq < _seen_seq:
+                _cache.clear()
+                _seen_seq = seq
+                return
+            if seq == _seen_seq:
+                return
+
+            ids = [row[0] for row in conn.execute(
+                f'SELECT subscription_id FROM {CHANGES_TABLE} WHERE seq > ? AND seq <= ?', (_seen_seq, seq)
+            )]
+
+        today = _today()
+        _cache.invalidate(('active', today), ('total_price', today), *(('by_id', id) for id in set(ids)))
+        _seen_seq = seq
+
+    except sqlite3.Error:
+        _cache.clear()
+        _seen_seq = None
+
+    finally:
+        _sync_lock.release()
+
+def _cached(key, load):
+    _sync_cache()
+    result = _cache.get(key)
+    if result is not cache.MISSING:
+        return result
+
+    generation = _cache.generation
+    if not cache.CACHE_COALESCE:
+        return _load(key, load, generation)
+
+    # A burst of misses, e.g. right after a write, runs the query once and
+    # the other callers wait for its result. The generation is part of the
+    # key, so a caller arriving after a write never gets a result loaded
+    # before it
+    return _flights.do((key, generation), lambda: _load(key, load, generation))
+
+def _load(key, load, generation):
+    result = load()
+    if result[0] != 500:
+        _cache.set(key, result, generation=generation)
+
+    return result
+
+def _invalidate(id, data=None):
+    # Drops the cached entries a write to subscription `id` can affect. The
+    # active subscription entries are keyed by day, so only today's matter
+    today = _today()
+    keys = [('by_id', id)]
+
+    active = _cache.peek(('active', today))
+    dates_changed = data is not None and (
+        'subscription_start_date' in data or 'subscription_end_date' in data
+    )
+    was_active = active is cache.MISSING or (
+        active[0] == 200 and id in active[1].column('subscription_id')
+    )
+    if dates_changed or was_active:
+        keys += [('active', today), ('total_price', today)]
+
+    _cache.invalidate(*keys)
+
+def clear_cache():
+    _cache.clear()
+
+def cache_stats():
+    return {**_cache.stats(), "coalescing": _flights.stats()}
+
 def get_subscription_by_id(id):
+    return _cached(('by_id', id), lambda: _get_subscription_by_id(id))
+
+@metrics.timed('db', rows=True)
+def _get_subscription_by_id(id):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with db.connection() as conn:
             cur = conn.cursor()
             
             cur.execute(f'SELECT * FROM {TABLE_NAME} WHERE subscription_id = ?', (id,))
@@ -142,13 +844,16 @@ def get_subscription_by_id(id):
         return [500, {"error": str(e)}]
 
 def get_active_subscriptions():
+    today = _today()
+    return _cached(('active', today), lambda: _get_active_subscriptions(today))
+
+@metrics.timed('db', rows=True)
+def _get_active_subscriptions(today):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with db.connection() as conn:
             cur = conn.cursor()
-
-            # Get today's date in ISO format 
-            today = datetime.now().strftime('%Y-%m-%d')
+            # Plain tuples, the RowSet takes the column names once
+            cur.row_factory = None
             
             cur.execute(
                 f''' SELECT * FROM {TABLE_NAME} 
@@ -161,26 +866,27 @@ def get_active_subscriptions():
             if not data:
                 return [404, {"message": "Currently, there are no active subscriptions"}]
                     
-            return [200, [dict(row) for row in data]]
+            return [200, db.RowSet([column[0] for column in cur.description], data)]
 
     except sqlite3.Error as e:
         return [500, {"error": str(e)}]
 
 def get_active_subscriptions_total_price():
+    today = _today()
+    return _cached(('total_price', today), lambda: _get_active_subscriptions_total_price(today))
+
+@metrics.timed('db')
+def _get_active_subscriptions_total_price(today):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with db.connection() as conn:
             cur = conn.cursor()
-
-            # Get today's date in ISO format 
-            today = datetime.now().strftime('%Y-%m-%d')
             
+            # Sum of the price changes up to today, see agg_active_price_deltas
             cur.execute(
-                f''' SELECT SUM(monthly_subscription_price) as total_price
-                FROM {TABLE_NAME} 
-                WHERE subscription_start_date <= ? 
-                AND subscription_end_date >= ? ''', 
-                (today, today)
+                ''' SELECT SUM(price_delta) as total_price
+                FROM agg_active_price_deltas 
+                WHERE day <= ? ''', 
+                (today,)
             )
             data = cur.fetchone()[0]
             
@@ -192,50 +898,289 @@ def get_active_subscriptions_total_price():
     except sqlite3.Error as e:
         return [500, {"error": str(e)}]
 
+@metrics.timed('db')
+def get_free_windows(car_id, start=None, end=None):
+    # Date ranges between start and end in which the car can be booked. As
+    # in find_booking_conflict, a window starts on the day a subscription
+    # ends and ends on the day the next one starts. Defaults to today and
+    # FREE_WINDOWS_DAYS ahead
+    try:
+        first = date.fromisoformat(_date(start)) if start else date.today()
+        last = date.fromisoformat(_date(end)) if end else first + timedelta(days=FREE_WINDOWS_DAYS)
+    except ValueError:
+        return [400, {"error": "from and to must be dates in the format YYYY-MM-DD"}]
+    if first > last:
+        return [400, {"error": "from must not be after to"}]
+
+    try:
+        with db.connection() as conn:
+            # The same index range as find_booking_conflict, in start order
+            rows = conn.execute(
+                f''' SELECT subscription_id, subscription_start_date, subscription_end_date
+                FROM {TABLE_NAME}
+                WHERE car_id = ?
+                AND subscription_start_date < ?
+                AND subscription_end_date > ?
+                ORDER BY subscription_start_date ''',
+                (car_id, last.isoformat(), first.isoformat())
+            ).fetchall()
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
+
+    # Rows stored before create payloads were validated may hold dates
+    # that don't parse. They are left out and reported instead of failing
+    bookings = []
+    invalid = []
+    for id, booked_from, booked_to in rows:
+        try:
+            bookings.append((date.fromisoformat(booked_from), date.fromisoformat(booked_to)))
+        except (ValueError, TypeError):
+            invalid.append(id)
+
+    windows = []
+    free_from = first
+    for booked_from, booked_to in bookings:
+        if booked_from > free_from:
+            windows.append((free_from, booked_from))
+        # max() because subscriptions from before the overlap check may overlap
+        free_from = max(free_from, booked_to)
+    if free_from < last or not bookings:
+        windows.append((free_from, last))
+
+    result = {
+        "car_id": car_id,
+        "from": first.isoformat(),
+        "to": last.isoformat(),
+        "booked_subscriptions": len(bookings),
+        "windows": [
+            {"start": window_start.isoformat(), "end": window_end.isoformat(), "days": (window_end - window_start).days + 1}
+            for window_start, window_end in windows
+        ],
+    }
+    if invalid:
+        result["invalid_subscription_ids"] = invalid
+
+    return [200, result]
+
+def _parse_update(data):
+    # Validates the fields once and puts them in column order, so every
+    # combination of fields maps to one SQL text
+    unknown = [field for field in data if field not in UPDATE_FIELDS and field != 'version']
+    if unknown:
+        raise ValueError(f"Unknown or read-only fields: {', '.join(unknown)}")
+
+    fields = tuple(field for field in UPDATE_FIELDS if field in data)
+    if not fields:
+        raise ValueError("No fields to update")
+
+    values = []
+    for field in fields:
+        try:
+            values.append(UPDATE_FIELDS[field](data[field]))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid value for '{field}': {e}") from None
+
+    if 'subscription_start_date' in fields and 'subscription_end_date' in fields:
+        if data['subscription_end_date'] < data['subscription_start_date']:
+            raise ValueError("Subscription ends before it starts")
+
+    version = data.get('version')
+    if version is not None:
+        version = _int_value(version)
+
+    return fields, values, version
+
+@lru_cache(maxsize=1024)
+def _update_query(fields, conditional):
+    # One statement per field combination, so it is compiled once and then
+    # reused from the connection's statement cache
+    assignments = ', '.join(f'{field} = ?' for field in fields)
+    query = f''' UPDATE {TABLE_NAME}
+        SET {assignments}, version = version + 1
+        WHERE subscription_id = ?{' AND version = ?' if conditional else ''}
+        RETURNING version, car_id '''
+    return query
+
+def _update(cur, id, data):
+    # With a 'version' in data the update only applies if the subscription
+    # is still at that version, otherwise it is a 409 conflict, as is a new
+    # car or new dates overlapping another subscription of the car.
+    # Availability is recalculated for the old and the new car when a
+    # subscription changes car or dates
+    fields, values, expected_version = _parse_update(data)
+
+    affects_cars = any(field in fields for field in AVAILABILITY_FIELDS)
+    old_car_id = None
+    if affects_cars:
+        cur.execute(f'SELECT {", ".join(AVAILABILITY_FIELDS)} FROM {TABLE_NAME} WHERE subscription_id = ?', (id,))
+        current = cur.fetchone()
+        if current is not None:
+            old_car_id = current[0]
+            booking = dict(zip(AVAILABILITY_FIELDS, current))
+            booking.update((field, value) for field, value in zip(fields, values) if field in AVAILABILITY_FIELDS)
+            start, end = booking['subscription_start_date'], booking['subscription_end_date']
+            if start is not None and end is not None and end < start:
+                raise ValueError("Subscription ends before it starts")
+            conflict = _booking_conflict(cur, booking, exclude_id=id)
+            if conflict:
+                return [409, conflict, []]
+
+    params = values + [id]
+    if expected_version is not None:
+        params.append(expected_version)
+    cur.execute(_update_query(fields, expected_version is not None), params)
+    row = cur.fetchone()
+
+    if row is None:
+        cur.execute(f'SELECT version FROM {TABLE_NAME} WHERE subscription_id = ?', (id,))
+        current = cur.fetchone()
+        if current is None:
+            return [404, {"message": "Subscription not found."}, []]
+        return [409, {"error": "Subscription was changed by someone else.", "version": current[0]}, []]
+
+    version, car_id = row
+    result = {"message": "Subscription updated successfully.", "version": version}
+    if not affects_cars:
+        return [200, result, []]
+
+    return [200, result, _enqueue_car_availability(cur, [old_car_id, car_id])]
+
+@metrics.timed('db')
 def update_subscription(id, data):
+    if not isinstance(data, dict):
+        return [400, {"error": "Expected a JSON object"}]
+
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with db.connection() as conn:
             cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
             
-            query = f'''
-            UPDATE {TABLE_NAME}
-            SET '''
-
-            i = 0
-            values = []
-            for key,value in data.items():
-                if key not in query:
-                    if i > 0:
-                        query+= ", "
-
-                    query += f'{key} = ?'
-                    values.append(value)
-                    i += 1
-
-            query += f" WHERE subscription_id = {id}"
-            print(query)
-
-            cur.execute(query, (values))
-            if cur.rowcount == 0:
-                return [404, {"message": "Subscription not found."}]
+            status, result, queued = _update(cur, id, data)
+            if status != 200:
+                return [status, result]
+
+        _invalidate(id, data)
+
+        if queued:
+            result["car_update"] = {"status": "queued", "car_ids": queued}
             
-            return [200, {"message": "Subscription updated successfully."}]
+        return [200, result]
+
+    except ValueError as e:
+        return [400, {"error": str(e)}]
 
     except sqlite3.Error as e:
         return [500, {"error": str(e)}]
 
+def _delete(cur, id):
+    car_id = _car_id(cur, id)
+    cur.execute(f'DELETE FROM {TABLE_NAME} WHERE subscription_id = ?', (id,))
+    rowcount = cur.rowcount
+    if rowcount == 0:
+        return rowcount, []
+
+    return rowcount, _enqueue_car_availability(cur, [car_id])
+
+@metrics.timed('db')
 def delete_item_by_id(id):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with db.connection() as conn:
             cur = conn.cursor()
 
             # Delete the row with the specified id
-            cur.execute(f'DELETE FROM {TABLE_NAME} WHERE subscription_id = ?', (id,))
-            
-            if cur.rowcount == 0:
+            rowcount, queued = _delete(cur, id)
+            if rowcount == 0:
                 return [404, {"message": "Subscription not found."}]
+
+        _invalidate(id)
+
+        result = {"message": f"Subscription deleted from {TABLE_NAME} successfully."}
+        if queued:
+            result["car_update"] = {"status": "queued", "car_ids": queued}
             
-            return [200, {"message": f"Subscription deleted from {TABLE_NAME} successfully."}]
+        return [200, result]
 
     except sqlite3.Error as e:
-        return [500, {"error": str(e)}]
\ No newline at end of file
+        return [500, {"error": str(e)}]
+
+def _apply_operation(cur, operation):
+    if not isinstance(operation, dict):
+        raise ValueError("Operation must be an object")
+
+    op = operation.get('op')
+    id = operation.get('id')
+    data = operation.get('data') or {}
+
+    if op in ('update', 'delete') and not isinstance(id, int):
+        raise ValueError(f"'{op}' needs an integer 'id'")
+    if op in ('create', 'update') and not isinstance(data, dict):
+        raise ValueError("'data' must be an object")
+
+    if op == 'create':
+        data = _parse_create(data)
+        conflict = _booking_conflict(cur, data)
+        if conflict:
+            return [409, conflict, None, []]
+        id, queued = _insert(cur, data)
+        return [201, {"message": "New subscription added to database", "subscription_id": id}, id, queued]
+
+    if op == 'update':
+        if not data:
+            raise ValueError("'update' needs a non-empty 'data' object")
+        status, result, queued = _update(cur, id, data)
+        return [status, result, id if status == 200 else None, queued]
+
+    if op == 'delete':
+        rowcount, queued = _delete(cur, id)
+        if rowcount == 0:
+            return [404, {"message": "Subscription not found."}, None, []]
+        return [200, {"message": f"Subscription deleted from {TABLE_NAME} successfully."}, id, queued]
+
+    raise ValueError(f"Unknown op '{op}', expected create, update or delete")
+
+@metrics.timed('db')
+def apply_batch(operations):
+    # Applies create/update/delete operations in a single transaction. Each
+    # operation runs in its own savepoint, so a failing item is rolled back
+    # and reported without affecting the others. Every car touched by the
+    # batch gets one queued availability update
+    if not isinstance(operations, list) or not operations:
+        return [400, {"error": "Expected a non-empty list of operations"}]
+    if len(operations) > MAX_BATCH_SIZE:
+        return [400, {"error": f"A batch can hold at most {MAX_BATCH_SIZE} operations"}]
+
+    results = []
+    written = []
+    queued = {}
+
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            # Immediate, so the booking checks see every committed write
+            # and nothing else writes until the batch is done
+            cur.execute('BEGIN IMMEDIATE')
+
+            for index, operation in enumerate(operations):
+                cur.execute('SAVEPOINT batch_item')
+                try:
+                    status, result, id, car_ids = _apply_operation(cur, operation)
+                    cur.execute('RELEASE SAVEPOINT batch_item')
+
+                except (ValueError, sqlite3.IntegrityError, sqlite3.OperationalError) as e:
+                    cur.execute('ROLLBACK TO SAVEPOINT batch_item')
+                    cur.execute('RELEASE SAVEPOINT batch_item')
+                    status, result, id, car_ids = 400, {"error": str(e)}, None, []
+
+                results.append({"index": index, "status": status, "result": result})
+                if id is not None:
+                    written.append((id, operation.get('data')))
+                queued.update(dict.fromkeys(car_ids))
+
+        for id, data in written:
+            _invalidate(id, data)
+
+        return [200, {"results": results, "car_update": {"status": "queued", "car_ids": list(queued)}}]
+
+    except sqlite3.Error as e:
+        return [500, {"error": str(e)}]
@@ -1,4 +1,15 @@
-from flasgger import Swagger
+import importlib.util
+import os
+from flask import Blueprint, Response, send_file
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+SPEC_DIR = os.path.dirname(os.path.abspath(__file__))
+# auto serves OPENAPI_SPEC if it has been built (python manage.py build-openapi)
+# and otherwise builds the spec from the YAML files with flasgger
+SWAGGER_MODE = os.getenv('SWAGGER_MODE', 'auto')
+OPENAPI_SPEC = os.getenv('OPENAPI_SPEC', os.path.join(SPEC_DIR, 'openapi.json'))
 
 # Swagger configuration
 swagger_config = {
@@ -37,6 +48,73 @@ template = {
     ]
 }
 
+DOCS_PAGE = f'''<!DOCTYPE html>
+<html>
+<head>
+  <title>{template["info"]["title"]}</title>
+  <link rel="stylesheet" href="{swagger_config["static_url_path"]}/swagger-ui.css">
+</head>
+<body>
+  <div id="swagger-ui"></div>
+  <script src="{swagger_config["static_url_path"]}/swagger-ui-bundle.js"></script>
+  <script src="{swagger_config["static_url_path"]}/swagger-ui-standalone-preset.js"></script>
+  <script>
+    SwaggerUIBundle({{
+      url: "{swagger_config["specs"][0]["route"]}",
+      dom_id: "#swagger-ui",
+      presets: [SwaggerUIBundle.presets.apis, SwaggerUIStandalonePreset],
+      layout: "StandaloneLayout"
+    }})
+  </script>
+</body>
+</html>
+'''
+
+def swag_from(path):
+    """Attach a YAML spec file to a view.
+
+    Sets the same attributes as flasgger's swag_from does for a file, so
+    flasgger finds them when it builds the spec, but without importing
+    flasgger. Paths are relative to the repository root"""
+    def decorator(f):
+        f.swag_path = os.path.join(os.path.dirname(SPEC_DIR), path)
+        f.swag_type = path.rsplit('.', 1)[-1]
+        return f
+    return decorator
+
+def _static_swagger(app):
+    # Serves the prebuilt spec and the Swagger UI at the same routes as
+    # flasgger. The UI assets are taken from the installed flasgger package,
+    # which is located without importing it
+    flasgger_dir = importlib.util.find_spec('flasgger').submodule_search_locations[0]
+    blueprint = Blueprint(
+        'flasgger', __name__,
+        static_folder=os.path.join(flasgger_dir, 'ui3', 'static'),
+        static_url_path=swagger_config["static_url_path"]
+    )
+    blueprint.add_url_rule(
+        swagger_config["specs"][0]["route"], swagger_config["specs"][0]["endpoint"],
+        lambda: send_file(OPENAPI_SPEC, mimetype='application/json')
+    )
+    blueprint.add_url_rule(
+        swagger_config["specs_route"], 'apidocs', lambda: Response(DOCS_PAGE, mimetype='text/html')
+    )
+    app.register_blueprint(blueprint)
+
 def init_swagger(app):
     """Initialize Swagger with the given Flask app"""
+    mode = SWAGGER_MODE
+    if mode == 'auto':
+        mode = 'static' if os.path.exists(OPENAPI_SPEC) else 'dynamic'
+
+    if mode == 'off':
+        return None
+    if mode == 'static':
+        if not os.path.exists(OPENAPI_SPEC):
+            raise RuntimeError(f'{OPENAPI_SPEC} not found, build it with: python manage.py build-openapi')
+        return _static_swagger(app)
+    if mode != 'dynamic':
+        raise RuntimeError(f"SWAGGER_MODE must be auto, static, dynamic or off, not '{SWAGGER_MODE}'")
+
+    from flasgger import Swagger
     return Swagger(app, config=swagger_config, template=template)
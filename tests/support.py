@@ -0,0 +1,33 @@
+# Imported first by every test module: points the app at a throwaway
+# database before db.py reads DB_PATH, and keeps the background threads off
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+WORKDIR = tempfile.mkdtemp(prefix='subscriptions-tests-')
+atexit.register(shutil.rmtree, WORKDIR, True)
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'test.db')
+os.environ['OUTBOX_ENABLED'] = 'false'
+os.environ['AVAILABILITY_JOB_ENABLED'] = 'false'
+
+import app
+import auth
+import db
+import subscription
+
+auth.SECRET_KEY = 'tests'
+ADMIN = {'Authorization': auth.create_token('tests@example.com', ['admin'])}
+
+def reset_database():
+    # Every test starts from the migrated schema without subscriptions
+    app.init_schema()
+    with db.connection() as conn:
+        conn.execute(f'DELETE FROM {subscription.TABLE_NAME}')
+        conn.execute(f'DELETE FROM {subscription.OUTBOX_TABLE}')
+    subscription.clear_cache()
+
+def booking(car_id, start, end, **fields):
+    return {"car_id": car_id, "subscription_start_date": start, "subscription_end_date": end, **fields}
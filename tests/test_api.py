@@ -0,0 +1,42 @@
+import unittest
+
+from support import ADMIN, booking, reset_database
+import app
+
+class ApiTest(unittest.TestCase):
+    def setUp(self):
+        reset_database()
+        self.client = app.app.test_client()
+
+    def create(self, data):
+        response = self.client.post('/subscriptions/batch', json=[{"op": "create", "data": data}], headers=ADMIN)
+        self.assertEqual(response.status_code, 200, response.json)
+        return response.json["results"][0]["result"]["subscription_id"]
+
+    def test_update_with_an_outdated_version_is_a_conflict(self):
+        id = self.create(booking(1, '2026-01-01', '2026-04-01', monthly_subscription_price=3000))
+
+        response = self.client.patch(f'/subscriptions/{id}', json={"monthly_subscription_price": 3500, "version": 1}, headers=ADMIN)
+        self.assertEqual(response.status_code, 200, response.json)
+        self.assertEqual(response.json["version"], 2)
+
+        response = self.client.patch(f'/subscriptions/{id}', json={"monthly_subscription_price": 4000, "version": 1}, headers=ADMIN)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json["version"], 2)
+        self.assertEqual(self.client.get(f'/subscriptions/{id}', headers=ADMIN).json["monthly_subscription_price"], 3500)
+
+    def test_batch_with_a_failing_item_is_a_multi_status(self):
+        response = self.client.post('/subscriptions/batch', json=[
+            {"op": "create", "data": booking(1, '2026-01-01', '2026-04-01')},
+            {"op": "create", "data": booking(1, '2026-02-01', '2026-05-01')},
+            {"op": "update", "id": 999999, "data": {"contracted_km": 1000}},
+            {"op": "delete"},
+        ], headers=ADMIN)
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([item["status"] for item in response.json["results"]], [201, 409, 404, 400])
+        id = response.json["results"][0]["result"]["subscription_id"]
+        self.assertEqual(self.client.get(f'/subscriptions/{id}', headers=ADMIN).status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
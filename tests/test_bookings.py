@@ -0,0 +1,41 @@
+import unittest
+
+from support import booking, reset_database
+import subscription
+
+class BookingConflictTest(unittest.TestCase):
+    def setUp(self):
+        reset_database()
+        status, _ = subscription.add_subscription(booking(1, '2021-08-01', '2021-11-01'))
+        self.assertEqual(status, 201)
+
+    def test_renewal_starting_on_the_previous_end_date(self):
+        status, result = subscription.add_subscription(booking(1, '2021-11-01', '2022-02-01'))
+        self.assertEqual(status, 201, result)
+
+    def test_booking_ending_on_the_next_start_date(self):
+        status, result = subscription.add_subscription(booking(1, '2021-05-01', '2021-08-01'))
+        self.assertEqual(status, 201, result)
+
+    def test_overlapping_booking(self):
+        status, result = subscription.add_subscription(booking(1, '2021-10-31', '2022-02-01'))
+        self.assertEqual(status, 409)
+        self.assertEqual(result["error"], "Car 1 is already subscribed from 2021-08-01 to 2021-11-01")
+
+    def test_back_to_back_in_a_batch(self):
+        status, body = subscription.apply_batch([
+            {"op": "create", "data": booking(1, '2021-11-01', '2022-02-01')},
+            {"op": "create", "data": booking(1, '2022-02-01', '2022-05-01')},
+        ])
+        self.assertEqual(status, 200, body)
+
+    def test_free_window_starts_on_the_end_date(self):
+        status, result = subscription.get_free_windows(1, '2021-07-01', '2021-12-01')
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            [(window["start"], window["end"]) for window in result["windows"]],
+            [('2021-07-01', '2021-08-01'), ('2021-11-01', '2021-12-01')]
+        )
+
+if __name__ == '__main__':
+    unittest.main()
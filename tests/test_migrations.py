@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import unittest
+from datetime import date, timedelta
+
+from support import WORKDIR
+import analytics
+import app
+import db
+import subscription
+
+# The subscriptions table as it was before the versioned migrations
+BASELINE_TABLE = f''' CREATE TABLE {subscription.TABLE_NAME} 
+    (
+        subscription_id INTEGER PRIMARY KEY AUTOINCREMENT, 
+        car_id INTEGER, 
+        subscription_start_date TEXT, 
+        subscription_end_date TEXT, 
+        subscription_duration_months INTEGER DEFAULT 3, 
+        km_driven_during_subscription INTEGER, 
+        contracted_km INTEGER, 
+        monthly_subscription_price INTEGER, 
+        delivery_location TEXT, 
+        has_delivery_insurance BOOLEAN DEFAULT FALSE 
+    ) '''
+
+class UpgradeTest(unittest.TestCase):
+    def setUp(self):
+        path = os.path.join(WORKDIR, 'baseline.db')
+        today = date.today()
+        with sqlite3.connect(path) as conn:
+            conn.execute(BASELINE_TABLE)
+            conn.execute(
+                subscription.INSERT_QUERY,
+                (1, (today - timedelta(days=10)).isoformat(), (today + timedelta(days=80)).isoformat(),
+                 3, 13000, 12000, 5000, 'Aarhus', False)
+            )
+        self.addCleanup(os.remove, path)
+
+        # Points the app at the baseline database for this test
+        pool = db._pool
+        db._pool = db.ConnectionPool(path, 2, 5)
+        self.addCleanup(setattr, db, '_pool', pool)
+        self.addCleanup(db._pool.close_idle)
+        self.addCleanup(subscription.clear_cache)
+        subscription.clear_cache()
+
+    def test_upgrade_keeps_the_answers_for_existing_subscriptions(self):
+        self.assertEqual(app.init_schema(), subscription.MIGRATIONS[-1][0])
+
+        self.assertEqual(subscription.get_active_subscriptions_total_price(), [200, {"total_price": 5000}])
+        status, overage = analytics.get_km_overage()
+        self.assertEqual(status, 200)
+        self.assertEqual((overage["subscriptions"], overage["overage_km"]), (1, 1000))
+
+        status, report = analytics.reconcile_aggregates(rebuild=False)
+        self.assertEqual(status, 200)
+        self.assertTrue(report["consistent"], report)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from support import reset_database
+import app
+import replication
+
+class ReplicaGuardTest(unittest.TestCase):
+    def setUp(self):
+        reset_database()
+
+    def guard(self, method, path):
+        with app.app.test_request_context(path, method=method):
+            return replication.guard_request()
+
+    def test_writes_are_refused(self):
+        for method, path in (('POST', '/subscriptions'), ('PATCH', '/subscriptions/1'),
+                             ('DELETE', '/subscriptions/1'), ('POST', '/admin/subscriptions/import')):
+            response, status = self.guard(method, path)
+            self.assertEqual(status, 403, f'{method} {path}')
+            self.assertIn("read replica", response.json["error"])
+
+    def test_reads_are_refused_before_the_first_copy(self):
+        response = self.guard('GET', '/subscriptions')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_other_paths_are_served(self):
+        self.assertIsNone(self.guard('POST', '/admin/profiler/start'))
+        self.assertIsNone(self.guard('GET', '/health'))
+
+if __name__ == '__main__':
+    unittest.main()